@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Benchmark of the startup of `create-dev-env`, up to the point where the first copy job can be submitted, with a
+# stubbed BigQuery client that adds a fixed latency to every request. Run from the root of the repository:
+# `python -m benchmarks.bench_create_dev_env_startup --tables 100 --latency-ms 100`
+
+import sys
+import time
+from argparse import ArgumentParser
+
+from scripts import create_dev_env
+
+
+class StubClient:
+    """Stands in for `bigquery.Client`, counting instances and sleeping on every request."""
+    instances = 0
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        StubClient.instances += 1
+        self.project = "stub-project"
+
+    def get_table(self, table_id: str):
+        time.sleep(StubClient.latency)
+        dataset_id, table_name = table_id.split(".")[-2:]
+        return create_dev_env.bigquery.Table(f"{self.project}.{dataset_id}.{table_name}")
+
+
+def measure_startup(table_ids: list[str], metadata_workers: int) -> tuple[float, float]:
+    """Returns the time to parse the arguments, and the time to resolve them, in seconds."""
+    create_dev_env.client = None
+    StubClient.instances = 0
+    argv = [arg for table_id in table_ids for arg in ("--source-table", table_id)]
+    argv += ["--target-dataset", "dev_dataset", "--metadata-workers", str(metadata_workers)]
+    started_at = time.perf_counter()
+    args = create_dev_env.ProgramArguments(create_dev_env.get_parser().parse_args(argv))
+    parsed_at = time.perf_counter()
+    assert StubClient.instances == 0, "Parsing the arguments must not create a client"
+    args.resolve()
+    resolved_at = time.perf_counter()
+    assert len(args.source_tables) == len(table_ids)
+    return parsed_at - started_at, resolved_at - parsed_at
+
+
+def main():
+    parser = ArgumentParser(prog="bench-create-dev-env-startup", description="Benchmark create-dev-env startup")
+    parser.add_argument("--tables", type=int, default=100, help="The number of `--source-table` arguments.")
+    parser.add_argument("--latency-ms", type=float, default=100, dest="latency_ms",
+                        help="The latency of every request to the stubbed client, in milliseconds.")
+    args = parser.parse_args(sys.argv[1:])
+
+    create_dev_env.bigquery.Client = StubClient
+    StubClient.latency = args.latency_ms / 1000
+    table_ids = [f"source_dataset.table_{i}" for i in range(args.tables)]
+    print(f"{'Metadata workers':>16} | {'Parse (ms)':>10} | {'Resolve (ms)':>12} | {'Total (ms)':>10}")
+    print(f"{'-' * 16}-+-{'-' * 10}-+-{'-' * 12}-+-{'-' * 10}")
+    for workers in [1, 4, create_dev_env.DEFAULT_METADATA_WORKERS, 64]:
+        parse_time, resolve_time = measure_startup(table_ids, workers)
+        print(f"{workers:>16} | {parse_time * 1000:>10.1f} | {resolve_time * 1000:>12.1f} | "
+              f"{(parse_time + resolve_time) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Benchmark of the SQL statement splitter on generated test files. Run from the root of the repository:
+# `python -m benchmarks.bench_sql_splitter --max-size-mb 50`
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from scripts.sql_splitter import iter_sql_statements
+
+# A statement with all the constructs the splitter has to look into: strings, comments and quoted identifiers, all of
+# them containing semicolons.
+STATEMENT_TEMPLATE = """-- Test number {i}; checks the orders table
+ASSERT
+  ((
+    SELECT
+      COUNT(*)
+    FROM
+      `${{the_look_ecom_copy.orders}}` AS o /* the orders; all of them */
+    WHERE
+      o.status = 'Shipped; or not' AND o.id > {i})) >= 0) AS "orders check {i}; should never fail";
+"""
+
+
+def generate_corpus(path: str, size_bytes: int) -> int:
+    """Writes a test file of about `size_bytes` bytes, and returns the number of statements in it."""
+    written = 0
+    count = 0
+    with open(path, "w") as fp:
+        while written < size_bytes:
+            statement = STATEMENT_TEMPLATE.format(i=count)
+            fp.write(statement)
+            written += len(statement)
+            count += 1
+    return count
+
+
+def split_file(path: str) -> int:
+    with open(path) as fp:
+        return sum(1 for _ in iter_sql_statements(fp))
+
+
+def main():
+    parser = ArgumentParser(prog="bench-sql-splitter", description="Benchmark the SQL statement splitter")
+    parser.add_argument("--max-size-mb", type=int, default=50, dest="max_size_mb",
+                        help="The size of the largest generated file. Smaller files are halved from this size.")
+    parser.add_argument("--steps", type=int, default=4, help="The number of file sizes to benchmark.")
+    args = parser.parse_args(sys.argv[1:])
+
+    sizes = [args.max_size_mb * 1024 * 1024 // 2 ** i for i in reversed(range(args.steps))]
+    print(f"{'Size (MB)':>10} | {'Statements':>10} | {'Seconds':>8} | {'MB/s':>7} | {'Peak memory (MB)':>16}")
+    print(f"{'-' * 10}-+-{'-' * 10}-+-{'-' * 8}-+-{'-' * 7}-+-{'-' * 16}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            path = os.path.join(tmp_dir, f"corpus_{size}.sql")
+            expected = generate_corpus(path, size)
+            started_at = time.perf_counter()
+            count = split_file(path)
+            elapsed = time.perf_counter() - started_at
+            assert count == expected, f"Expected {expected} statements, got {count}"
+            # Memory is measured on a separate pass, as tracing slows down the split considerably.
+            tracemalloc.start()
+            split_file(path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            size_mb = size / 1024 / 1024
+            print(f"{size_mb:>10.2f} | {count:>10} | {elapsed:>8.2f} | {size_mb / elapsed:>7.1f} | "
+                  f"{peak / 1024 / 1024:>16.2f}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Micro-benchmark of the template renderer used for the SQL tests, against the previous implementation that retried
+# `substitute` once for every missing key. Run from the root of the repository:
+# `python -m benchmarks.bench_template_renderer --keys 10000 --statements 1000`
+
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from string import Template
+
+from scripts.run_tests import TemplateWithDefaultKey, compile_template
+
+
+class RetryOnKeyErrorTemplate(Template):
+    """The previous implementation of TemplateWithDefaultKey, kept for comparison."""
+    idpattern = TemplateWithDefaultKey.idpattern
+
+    def substitute(self, *args, **kwds):
+        try:
+            return super().substitute(*args, **kwds)
+        except KeyError as err:
+            key = str(err.args[0])
+            kwds[key] = key
+            return self.substitute(*args, **kwds)
+
+
+def generate_statements(num_statements: int, num_keys: int, refs_per_statement: int,
+                        missing_ratio: float) -> list[str]:
+    rnd = random.Random(42)
+    statements = []
+    for i in range(num_statements):
+        refs = []
+        for _ in range(refs_per_statement):
+            if rnd.random() < missing_ratio:
+                refs.append(f"${{untranslated_dataset.table_{rnd.randrange(num_keys)}}}")
+            else:
+                refs.append(f"${{dataset_{rnd.randrange(num_keys) % 100}.table_{rnd.randrange(num_keys)}}}")
+        joins = "\n  CROSS JOIN ".join(f"`{ref}` AS t{j}" for j, ref in enumerate(refs))
+        statements.append(f"ASSERT ((SELECT COUNT(*) FROM {joins}) >= 0) AS 'statement {i}';")
+    return statements
+
+
+def generate_translations(num_keys: int) -> dict[str, str]:
+    return {f"dataset_{i % 100}.table_{i}": f"project.dev_dataset.clone_20220317151941_table_{i}"
+            for i in range(num_keys)}
+
+
+def measure(label: str, render, statements: list[str], translations: dict[str, str]):
+    started_at = time.perf_counter()
+    for statement in statements:
+        render(statement, translations)
+    elapsed = time.perf_counter() - started_at
+    print(f"{label:<40} | {elapsed * 1000:>10.1f} | {elapsed / len(statements) * 1e6:>12.1f}")
+
+
+def main():
+    parser = ArgumentParser(prog="bench-template-renderer", description="Benchmark the SQL template renderer")
+    parser.add_argument("--keys", type=int, default=10_000, help="The number of keys in the translation map.")
+    parser.add_argument("--statements", type=int, default=1_000, help="The number of statements to render.")
+    parser.add_argument("--refs-per-statement", type=int, default=20, dest="refs_per_statement",
+                        help="The number of table placeholders in each statement.")
+    parser.add_argument("--missing-ratio", type=float, default=0.5, dest="missing_ratio",
+                        help="The ratio of placeholders that are not in the translation map.")
+    args = parser.parse_args(sys.argv[1:])
+
+    statements = generate_statements(args.statements, args.keys, args.refs_per_statement, args.missing_ratio)
+    translations = generate_translations(args.keys)
+    print(f"{'Renderer':<40} | {'Total (ms)':>10} | {'Per stmt (us)':>12}")
+    print(f"{'-' * 40}-+-{'-' * 10}-+-{'-' * 12}")
+
+    # The previous implementation adds every missing key to the mapping it is given, so it gets a copy.
+    measure("retry on KeyError (previous)",
+            lambda statement, mapping: RetryOnKeyErrorTemplate(statement).substitute(mapping),
+            statements, dict(translations))
+    compile_template.cache_clear()
+    measure("single pass, cold compile cache",
+            lambda statement, mapping: TemplateWithDefaultKey(statement).substitute(mapping),
+            statements, translations)
+    measure("single pass, warm compile cache",
+            lambda statement, mapping: TemplateWithDefaultKey(statement).substitute(mapping),
+            statements, translations)
+    assert len(translations) == args.keys, "The translation map must not be modified by the renderer"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Benchmark suite of the stages of `run-tests` and `create-dev-env`, with the local backend standing in for BigQuery.
+# Every stage reports its best time over a few repeats and its peak memory, compared with the saved baselines. Run from
+# the root of the repository:
+# `python -m benchmarks.suite` to compare with the baselines, exiting with 1 on a regression
+# `python -m benchmarks.suite --save-baseline` to record new baselines, e.g. after an improvement or on a new machine
+# Times depend on the machine, so a CI job must record its baselines on the runner itself, see the README.
+
+import asyncio
+import contextlib
+import dataclasses
+import fnmatch
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Callable, Iterator, Optional
+
+from scripts import backends, create_dev_env, run_tests
+from scripts.local_bigquery import LocalClient
+from scripts.run_tests import TemplateWithDefaultKey, compile_template, format_bytes, r_pad
+
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# A stage regresses when it is slower, or uses more memory, than its baseline by more than this ratio.
+DEFAULT_THRESHOLD = 0.25
+
+# Differences under these are noise, whatever the ratio.
+MIN_SECONDS_DIFFERENCE = 0.005
+MIN_BYTES_DIFFERENCE = 256 * 1024
+
+# The name of the backend the benchmarks register, to hand their pre-populated client to `run_tests.run`.
+BENCHMARK_BACKEND = "benchmark"
+
+
+@dataclasses.dataclass()
+class Measurement:
+    seconds: float
+    peak_bytes: int
+
+
+def measure(func: Callable[[], None], repeat: int) -> Measurement:
+    """Returns the best time of `repeat` calls of `func`, and the peak memory of one more call. Memory is measured
+    separately, as tracing allocations slows everything down.
+    """
+    times = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started_at)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Measurement(seconds=min(times), peak_bytes=peak_bytes)
+
+
+def write_test_files(directory: str, num_files: int, statements_per_file: int = 2):
+    for i in range(num_files):
+        # Spread the files over sub-directories, like a real test suite.
+        sub_directory = os.path.join(directory, f"area_{i % 20}")
+        os.makedirs(sub_directory, exist_ok=True)
+        with open(os.path.join(sub_directory, f"test_{i}.sql"), "w") as fp:
+            for j in range(statements_per_file):
+                table = (i + j) % 100
+                fp.write(f"-- Test {j} of file {i}\n"
+                         f"ASSERT ((SELECT COUNT(*) FROM `${{dataset_{table % 10}.table_{table}}}` "
+                         f"WHERE id < 0) = 0) AS 'file {i}, test {j}: ids must be positive';\n")
+
+
+def synthetic_translations(num_keys: int) -> dict[str, str]:
+    return {f"dataset_{i % 10}.table_{i}": f"local-project.dev.clone_20220317151941_table_{i}"
+            for i in range(num_keys)}
+
+
+def populated_client(database: str, num_tables: int, job_duration: float, rows_per_table: int = 10) -> LocalClient:
+    """Returns a local client with `num_tables` tables in the `src` dataset. The tables are written to `database`, and
+    the client works on an in-memory copy of them.
+    """
+    connection = sqlite3.connect(database)
+    for i in range(num_tables):
+        connection.execute(f'CREATE TABLE "src.table_{i}" (id INTEGER)')
+        connection.executemany(f'INSERT INTO "src.table_{i}" VALUES (?)', [(j,) for j in range(rows_per_table)])
+    connection.commit()
+    connection.close()
+    return LocalClient.in_memory_copy(database, job_duration=job_duration)
+
+
+def stages(stack: contextlib.ExitStack, quick: bool) -> Iterator[tuple[str, Callable[[], None]]]:
+    """Generates the name and the function of every stage. Setting up a stage is not part of its measurement."""
+    for num_files in [10, 100, 1_000] + ([] if quick else [10_000]):
+        directory = stack.enter_context(tempfile.TemporaryDirectory())
+        write_test_files(directory, num_files)
+        translations = synthetic_translations(100)
+
+        def load_tests(directory=directory, translations=translations, num_files=num_files):
+            # Every load starts cold, as a new process would.
+            compile_template.cache_clear()
+            tests = run_tests.get_tests_to_run(directory, translations)
+            assert len(tests) == num_files * 2
+
+        yield f"get_tests_to_run/{num_files}_files", load_tests
+
+    template = TemplateWithDefaultKey("\n".join(f"SELECT * FROM `${{dataset_{i % 10}.table_{i}}}`;"
+                                                for i in range(0, 1_000, 7)))
+    for num_keys in [10, 1_000, 100_000] + ([] if quick else [1_000_000]):
+        translations = synthetic_translations(num_keys)
+
+        def substitute(template=template, translations=translations):
+            for _ in range(100):
+                template.substitute(translations)
+
+        yield f"substitute/{num_keys}_keys", substitute
+
+    for num_tests, job_duration in [(200, 0.05)] + ([] if quick else [(2_000, 0.05)]):
+        directory = stack.enter_context(tempfile.TemporaryDirectory())
+        num_files = num_tests // 2
+        write_test_files(directory, num_files)
+        client = populated_client(os.path.join(directory, "bigquery.sqlite"), 100, job_duration)
+        translation_file = os.path.join(directory, "translation.json")
+        with open(translation_file, "w") as fp:
+            json.dump({f"dataset_{i % 10}.table_{i}": f"src.table_{i}" for i in range(100)}, fp)
+        argv = ["--translation-file", translation_file, directory, "--project", client.project,
+                "--max-concurrency", "100", "--no-cache", "--history-file", os.path.join(directory, "history.json")]
+
+        def run(client=client, argv=argv):
+            args = run_tests.ProgramArguments(run_tests.get_parser().parse_args(argv))
+            with benchmark_backend(client), contextlib.redirect_stdout(io.StringIO()):
+                assert asyncio.run(run_tests.run(args)) == 0
+
+        yield f"run/{num_tests}_tests_{int(job_duration * 1000)}ms_jobs", run
+
+    for num_tables in [100] + ([] if quick else [500]):
+        directory = stack.enter_context(tempfile.TemporaryDirectory())
+        database = os.path.join(directory, "bigquery.sqlite")
+        populated_client(database, num_tables, job_duration=0.01, rows_per_table=1).close()
+
+        def create_env(database=database):
+            # Every run starts from the source tables only, so that the clones of the previous runs do not slow it down.
+            client = LocalClient.in_memory_copy(database, job_duration=0.01)
+            argv = ["create-dev-env", "--source-dataset", "src", "--target-dataset", "dev",
+                    "--create-dataset", "--max-concurrent-jobs", "16"]
+            with patched_argv(argv), patched_dev_env_client(client), contextlib.redirect_stdout(io.StringIO()):
+                create_dev_env.main()
+            client.close()
+
+        yield f"create_dev_env/{num_tables}_tables_10ms_jobs", create_env
+
+
+@contextlib.contextmanager
+def patched_argv(argv: list[str]):
+    saved_argv = sys.argv
+    sys.argv = argv
+    try:
+        yield
+    finally:
+        sys.argv = saved_argv
+
+
+@contextlib.contextmanager
+def benchmark_backend(client: LocalClient):
+    """Selects a backend that returns `client`, e.g. for `run_tests.run`, and restores the previous backend after."""
+    saved_factory = backends.BACKENDS.get(BENCHMARK_BACKEND)
+    saved_backend = os.environ.get(backends.BACKEND_ENV_VAR)
+    backends.BACKENDS[BENCHMARK_BACKEND] = lambda project=None: client
+    os.environ[backends.BACKEND_ENV_VAR] = BENCHMARK_BACKEND
+    try:
+        yield
+    finally:
+        if saved_factory is None:
+            del backends.BACKENDS[BENCHMARK_BACKEND]
+        else:
+            backends.BACKENDS[BENCHMARK_BACKEND] = saved_factory
+        if saved_backend is None:
+            del os.environ[backends.BACKEND_ENV_VAR]
+        else:
+            os.environ[backends.BACKEND_ENV_VAR] = saved_backend
+
+
+@contextlib.contextmanager
+def patched_dev_env_client(client: LocalClient):
+    saved_client = create_dev_env.client
+    create_dev_env.client = client
+    try:
+        yield
+    finally:
+        create_dev_env.client = saved_client
+
+
+def regressions(measurement: Measurement, baseline: Optional[dict], threshold: float) -> list[str]:
+    if baseline is None:
+        return []
+    found = []
+    if (measurement.seconds > baseline["seconds"] * (1 + threshold)
+            and measurement.seconds - baseline["seconds"] > MIN_SECONDS_DIFFERENCE):
+        found.append("time")
+    if (measurement.peak_bytes > baseline["peak_bytes"] * (1 + threshold)
+            and measurement.peak_bytes - baseline["peak_bytes"] > MIN_BYTES_DIFFERENCE):
+        found.append("memory")
+    return found
+
+
+def main():
+    parser = ArgumentParser(prog="bench-suite", description="Benchmark the stages of run-tests and create-dev-env")
+    parser.add_argument("--baseline-file", default=DEFAULT_BASELINE_FILE, dest="baseline_file",
+                        help="The JSON file with the baseline of every stage.")
+    parser.add_argument("--save-baseline", action="store_true", dest="save_baseline",
+                        help="Save the measurements as the new baselines, instead of comparing with them.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="The ratio over the baseline, in time or peak memory, that is reported as a regression.")
+    parser.add_argument("--repeat", type=int, default=3, help="The number of timed runs of every stage.")
+    parser.add_argument("--stage", action="append", dest="stages",
+                        help="Only run the stages matching this glob pattern, e.g: `run/*`. Can be repeated.")
+    parser.add_argument("--quick", action="store_true",
+                        help="Skip the largest sizes. Their baselines are left untouched by `--save-baseline`.")
+    args = parser.parse_args(sys.argv[1:])
+
+    baselines = {}
+    if os.path.exists(args.baseline_file):
+        with open(args.baseline_file) as fp:
+            baselines = json.load(fp)
+
+    max_stage_name = 45
+    print(f"{r_pad('Stage', max_stage_name)} | {r_pad('Time (ms)', 10)} | {r_pad('Baseline', 10)} | "
+          f"{r_pad('Peak memory', 11)} | {r_pad('Baseline', 11)} | Result")
+    print(f"{r_pad('', max_stage_name, '-')}-+-{'-' * 10}-+-{'-' * 10}-+-{'-' * 11}-+-{'-' * 11}-+-----------")
+    measurements = {}
+    regressed = []
+    with contextlib.ExitStack() as stack:
+        for name, func in stages(stack, args.quick):
+            if args.stages and not any(fnmatch.fnmatch(name, pattern) for pattern in args.stages):
+                continue
+            measurement = measure(func, args.repeat)
+            measurements[name] = measurement
+            baseline = baselines.get(name)
+            found = [] if args.save_baseline else regressions(measurement, baseline, args.threshold)
+            if found:
+                regressed.append(name)
+            result = "REGRESSION (" + ", ".join(found) + ")" if found else ("OK" if baseline else "no baseline")
+            baseline_time = f"{baseline['seconds'] * 1000:.1f}" if baseline else ""
+            baseline_memory = format_bytes(baseline["peak_bytes"]) if baseline else ""
+            print(f"{r_pad(name, max_stage_name)} | {r_pad(f'{measurement.seconds * 1000:.1f}', 10)} | "
+                  f"{r_pad(baseline_time, 10)} | {r_pad(format_bytes(measurement.peak_bytes), 11)} | "
+                  f"{r_pad(baseline_memory, 11)} | {result}")
+
+    if args.save_baseline:
+        baselines.update({name: dataclasses.asdict(measurement) for name, measurement in measurements.items()})
+        with open(args.baseline_file, "w") as fp:
+            json.dump(baselines, fp, indent=2, sort_keys=True)
+        print(f"Saved {len(measurements)} baseline(s) to {args.baseline_file}")
+    elif regressed:
+        print(f"{len(regressed)} stage(s) regressed by more than {args.threshold:.0%}: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
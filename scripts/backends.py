@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import os
+from typing import Callable, Optional
+
+import google.auth
+from google.cloud import bigquery
+
+# The environment variable selecting the backend of all the CLIs: the name of a registered backend, or the path of a
+# factory function in the form `package.module:function`.
+BACKEND_ENV_VAR = "CI_FOR_DATA_BACKEND"
+DEFAULT_BACKEND = "bigquery"
+
+
+def bigquery_backend(project: Optional[str] = None) -> bigquery.Client:
+    return bigquery.Client(project=project)
+
+
+def local_backend(project: Optional[str] = None):
+    # Imported here, so that the real backend does not pay for it.
+    from scripts.local_bigquery import LocalClient
+    return LocalClient.from_environment(project)
+
+
+# The known backends. A backend is a function that takes an optional project and returns an object with the same
+# interface as `bigquery.Client`, for the methods the CLIs use.
+BACKENDS = {
+    "bigquery": bigquery_backend,
+    "local": local_backend,
+}  # type: dict[str, Callable]
+
+
+def backend_name() -> str:
+    return os.environ.get(BACKEND_ENV_VAR, DEFAULT_BACKEND)
+
+
+def get_backend(name: Optional[str] = None) -> Callable:
+    """Finds a backend by name, or imports it when given as `package.module:function`.
+
+    Raises:
+        ValueError: if there is no such backend
+    """
+    name = name or backend_name()
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError(f"Unknown backend {name!r}, expected one of {', '.join(BACKENDS)} "
+                         f"or `package.module:function`")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def create_client(project: Optional[str] = None, backend: Optional[str] = None):
+    """Creates the client of the selected backend, the real BigQuery client unless `CI_FOR_DATA_BACKEND` says
+    otherwise.
+    """
+    return get_backend(backend)(project)
+
+
+def default_project(backend: Optional[str] = None) -> Optional[str]:
+    """Returns the project to use when none is given: the one of the environment credentials for BigQuery, and the
+    default project of the client for the other backends.
+    """
+    if (backend or backend_name()) == "bigquery":
+        _, project = google.auth.default()
+        return project
+    return create_client(backend=backend).project
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dataclasses
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, Iterator, Optional
+
+from google.api_core.exceptions import TooManyRequests
+from google.cloud import bigquery
+
+# The maximum number of copy jobs to have running at the same time.
+DEFAULT_MAX_CONCURRENT_JOBS = 8
+
+# The number of times a copy job is retried after hitting a rate limit or a quota, before giving up on it.
+DEFAULT_MAX_RETRIES = 5
+
+# The bounds of the delay before retrying a copy job, in seconds. The delay doubles on every retry.
+DEFAULT_BACKOFF_INITIAL = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+
+# The error reasons (see https://cloud.google.com/bigquery/docs/error-messages) worth retrying after a while.
+RETRYABLE_REASONS = {"rateLimitExceeded", "quotaExceeded"}
+
+
+@dataclasses.dataclass()
+class CopyRequest:
+    """A copy job to run.
+
+    Attributes:
+        source_table: The fully qualified name of the table being copied, used to group the jobs by table
+        source_id: The table to copy from, possibly with a point-in-time decorator. e.g: `p.d.foo@1647530381000`
+        destination_id: The fully qualified name of the table to create
+        operation_type: `SNAPSHOT` or `CLONE`
+        project: The project to run the job in
+    """
+    source_table: str
+    source_id: str
+    destination_id: str
+    operation_type: str
+    project: str
+
+
+@dataclasses.dataclass()
+class CopyResult:
+    request: CopyRequest
+    error: Optional[str] = None
+    attempts: int = 1
+    duration: float = 0.0
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Returns True if the error comes from a rate limit or a quota, and the job may succeed later."""
+    if isinstance(error, TooManyRequests):
+        return True
+    errors = getattr(error, "errors", None) or []
+    return any(isinstance(e, dict) and e.get("reason") in RETRYABLE_REASONS for e in errors)
+
+
+def error_message(error: Exception) -> str:
+    return getattr(error, "message", None) or str(error)
+
+
+def backoff_delays(initial_delay: float, max_delay: float) -> Iterator[float]:
+    """Generates the delays before each retry: exponential backoff with full jitter, so that jobs throttled at the same
+    time do not all retry at the same time.
+    """
+    delay = initial_delay
+    while True:
+        yield random.uniform(0, min(delay, max_delay))
+        delay *= 2
+
+
+def run_copy_job(client: bigquery.Client, request: CopyRequest, max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_initial: float = DEFAULT_BACKOFF_INITIAL, backoff_max: float = DEFAULT_BACKOFF_MAX,
+                 sleep: Callable[[float], None] = time.sleep) -> CopyResult:
+    """Runs a copy job and waits for it to complete, retrying it when it hits a rate limit or a quota.
+
+    Returns:
+        The result of the job. Errors are reported in the result, never raised.
+    """
+    started_at = time.monotonic()
+    delays = backoff_delays(backoff_initial, backoff_max)
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            job = client.copy_table(request.source_id, request.destination_id, project=request.project,
+                                    job_config=bigquery.job.CopyJobConfig(operation_type=request.operation_type))
+            job.result()
+            return CopyResult(request, attempts=attempts, duration=time.monotonic() - started_at)
+        except Exception as e:
+            if attempts > max_retries or not is_retryable(e):
+                return CopyResult(request, error=error_message(e), attempts=attempts,
+                                  duration=time.monotonic() - started_at)
+        sleep(next(delays))
+
+
+def run_copy_jobs(client: bigquery.Client, requests: Iterable[CopyRequest],
+                  max_concurrent_jobs: int = DEFAULT_MAX_CONCURRENT_JOBS, max_retries: int = DEFAULT_MAX_RETRIES,
+                  backoff_initial: float = DEFAULT_BACKOFF_INITIAL,
+                  backoff_max: float = DEFAULT_BACKOFF_MAX) -> Iterator[CopyResult]:
+    """Runs copy jobs, at most `max_concurrent_jobs` at a time. Jobs are submitted in the order of `requests`.
+
+    Returns:
+        An iterator over the results, in the order the jobs complete. It must be consumed to the end, as it waits for
+        all the jobs to complete when closed.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrent_jobs) as executor:
+        futures = [executor.submit(run_copy_job, client, request, max_retries, backoff_initial, backoff_max)
+                   for request in requests]
+        for future in as_completed(futures):
+            yield future.result()
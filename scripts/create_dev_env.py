@@ -22,21 +22,48 @@ from __future__ import print_function, unicode_literals
 
 import argparse
 import dataclasses
+import fnmatch
 import json
+import re
 import sys
 from argparse import ArgumentParser, Namespace
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from io import TextIOWrapper
-from typing import List, Optional
+from typing import Iterator, List, Optional, Union
 
 import google
 from google.cloud import bigquery
 
+from scripts.backends import create_client
+from scripts.copy_jobs import DEFAULT_MAX_CONCURRENT_JOBS, DEFAULT_MAX_RETRIES, CopyRequest, CopyResult, run_copy_jobs
+from scripts.translations import compact_translations
+
 # A unified datetime-format to be used across the script. Can be changed.
 DT_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
-# One BigQuery Client to rule them all
-client = bigquery.Client()
+# The maximum number of concurrent requests when fetching the metadata of the source tables.
+DEFAULT_METADATA_WORKERS = 16
+
+# The number of tables to fetch per page when listing the tables of a source dataset.
+DEFAULT_LIST_PAGE_SIZE = 1000
+
+# The types of table that can be snapshot and cloned. Views, materialized views and external tables are skipped.
+COPYABLE_TABLE_TYPES = {"TABLE"}
+
+# The name of the clones created by this script, with the point-in-time they were taken at and the source table name.
+CLONE_NAME_PATTERN = re.compile(r"^clone_(\d{14})_(.+)$")
+
+# One BigQuery Client to rule them all. Created on first use by `get_client`, so that building the parser (e.g. for
+# `--help`) does not go through credential discovery.
+client = None  # type: Optional[bigquery.Client]
+
+
+def get_client() -> bigquery.Client:
+    global client
+    if client is None:
+        client = create_client()
+    return client
 
 
 def timestamp(dt: datetime) -> int:
@@ -52,18 +79,117 @@ def timestamp(dt: datetime) -> int:
     return int((dt - epoch).total_seconds() * 1000.0)
 
 
-def source_tables(astring: str) -> bigquery.Table:
-    try:
-        tbl = client.get_table(astring)
-    except Exception as e:
-        print(e)
-        raise e
-    return tbl
+def fetch_source_tables(table_ids: List[str], max_workers: int = DEFAULT_METADATA_WORKERS) -> List[bigquery.Table]:
+    """Fetches the metadata of the source tables, concurrently.
+
+    Args:
+        table_ids: The source tables, in the BigQuery syntax of dataset and table name separated by dots, with an
+            optional project_id as a prefix
+        max_workers: The maximum number of requests to have in flight at the same time
+
+    Returns:
+        The tables, in the same order as `table_ids`
+
+    Raises:
+        ValueError: if any of the tables could not be fetched. The message lists all of them.
+    """
+    bigquery_client = get_client()
+
+    def get_table(table_id: str):
+        try:
+            return bigquery_client.get_table(table_id)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(get_table, table_ids))
+    errors = [f"{table_id}: {table}" for table_id, table in zip(table_ids, tables) if isinstance(table, Exception)]
+    if errors:
+        raise ValueError("Could not get the source table(s):\n" + "\n".join(errors))
+    return tables
+
+
+def list_source_tables(dataset_ids: List[str], include: List[str], exclude: List[str],
+                       page_size: int = DEFAULT_LIST_PAGE_SIZE,
+                       complete_datasets: Optional[set] = None) -> Iterator[bigquery.table.TableListItem]:
+    """Lists the tables of the source datasets that can be cloned, page by page.
+
+    Args:
+        dataset_ids: The source datasets, with an optional project_id as a prefix
+        include: Glob patterns, a table is selected if its name matches any of them. An empty list selects all tables.
+        exclude: Glob patterns, a table is skipped if its name matches any of them, even if it is included
+        page_size: The number of tables to fetch per request
+        complete_datasets: If given, the datasets whose tables were all selected are added to it, as
+            `project.dataset`, once they have been listed
+
+    Returns:
+        An iterator over the selected tables. Only the table list entries are fetched, not the full table metadata.
+
+    Raises:
+        ValueError: if a dataset could not be listed
+    """
+    bigquery_client = get_client()
+    for dataset_id in dataset_ids:
+        dataset_ref = bigquery.DatasetReference.from_string(dataset_id, bigquery_client.project)
+        complete = True
+        try:
+            for item in bigquery_client.list_tables(dataset_ref, page_size=page_size):
+                if (item.table_type not in COPYABLE_TABLE_TYPES
+                        or include and not any(fnmatch.fnmatchcase(item.table_id, pattern) for pattern in include)
+                        or any(fnmatch.fnmatchcase(item.table_id, pattern) for pattern in exclude)):
+                    complete = False
+                    continue
+                yield item
+        except Exception as e:
+            raise ValueError(f"Could not list the tables of {dataset_id}: {e}") from e
+        if complete and complete_datasets is not None:
+            complete_datasets.add(f"{dataset_ref.project}.{dataset_ref.dataset_id}")
+
+
+def find_existing_clones(dataset: bigquery.DatasetReference) -> dict[str, tuple[str, datetime]]:
+    """Finds the clones previously created in the target dataset.
+
+    Returns:
+        The fully qualified name and the point-in-time of the latest clone of each table, keyed by source table name
+    """
+    clones = {}
+    for item in get_client().list_tables(dataset, page_size=DEFAULT_LIST_PAGE_SIZE):
+        match = CLONE_NAME_PATTERN.match(item.table_id)
+        if not match:
+            continue
+        when = datetime.strptime(match.group(1), "%Y%m%d%H%M%S")
+        table_name = match.group(2)
+        if table_name not in clones or clones[table_name][1] < when:
+            clones[table_name] = (f"{item.project}.{item.dataset_id}.{item.table_id}", when)
+    return clones
+
+
+def find_unchanged_tables(source_tables: List[Union[bigquery.Table, bigquery.table.TableListItem]],
+                          existing_clones: dict[str, tuple[str, datetime]],
+                          max_workers: int = DEFAULT_METADATA_WORKERS) -> dict[str, str]:
+    """Finds the source tables that have not changed since their latest clone was taken: the source table was last
+    modified before the point-in-time of the clone, and both have the same number of rows.
+
+    Returns:
+        The fully qualified name of the clone to reuse, keyed by the fully qualified name of the source table
+    """
+    candidates = [table for table in source_tables if table.table_id in existing_clones]
+    source_ids = [f"{table.project}.{table.dataset_id}.{table.table_id}" for table in candidates]
+    clone_ids = [existing_clones[table.table_id][0] for table in candidates]
+    # Tables listed from a dataset do not have their modification time and number of rows, fetch them all at once.
+    tables = fetch_source_tables(source_ids + clone_ids, max_workers)
+    unchanged = {}
+    for source_id, source, clone in zip(source_ids, tables[:len(candidates)], tables[len(candidates):]):
+        clone_when = existing_clones[source.table_id][1]
+        modified = source.modified.astimezone(timezone.utc).replace(tzinfo=None) if source.modified else None
+        if modified is not None and modified <= clone_when and source.num_rows == clone.num_rows:
+            unchanged[source_id] = f"{clone.project}.{clone.dataset_id}.{clone.table_id}"
+    return unchanged
 
 
 def target_dataset(astring: str) -> bigquery.DatasetReference:
     try:
-        ref = bigquery.DatasetReference.from_string(astring, client.project)
+        ref = bigquery.DatasetReference.from_string(astring, get_client().project)
     except Exception as e:
         print(e)
         raise e
@@ -74,16 +200,41 @@ def datetime_type(astring: str) -> datetime:
     return datetime.strptime(astring, DT_FORMAT)
 
 
+def positive_int(astring: str) -> int:
+    value = int(astring)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{astring} is not a positive number")
+    return value
+
+
+def non_negative_int(astring: str) -> int:
+    value = int(astring)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"{astring} is not a non-negative number")
+    return value
+
+
 def get_parser() -> ArgumentParser:
     parser = ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                             prog="create-dev-env", description="Create DEV environment for BigQuery Data Integration")
-    parser.add_argument("--source-table", required=True, type=source_tables, action='append', dest='source_tables',
+    parser.add_argument("--source-table", action='append', dest='source_tables', default=[],
                         help="Source table(s). List of tables to be cloned into the development environment. "
                              "Use the BigQuery syntax of dataset and table name seperated by dots, "
                              "with optional project_id as a prefix."
                              "Examples: --source-table my_dataset1.table1 "
                              "--source-table different_project.my_dataset2.table2")
-    parser.add_argument("--target-dataset", required=True, type=target_dataset, dest='target_dataset',
+    parser.add_argument("--source-dataset", action='append', dest='source_datasets', default=[],
+                        help="Source dataset(s). All the tables of these datasets are cloned into the development "
+                             "environment, unless filtered with `--include` or `--exclude`. Views and external tables "
+                             "are skipped. Use the BigQuery syntax of dataset name, with optional project_id as a "
+                             "prefix. Can be combined with `--source-table`.")
+    parser.add_argument("--include", action='append', dest='include', default=[],
+                        help="Only clone the tables of the source datasets whose name matches this glob pattern, "
+                             "e.g: `orders_*`. Can be repeated.")
+    parser.add_argument("--exclude", action='append', dest='exclude', default=[],
+                        help="Skip the tables of the source datasets whose name matches this glob pattern, "
+                             "e.g: `*_backup`. Can be repeated, and takes precedence over `--include`.")
+    parser.add_argument("--target-dataset", required=True, dest='target_dataset',
                         help="The target dataset to which to clone the source tables. "
                              "If the `--create-dataset` option is specified, dataset MUST NOT be already exists, "
                              "and it will be created. "
@@ -98,24 +249,125 @@ def get_parser() -> ArgumentParser:
                              f"Specify in the format 'YYYY-mm-ddTHH:MM:SS'")
     parser.add_argument("--translation-file", help="Create a translation JSON file.", required=False,
                         type=argparse.FileType("w", encoding='UTF-8'), dest="translation_file")
+    parser.add_argument("--compact-translations", action='store_true', dest='compact_translations',
+                        help="Write the translation file in its compact form: one rule per table, with the project, "
+                             "and a single `dataset.*` rule for a source dataset whose tables were all cloned.")
+    parser.add_argument("--metadata-workers", type=positive_int, default=DEFAULT_METADATA_WORKERS,
+                        dest='metadata_workers',
+                        help="The maximum number of concurrent requests when fetching the metadata of the source "
+                             "tables.")
+    parser.add_argument("--refresh", action='store_true', dest='refresh',
+                        help="Refresh an existing development environment: the source tables that have not been "
+                             "modified since their latest clone in the target dataset, and have the same number of "
+                             "rows, keep using that clone. Only the other tables are cloned again. The translation "
+                             "file covers all the source tables.")
+    parser.add_argument("--clone-only", action='store_true', dest='clone_only',
+                        help="Only create the clones, without the snapshots.")
+    parser.add_argument("--max-concurrent-jobs", type=positive_int, default=DEFAULT_MAX_CONCURRENT_JOBS,
+                        dest='max_concurrent_jobs',
+                        help="The maximum number of snapshot and clone jobs to run at the same time.")
+    parser.add_argument("--max-retries", type=non_negative_int, default=DEFAULT_MAX_RETRIES, dest='max_retries',
+                        help="The number of times a job is retried, with a jittered exponential backoff, after hitting "
+                             "a rate limit or a quota. 0 to never retry.")
 
     return parser
 
 
 @dataclasses.dataclass()
 class ProgramArguments:
-    source_tables: List[bigquery.Table]
-    target_dataset: bigquery.DatasetReference
+    """The parsed program arguments. Tables and datasets are only given by name on the command line, they are resolved
+    into `source_tables` and `target_dataset` by `resolve`, once parsing has succeeded.
+    """
+    source_table_ids: List[str]
+    source_dataset_ids: List[str]
+    include: List[str]
+    exclude: List[str]
+    target_dataset_id: str
     create_dataset: bool
     when: datetime
     translation_file: Optional[TextIOWrapper]
+    compact_translations: bool
+    metadata_workers: int
+    refresh: bool
+    clone_only: bool
+    max_concurrent_jobs: int
+    max_retries: int
+    source_tables: Optional[List[Union[bigquery.Table, bigquery.table.TableListItem]]] = None
+    target_dataset: Optional[bigquery.DatasetReference] = None
+    complete_datasets: Optional[set] = None
 
     def __init__(self, ns: Namespace):
         self.when = ns.when
-        self.source_tables = ns.source_tables
-        self.target_dataset = ns.target_dataset
+        self.source_table_ids = ns.source_tables
+        self.source_dataset_ids = ns.source_datasets
+        self.include = ns.include
+        self.exclude = ns.exclude
+        self.target_dataset_id = ns.target_dataset
         self.create_dataset = ns.create_dataset
         self.translation_file = ns.translation_file
+        self.compact_translations = ns.compact_translations
+        self.metadata_workers = ns.metadata_workers
+        self.refresh = ns.refresh
+        self.clone_only = ns.clone_only
+        self.max_concurrent_jobs = ns.max_concurrent_jobs
+        self.max_retries = ns.max_retries
+        self.source_tables = None
+        self.target_dataset = None
+        self.complete_datasets = None
+
+    def resolve(self):
+        self.target_dataset = target_dataset(self.target_dataset_id)
+        tables = fetch_source_tables(self.source_table_ids, self.metadata_workers)
+        # The source datasets selected entirely, which a compact translation file covers with a single rule.
+        self.complete_datasets = set()
+        tables.extend(list_source_tables(self.source_dataset_ids, self.include, self.exclude,
+                                         complete_datasets=self.complete_datasets))
+        # A table can be both given explicitly and selected from its dataset, it is only cloned once.
+        unique_tables = {}
+        for table in tables:
+            unique_tables.setdefault(f"{table.project}.{table.dataset_id}.{table.table_id}", table)
+        self.source_tables = list(unique_tables.values())
+
+
+def describe_copy_result(res: CopyResult) -> str:
+    operation = "snapshot" if res.request.operation_type == "SNAPSHOT" else "clone"
+    retries = f", retried {res.attempts - 1} time(s)" if res.attempts > 1 else ""
+    if res.succeeded:
+        return (f"Created {operation} of {res.request.source_table} as {res.request.destination_id} "
+                f"({res.duration:.1f}s{retries})")
+    return f"Failed to create {operation} of {res.request.source_table}{retries}: {res.error}"
+
+
+def r_pad(s: str, str_len: int, char: str = " ") -> str:
+    base_len = len(s)
+    spaces = char * max(str_len - base_len, 0)
+    return s + spaces
+
+
+def print_copy_summary(table_names: List[str], results: dict[str, dict[str, CopyResult]],
+                       reused: Optional[dict[str, str]] = None):
+    """Prints the outcome of the snapshot and clone of every table, in the order the tables were given. Tables whose
+    clone is `reused` are listed with the name of that clone.
+    """
+    reused = reused or {}
+    max_table_name = max([len('Table')] + [len(table_name) for table_name in table_names])
+    column_width = len('Snapshot')
+    print()
+    print(f"{r_pad('Table', max_table_name)} | {r_pad('Snapshot', column_width)} | {r_pad('Clone', column_width)} | "
+          f"Details")
+    print(f"{r_pad('', max_table_name, '-')}-+-{r_pad('', column_width, '-')}-+-{r_pad('', column_width, '-')}-+-"
+          f"------------------------")
+    for table_name in table_names:
+        if table_name in reused:
+            print(f"{r_pad(table_name, max_table_name)} | {r_pad('-', column_width)} | "
+                  f"{r_pad('REUSED', column_width)} | {reused[table_name]}")
+            continue
+        table_results = results.get(table_name, {})
+        statuses = [("OK" if res.succeeded else "FAILED") if res else "-"
+                    for res in (table_results.get("SNAPSHOT"), table_results.get("CLONE"))]
+        errors = "; ".join(res.error for res in table_results.values() if not res.succeeded)
+        print(f"{r_pad(table_name, max_table_name)} | {r_pad(statuses[0], column_width)} | "
+              f"{r_pad(statuses[1], column_width)} | {errors}")
 
 
 def main():
@@ -123,6 +375,26 @@ def main():
     parser = get_parser()
     args = parser.parse_args(sys.argv[1:])
     args = ProgramArguments(args)
+    if not args.source_table_ids and not args.source_dataset_ids:
+        parser.error("At least one of `--source-table` or `--source-dataset` is required.")
+        return
+    if (args.include or args.exclude) and not args.source_dataset_ids:
+        parser.error("`--include` and `--exclude` select tables from the `--source-dataset` datasets, "
+                     "which are missing.")
+        return
+    if args.refresh and args.create_dataset:
+        parser.error("`--refresh` updates the clones of an existing dataset, it cannot be used with "
+                     "`--create-dataset`.")
+        return
+    try:
+        args.resolve()
+    except ValueError as e:
+        parser.error(str(e))
+        return
+    if not args.source_tables:
+        parser.error("No table to clone, all the tables of the source dataset(s) were filtered out.")
+        return
+    client = get_client()
 
     if args.create_dataset:
         try:
@@ -139,41 +411,66 @@ def main():
                          f"name, or add the `--create-dataset` flag to create it.")
             return
 
-    jobs = []
+    reused = {}  # type: dict[str, str]
+    if args.refresh:
+        try:
+            reused = find_unchanged_tables(args.source_tables, find_existing_clones(target_dataset),
+                                           args.metadata_workers)
+        except ValueError as e:
+            parser.error(str(e))
+            return
+        print(f"{len(reused)} of {len(args.source_tables)} table(s) unchanged since their latest clone")
+
     dt_short = args.when.strftime("%Y%m%d%H%M%S")
     ts = timestamp(args.when)
-    translations = {}
+    requests = []
+    translations = {}  # type: dict[str, dict[str, str]]
     for table in args.source_tables:
         # for each table, run 2 copy jobs, one is a snapshot, and one a clone.
         # Both tables will be copied using the same timestamp
-        source_id = f"{table.project}.{table.dataset_id}.{table.table_id}@{ts}"
+        table_name = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        source_id = f"{table_name}@{ts}"
         snapshot_id = f"{target_dataset.project}.{target_dataset.dataset_id}.snap_{dt_short}_{table.table_id}"
-        clone_id = f"{target_dataset.project}.{target_dataset.dataset_id}.clone_{dt_short}_{table.table_id}"
-        translations[f"{table.dataset_id}.{table.table_id}"] = clone_id
-        translations[f"{table.project}.{table.dataset_id}.{table.table_id}"] = clone_id
-        # the call to `client.copy_table` is asynchronous, which means we can just continue, and wait for all to
-        # complete at the end.
-        print(
-            f"Creating snapshot for {table.project}.{table.dataset_id}.{table.table_id} as {snapshot_id}"
-        )
-        jobs.append(
-            client.copy_table(
-                source_id,
-                snapshot_id,
-                project=table.project,
-                job_config=bigquery.job.CopyJobConfig(operation_type="SNAPSHOT")))
-        print(
-            f"Creating clone for {table.project}.{table.dataset_id}.{table.table_id} as {clone_id}"
-        )
-        jobs.append(
-            client.copy_table(
-                source_id,
-                clone_id,
-                project=table.project,
-                job_config=bigquery.job.CopyJobConfig(operation_type="CLONE")))
-    # wait for all job results
-    [job.result() for job in jobs]
-    print("All tables created")
+        clone_id = reused.get(table_name,
+                              f"{target_dataset.project}.{target_dataset.dataset_id}.clone_{dt_short}_{table.table_id}")
+        translations[table_name] = {
+            f"{table.dataset_id}.{table.table_id}": clone_id,
+            table_name: clone_id,
+        }
+        if table_name in reused:
+            continue
+        if not args.clone_only:
+            requests.append(CopyRequest(table_name, source_id, snapshot_id, "SNAPSHOT", table.project))
+        requests.append(CopyRequest(table_name, source_id, clone_id, "CLONE", table.project))
+
+    copies = "a clone" if args.clone_only else "a snapshot and a clone"
+    print(f"Creating {copies} of {len(translations) - len(reused)} table(s), "
+          f"{args.max_concurrent_jobs} copy job(s) at a time")
+    results = {}  # type: dict[str, dict[str, CopyResult]]
+    for done, res in enumerate(run_copy_jobs(client, requests, args.max_concurrent_jobs, args.max_retries), start=1):
+        results.setdefault(res.request.source_table, {})[res.request.operation_type] = res
+        print(f"[{done}/{len(requests)}] {describe_copy_result(res)}")
+    print_copy_summary(list(translations), results, reused)
+
+    succeeded = [table_name for table_name in translations
+                 if table_name in reused or all(res.succeeded for res in results[table_name].values())]
+    if len(succeeded) == len(translations):
+        print("All tables created")
+    else:
+        print(f"{len(succeeded)} of {len(translations)} table(s) created")
     if args.translation_file:
-        json.dump(translations, args.translation_file, indent=2)
+        # Only the tables whose copies were all created (or reused), so the file can be used as is.
+        if args.compact_translations:
+            # A dataset rule would also redirect the tables that failed, those datasets keep one rule per table.
+            failed_datasets = {table_name.rsplit(".", 1)[0] for table_name in translations
+                               if table_name not in succeeded}
+            json.dump(compact_translations({table_name: translations[table_name][table_name]
+                                            for table_name in succeeded},
+                                           args.complete_datasets - failed_datasets),
+                      args.translation_file, indent=2)
+        else:
+            json.dump({key: value for table_name in succeeded for key, value in translations[table_name].items()},
+                      args.translation_file, indent=2)
         args.translation_file.close()
+    if len(succeeded) < len(translations):
+        sys.exit(1)
@@ -23,13 +23,18 @@ from __future__ import print_function, unicode_literals
 import json
 import re
 import sys
+from argparse import ArgumentParser, ArgumentTypeError
 from datetime import datetime
-from typing import Union
+from typing import Any, Callable, Iterator, Optional, Union
 
 from InquirerPy import inquirer
 from InquirerPy.base import Choice
 from google.cloud import bigquery
 
+from scripts.backends import create_client
+from scripts.metadata_cache import (DEFAULT_METADATA_CACHE_FILE, DEFAULT_TTL, Listing, MetadataCache, datasets_key,
+                                    open_listing, projects_key, tables_key)
+
 # A unified datetime-format to be used across the script. Can be changed.
 DT_FORMAT = "%Y-%m-%d %H:%M:%S"
 
@@ -37,8 +42,21 @@ DT_FORMAT = "%Y-%m-%d %H:%M:%S"
 # dataset.
 dataset_name_pattern = re.compile("^[a-zA-Z_]{1,1024}$")
 
-# One BigQuery Client to rule them all
-client = bigquery.Client()
+# The number of projects, datasets or tables to show before offering to load more.
+DEFAULT_PAGE_SIZE = 500
+
+# The value of the choice that shows more items of a listing.
+LOAD_MORE = "--- LOAD MORE ---"
+
+# One BigQuery Client to rule them all. Created on first use by `get_client`.
+client = None  # type: Optional[bigquery.Client]
+
+
+def get_client() -> bigquery.Client:
+    global client
+    if client is None:
+        client = create_client()
+    return client
 
 
 def timestamp(dt: datetime) -> int:
@@ -108,54 +126,155 @@ def validate_dataset_name(dataset_name: str) -> bool:
     return match is not None
 
 
+def positive_int(astring: str) -> int:
+    value = int(astring)
+    if value < 1:
+        raise ArgumentTypeError(f"{astring} is not a positive number")
+    return value
+
+
+def non_negative_float(astring: str) -> float:
+    value = float(astring)
+    if not value >= 0:
+        raise ArgumentTypeError(f"{astring} is not a non-negative number")
+    return value
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog="create-dev-env-interactive",
+                            description="Create DEV environment for BigQuery Data Integration, interactively")
+    parser.add_argument("--metadata-cache-file", default=DEFAULT_METADATA_CACHE_FILE, dest='metadata_cache_file',
+                        help="The file where the lists of projects, datasets and tables are cached.")
+    parser.add_argument("--metadata-ttl", type=non_negative_float, default=DEFAULT_TTL, dest='metadata_ttl',
+                        help="The number of seconds after which a cached list is refreshed. Older lists are still "
+                             "shown right away, and refreshed in the background for the next time. 0 to refresh "
+                             "every list in the background on every run.")
+    parser.add_argument("--refresh-metadata", action='store_true', dest='refresh_metadata',
+                        help="Clear the cached lists of projects, datasets and tables, and fetch them again.")
+    parser.add_argument("--page-size", type=positive_int, default=DEFAULT_PAGE_SIZE, dest='page_size',
+                        help="The number of projects, datasets or tables to show before offering to load more.")
+    return parser
+
+
+def resource_pages(iterator) -> Iterator[list[dict]]:
+    """Returns the pages of a paged API iterator as lists of API resources, as expected by `open_listing`."""
+    for page in iterator.pages:
+        yield [item._properties for item in page]
+
+
+def list_project_pages():
+    # `Project` does not keep its API resource, rebuild the part of it that `Project.from_api_repr` reads.
+    for page in get_client().list_projects().pages:
+        yield [{"id": p.project_id, "numericId": p.numeric_id, "friendlyName": p.friendly_name} for p in page]
+
+
+def select_from_listing(listing: Listing, page_size: int, make_choice: Callable[[dict], Choice],
+                        prompt: Callable[[list], Any], multiselect: bool = False,
+                        extra_choices: Optional[list] = None) -> Any:
+    """Prompts the user to select among the items of a listing. Only the items fetched so far are shown, with a choice
+    to load more while the listing is not complete. Selected items are kept selected when more are loaded.
+
+    Args:
+        listing: The items to choose from
+        page_size: The number of items to wait for before showing the prompt, and to add on every load
+        make_choice: Creates the choice of an item
+        prompt: Shows a prompt with the given choices, and returns the answer
+        multiselect: Whether `prompt` lets the user select several choices
+        extra_choices: Choices to show after the items
+
+    Returns:
+        The answer of the last prompt
+    """
+    count = page_size
+    selected_names = set()
+    while True:
+        items = listing.wait_for(count)
+        choices = []
+        for item in items:
+            choice = make_choice(item)
+            choice.enabled = choice.name in selected_names
+            choices.append(choice)
+        if not listing.done:
+            choices.append(Choice(value=LOAD_MORE, name=f"--- LOAD MORE ({len(items)} loaded so far) ---"))
+        answer = prompt(choices + (extra_choices or []))
+        selected = answer if multiselect else [answer]
+        if LOAD_MORE not in selected:
+            return answer
+        selected_names = {choice.name for choice in choices if choice.value in selected and choice.value != LOAD_MORE}
+        count = len(items) + page_size
+
+
 def main():
+    parser = get_parser()
+    args = parser.parse_args(sys.argv[1:])
+    cache = MetadataCache(args.metadata_cache_file)
+    if args.refresh_metadata:
+        cache.invalidate()
+
     # Get all projects
-    projects = list(client.list_projects())  # type: list[bigquery.client.Project]
-    source_project = inquirer.fuzzy(
-        message="Select a source project (up and down keys to move, enter to select)",
-        choices=[Choice(value=p, name=p.friendly_name) for p in projects],
-        default=None,
-        mandatory=True,
-        mandatory_message="(Required)",
-    ).execute()  # type: bigquery.client.Project
-
-    datasets = {
-        d.dataset_id: d
-        for d in client.list_datasets(project=source_project.project_id)
-    }  # type: dict[str, bigquery.client.Dataset]
-    source_dataset = inquirer.select(
-        message="Select a source dataset (up and down keys to move, enter to select)",
-        choices=[
-            Choice(value=dataset, name=dataset.dataset_id)
-            for dataset in datasets.values()
-        ],
-        default=None,
-        mandatory=True,
-        mandatory_message="(Required)",
-    ).execute()  # type: bigquery.client.Dataset
-
-    tables = {t.table_id: t for t in client.list_tables(dataset=source_dataset)}
-    source_tables = inquirer.select(
-        message="Select a source tables (Space to (de)select, up and down arrows to move):",
-        choices=[
-            Choice(value=table, name=table.table_id) for table in tables.values()
-        ],
-        default=None,
-        mandatory=True,
-        mandatory_message="(Required)",
-        multiselect=True,
-        validate=lambda res: len(res) > 0,
-        invalid_message="Minimum 1 table.",
-    ).execute()  # type: list[bigquery.client.Table]
-
-    target_dataset = inquirer.select(
-        message="Select a target dataset (Select one or choose create new):",
-        choices=[
-                    Choice(value=dataset, name=dataset.dataset_id)
-                    for dataset in datasets.values()
-                ] + [Choice(value=None, name="--- CREATE NEW ---")],
-        default=None,
-    ).execute()  # type: bigquery.client.Dataset
+    projects = open_listing(cache, projects_key(), list_project_pages, args.metadata_ttl)
+    source_project = select_from_listing(
+        projects, args.page_size,
+        lambda resource: Choice(value=bigquery.client.Project.from_api_repr(resource), name=resource["friendlyName"]),
+        lambda choices: inquirer.fuzzy(
+            message="Select a source project (up and down keys to move, enter to select)",
+            choices=choices,
+            default=None,
+            mandatory=True,
+            mandatory_message="(Required)",
+        ).execute())  # type: bigquery.client.Project
+
+    datasets = open_listing(
+        cache, datasets_key(source_project.project_id),
+        lambda: resource_pages(get_client().list_datasets(project=source_project.project_id,
+                                                          page_size=args.page_size)),
+        args.metadata_ttl)
+
+    def dataset_choice(resource: dict) -> Choice:
+        dataset = bigquery.dataset.DatasetListItem(resource)
+        return Choice(value=dataset, name=dataset.dataset_id)
+
+    source_dataset = select_from_listing(
+        datasets, args.page_size, dataset_choice,
+        lambda choices: inquirer.select(
+            message="Select a source dataset (up and down keys to move, enter to select)",
+            choices=choices,
+            default=None,
+            mandatory=True,
+            mandatory_message="(Required)",
+        ).execute())  # type: bigquery.dataset.DatasetListItem
+
+    tables = open_listing(
+        cache, tables_key(source_dataset.project, source_dataset.dataset_id),
+        lambda: resource_pages(get_client().list_tables(dataset=source_dataset.reference, page_size=args.page_size)),
+        args.metadata_ttl)
+
+    def table_choice(resource: dict) -> Choice:
+        table = bigquery.table.TableListItem(resource)
+        return Choice(value=table, name=table.table_id)
+
+    source_tables = select_from_listing(
+        tables, args.page_size, table_choice,
+        lambda choices: inquirer.fuzzy(
+            message="Select a source tables (Type to search, Tab to (de)select, up and down arrows to move):",
+            choices=choices,
+            default=None,
+            mandatory=True,
+            mandatory_message="(Required)",
+            multiselect=True,
+            validate=lambda res: len(res) > 0,
+            invalid_message="Minimum 1 table.",
+        ).execute(),
+        multiselect=True)  # type: list[bigquery.table.TableListItem]
+
+    target_dataset = select_from_listing(
+        datasets, args.page_size, dataset_choice,
+        lambda choices: inquirer.select(
+            message="Select a target dataset (Select one or choose create new):",
+            choices=choices,
+            default=None,
+        ).execute(),
+        extra_choices=[Choice(value=None, name="--- CREATE NEW ---")])  # type: bigquery.dataset.DatasetListItem
     target_dataset_name = None
     if not target_dataset:
         target_dataset_name = inquirer.text(
@@ -191,9 +310,12 @@ def main():
         target_dataset = bigquery.Dataset(
             f"{source_dataset.project}.{target_dataset_name}")
         target_dataset.location = source_dataset._properties["location"]
-        target_dataset = client.create_dataset(target_dataset, timeout=30)
+        target_dataset = get_client().create_dataset(target_dataset, timeout=30)
+        # The new dataset is missing from the cached list of datasets of the project.
+        cache.invalidate(datasets_key(source_dataset.project))
     assert target_dataset is not None and target_dataset.dataset_id is not None
 
+    client = get_client()
     jobs = []
     project = source_dataset.project
     source_dataset_id = source_dataset.dataset_id
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Shows what changed in the clones of a development environment, compared with the snapshots `create-dev-env` took
+# at the same point-in-time. The comparison runs inside BigQuery: the rows of each partition are counted and
+# fingerprinted, and only the rows of the partitions whose fingerprints differ are read.
+
+import dataclasses
+import json
+import re
+import sys
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Optional
+
+from google.api_core.exceptions import BadRequest, NotFound
+from google.cloud import bigquery
+
+from scripts.backends import create_client, default_project
+from scripts.translations import WILDCARD
+
+# The maximum number of table pairs to compare at the same time.
+DEFAULT_MAX_CONCURRENT_QUERIES = 8
+
+# The maximum number of rows that differ to show per table.
+DEFAULT_MAX_ROWS = 10
+
+# The partition id of the rows whose partitioning column is NULL, and of all the rows of a table without partitions.
+NULL_PARTITION = "__NULL__"
+UNPARTITIONED = "__UNPARTITIONED__"
+
+# The format of the partition ids of BigQuery, for each granularity of time partitioning.
+PARTITION_ID_FORMATS = {"HOUR": "%Y%m%d%H", "DAY": "%Y%m%d", "MONTH": "%Y%m", "YEAR": "%Y"}
+
+# The name of the clones created by `create-dev-env`: `clone_<DATETIME>_<SOURCE_TABLE_NAME>`.
+CLONE_NAME_PATTERN = re.compile(r"^clone_(\d{14})_(.+)$")
+
+
+@dataclasses.dataclass()
+class TablePair:
+    source_table: str
+    snapshot_id: str
+    clone_id: str
+
+
+@dataclasses.dataclass()
+class Partitioning:
+    """How the rows of a table are partitioned: by time (`granularity` is set) or by integer range (`range_start` and
+    `range_interval` are set). `column` is `_PARTITIONTIME` for ingestion-time partitioning.
+    """
+    column: str
+    column_type: str
+    granularity: Optional[str] = None
+    range_start: Optional[int] = None
+    range_interval: Optional[int] = None
+
+    @property
+    def quoted_column(self) -> str:
+        # The pseudo-column of ingestion-time partitioning is not a real column, so it is not quoted.
+        return self.column if self.column.startswith("_PARTITION") else f"`{self.column}`"
+
+    def partition_id(self) -> str:
+        """Returns the SQL expression of the partition id of a row, in the same form as BigQuery, e.g: `20220317`."""
+        column = self.quoted_column
+        if self.granularity is None:
+            expression = (f"CAST({self.range_start} + {self.range_interval} * "
+                          f"CAST(FLOOR(({column} - {self.range_start}) / {self.range_interval}) AS INT64) AS STRING)")
+        elif self.column_type == "TIMESTAMP":
+            expression = f"FORMAT_TIMESTAMP('{PARTITION_ID_FORMATS[self.granularity]}', {column}, 'UTC')"
+        else:
+            expression = f"FORMAT_{self.column_type}('{PARTITION_ID_FORMATS[self.granularity]}', {column})"
+        return f"IFNULL({expression}, '{NULL_PARTITION}')"
+
+    def partition_filter(self, partition_ids: list[str]) -> str:
+        """Returns a SQL condition selecting the rows of the given partitions. The partitioning column is compared with
+        constants, so that BigQuery only reads those partitions.
+        """
+        column = self.quoted_column
+        conditions = []
+        for partition_id in partition_ids:
+            if partition_id == NULL_PARTITION:
+                conditions.append(f"{column} IS NULL")
+            elif self.granularity is None:
+                lower = int(partition_id)
+                conditions.append(f"({column} >= {lower} AND {column} < {lower + self.range_interval})")
+            else:
+                lower = datetime.strptime(partition_id, PARTITION_ID_FORMATS[self.granularity])
+                conditions.append(f"({column} >= {self.literal(lower)} AND "
+                                  f"{column} < {self.literal(next_partition(lower, self.granularity))})")
+        return "(" + " OR ".join(conditions) + ")"
+
+    def literal(self, value: datetime) -> str:
+        if self.column_type == "DATE":
+            return f"DATE '{value:%Y-%m-%d}'"
+        if self.column_type == "DATETIME":
+            return f"DATETIME '{value:%Y-%m-%d %H:%M:%S}'"
+        return f"TIMESTAMP '{value:%Y-%m-%d %H:%M:%S}+00'"
+
+
+def next_partition(lower: datetime, granularity: str) -> datetime:
+    if granularity == "HOUR":
+        return lower + timedelta(hours=1)
+    if granularity == "DAY":
+        return lower + timedelta(days=1)
+    if granularity == "MONTH":
+        return lower.replace(year=lower.year + lower.month // 12, month=lower.month % 12 + 1)
+    return lower.replace(year=lower.year + 1)
+
+
+def get_partitioning(table: bigquery.Table) -> Optional[Partitioning]:
+    column_types = {field.name: field.field_type for field in table.schema}
+    if table.time_partitioning is not None:
+        column = table.time_partitioning.field or "_PARTITIONTIME"
+        return Partitioning(column=column, column_type=column_types.get(column, "TIMESTAMP"),
+                            granularity=table.time_partitioning.type_ or "DAY")
+    if table.range_partitioning is not None:
+        column = table.range_partitioning.field
+        return Partitioning(column=column, column_type=column_types.get(column, "INTEGER"),
+                            range_start=table.range_partitioning.range_.start,
+                            range_interval=table.range_partitioning.range_.interval)
+    return None
+
+
+def row_json(table: bigquery.Table) -> str:
+    """Returns the SQL expression of a row as JSON. Columns are sorted by name, so that reordering the columns of a
+    table does not change its rows.
+    """
+    columns = sorted(field.name for field in table.schema)
+    return "TO_JSON_STRING(STRUCT(" + ", ".join(f"`{column}`" for column in columns) + "))"
+
+
+def fingerprint_query(pair: TablePair, snapshot: bigquery.Table, clone: bigquery.Table,
+                      partitioning: Optional[Partitioning]) -> str:
+    """Returns the query counting and fingerprinting the rows of every partition of both tables, in a single job.
+
+    The fingerprint of a partition is the XOR and the sum of the fingerprints of its rows, so it does not depend on the
+    order of the rows. The XOR alone would not see a row that is duplicated twice (or two duplicates that are removed),
+    as identical rows cancel each other out, while the sum counts every copy of a row. Together with the number of rows,
+    the fingerprint changes as soon as a row is added, removed or updated.
+    """
+    partition_id = partitioning.partition_id() if partitioning else f"'{UNPARTITIONED}'"
+    return "\nUNION ALL\n".join(
+        f"SELECT '{side}' AS side, {partition_id} AS partition_id, COUNT(*) AS row_count, "
+        f"BIT_XOR(FARM_FINGERPRINT({row_json(table)})) AS fingerprint_xor, "
+        # The sum of up to 2^63 fingerprints of 64 bits fits in a BIGNUMERIC, where an INT64 sum would overflow.
+        f"SUM(CAST(FARM_FINGERPRINT({row_json(table)}) AS BIGNUMERIC)) AS fingerprint_sum\n"
+        f"FROM `{table_id}`\n"
+        f"GROUP BY partition_id"
+        for side, table_id, table in [("snapshot", pair.snapshot_id, snapshot), ("clone", pair.clone_id, clone)])
+
+
+def rows_query(pair: TablePair, snapshot: bigquery.Table, clone: bigquery.Table, partitioning: Optional[Partitioning],
+               partition_ids: list[str], max_rows: int) -> str:
+    """Returns the query of up to `max_rows` rows of the given partitions that do not appear the same number of times
+    in both tables, with the number of times they appear in the snapshot and in the clone. A row that was only
+    duplicated, or one of whose duplicates was removed, is found as well as a row that was added or removed.
+    """
+    partition_id = partitioning.partition_id() if partitioning else f"'{UNPARTITIONED}'"
+    partition_filter = partitioning.partition_filter(partition_ids) if partitioning else "TRUE"
+    return (f"WITH snapshot_rows AS (\n"
+            f"  SELECT {partition_id} AS partition_id, {row_json(snapshot)} AS row_json, COUNT(*) AS copies\n"
+            f"  FROM `{pair.snapshot_id}` WHERE {partition_filter}\n"
+            f"  GROUP BY partition_id, row_json\n"
+            f"), clone_rows AS (\n"
+            f"  SELECT {partition_id} AS partition_id, {row_json(clone)} AS row_json, COUNT(*) AS copies\n"
+            f"  FROM `{pair.clone_id}` WHERE {partition_filter}\n"
+            f"  GROUP BY partition_id, row_json\n"
+            f")\n"
+            f"SELECT IFNULL(snapshot_rows.partition_id, clone_rows.partition_id) AS partition_id,\n"
+            f"  IFNULL(snapshot_rows.row_json, clone_rows.row_json) AS row_json,\n"
+            f"  IFNULL(snapshot_rows.copies, 0) AS snapshot_copies, IFNULL(clone_rows.copies, 0) AS clone_copies\n"
+            f"FROM snapshot_rows FULL OUTER JOIN clone_rows\n"
+            f"ON snapshot_rows.partition_id = clone_rows.partition_id\n"
+            f"AND snapshot_rows.row_json = clone_rows.row_json\n"
+            f"WHERE IFNULL(snapshot_rows.copies, 0) != IFNULL(clone_rows.copies, 0)\n"
+            f"ORDER BY partition_id, row_json\n"
+            f"LIMIT {max_rows}")
+
+
+@dataclasses.dataclass()
+class PartitionDiff:
+    """A partition whose rows differ. The number of rows is None on the side where the partition does not exist."""
+    partition_id: str
+    snapshot_rows: Optional[int]
+    clone_rows: Optional[int]
+
+
+@dataclasses.dataclass()
+class TableDiff:
+    pair: TablePair
+    error: Optional[str] = None
+    partitions: int = 0
+    snapshot_rows: int = 0
+    clone_rows: int = 0
+    differing: list[PartitionDiff] = dataclasses.field(default_factory=list)
+    # The partition id, the JSON, and the number of copies in the snapshot and in the clone, of a sample of the rows
+    # that differ
+    rows: list[tuple[str, str, int, int]] = dataclasses.field(default_factory=list)
+    bytes_processed: int = 0
+
+    @property
+    def identical(self) -> bool:
+        return self.error is None and not self.differing
+
+
+def find_table_pairs(translations: dict[str, str], bigquery_client: bigquery.Client) -> list[TablePair]:
+    """Finds the clones of the translation file, and their snapshots. Prefix rules (e.g. `dataset1.*`) are expanded
+    by listing the tables of the target dataset. Targets that are not clones created by `create-dev-env` are skipped.
+    """
+    sources = {}  # type: dict[str, str]
+    for key, value in translations.items():
+        if not key.endswith(WILDCARD):
+            clone_ids = {value: key}
+        else:
+            dataset_id, table_prefix = value.rsplit(".", 1)
+            dataset = bigquery.DatasetReference.from_string(dataset_id, bigquery_client.project)
+            table_prefix = table_prefix.rstrip(WILDCARD)
+            clone_ids = {f"{dataset.project}.{dataset.dataset_id}.{item.table_id}":
+                         key[:-len(WILDCARD)] + item.table_id[len(table_prefix):]
+                         for item in bigquery_client.list_tables(dataset) if item.table_id.startswith(table_prefix)}
+        for clone_id, source_table in clone_ids.items():
+            # A table has a key with and without its project in the full form of the translation file, the longest
+            # name is shown.
+            if len(source_table) > len(sources.get(clone_id, "")):
+                sources[clone_id] = source_table
+    pairs = []
+    for clone_id, source_table in sources.items():
+        dataset_id, table_id = clone_id.rsplit(".", 1)
+        # The snapshot of a clone is named the same way, with a `snap_` prefix instead of `clone_`.
+        if CLONE_NAME_PATTERN.match(table_id):
+            pairs.append(TablePair(source_table=source_table,
+                                   snapshot_id=f"{dataset_id}.snap_{table_id[len('clone_'):]}", clone_id=clone_id))
+    return pairs
+
+
+def run_query(bigquery_client: bigquery.Client, query: str, diff: TableDiff) -> list:
+    job = bigquery_client.query(query)
+    rows = list(job.result())
+    diff.bytes_processed += job.total_bytes_processed or 0
+    return rows
+
+
+def diff_tables(bigquery_client: bigquery.Client, pair: TablePair, max_rows: int) -> TableDiff:
+    """Compares a clone with its snapshot: one query fingerprints the partitions of both tables, and a second one, only
+    if some partitions differ, reads a sample of the rows that differ in those partitions.
+    """
+    diff = TableDiff(pair=pair)
+    try:
+        snapshot = bigquery_client.get_table(pair.snapshot_id)
+    except NotFound:
+        diff.error = f"No snapshot {pair.snapshot_id}, was the clone created with `--clone-only`?"
+        return diff
+    try:
+        clone = bigquery_client.get_table(pair.clone_id)
+        partitioning = get_partitioning(snapshot)
+        fingerprints = {}  # type: dict[tuple[str, str], tuple[int, tuple]]
+        for side, partition_id, row_count, fingerprint_xor, fingerprint_sum in run_query(
+                bigquery_client, fingerprint_query(pair, snapshot, clone, partitioning), diff):
+            fingerprints[(side, partition_id)] = (row_count, (fingerprint_xor, fingerprint_sum))
+        partition_ids = sorted({partition_id for _, partition_id in fingerprints})
+        diff.partitions = len(partition_ids)
+        diff.snapshot_rows = sum(row_count for (side, _), (row_count, _) in fingerprints.items() if side == "snapshot")
+        diff.clone_rows = sum(row_count for (side, _), (row_count, _) in fingerprints.items() if side == "clone")
+        for partition_id in partition_ids:
+            snapshot_partition = fingerprints.get(("snapshot", partition_id))
+            clone_partition = fingerprints.get(("clone", partition_id))
+            if snapshot_partition != clone_partition:
+                diff.differing.append(PartitionDiff(partition_id, snapshot_partition and snapshot_partition[0],
+                                                    clone_partition and clone_partition[0]))
+        if diff.differing and max_rows:
+            diff.rows = [tuple(row) for row in run_query(
+                bigquery_client, rows_query(pair, snapshot, clone, partitioning,
+                                            [partition.partition_id for partition in diff.differing], max_rows), diff)]
+    except BadRequest as br:
+        diff.error = br.errors[0]['message'] if br.errors else str(br)
+    except Exception as e:
+        diff.error = str(e)
+    return diff
+
+
+def positive_int(astring: str) -> int:
+    value = int(astring)
+    if value < 1:
+        raise ArgumentTypeError(f"{astring} is not a positive number")
+    return value
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog="diff-dev-env",
+                            description="Show the rows that changed in the clones of a development environment, "
+                                        "compared with their snapshots.")
+    parser.add_argument("--translation-file", required=True, dest="translation_file",
+                        help="The JSON translation file written by `create-dev-env`.")
+    parser.add_argument("--project", required=False,
+                        help="The project to run the queries in. Value must be set if not using a service account.")
+    parser.add_argument("--max-concurrent-queries", type=positive_int, default=DEFAULT_MAX_CONCURRENT_QUERIES,
+                        dest="max_concurrent_queries",
+                        help="The maximum number of tables to compare at the same time.")
+    parser.add_argument("--max-rows", type=int, default=DEFAULT_MAX_ROWS, dest="max_rows",
+                        help="The maximum number of rows that differ (added, removed, or with a different number of "
+                             "copies) to show per table. 0 to only compare the partitions, without reading any row.")
+    return parser
+
+
+@dataclasses.dataclass()
+class ProgramArguments:
+    translation_file: str
+    project: Optional[str]
+    max_concurrent_queries: int
+    max_rows: int
+
+    def __init__(self, ns: Namespace):
+        self.translation_file = ns.translation_file
+        self.project = ns.project
+        self.max_concurrent_queries = ns.max_concurrent_queries
+        self.max_rows = ns.max_rows
+
+
+def read_json_as_dict(translation_file: str) -> dict[str, str]:
+    with open(translation_file, 'r') as fp:
+        return json.load(fp)
+
+
+def r_pad(s: str, str_len: int, char: str = " ") -> str:
+    base_len = len(s)
+    spaces = char * max(str_len - base_len, 0)
+    return s + spaces
+
+
+def format_bytes(num_bytes: int) -> str:
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.2f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.2f} PB"
+
+
+def describe_diff(diff: TableDiff) -> str:
+    if diff.error is not None:
+        return f"ERROR: {diff.error}"
+    if not diff.differing:
+        return "identical"
+    return f"{len(diff.differing)} of {diff.partitions} partition(s) differ"
+
+
+def print_diff_summary(diffs: list[TableDiff]):
+    max_table_name = max([len('Table')] + [len(diff.pair.source_table) for diff in diffs])
+    column_width = 15
+    print()
+    print(f"{r_pad('Table', max_table_name)} | {r_pad('Snapshot rows', column_width)} | "
+          f"{r_pad('Clone rows', column_width)} | {r_pad('Bytes processed', column_width)} | Result")
+    print(f"{r_pad('', max_table_name, '-')}-+-{'-' * column_width}-+-{'-' * column_width}-+-{'-' * column_width}-+-"
+          f"------------------------")
+    for diff in diffs:
+        print(f"{r_pad(diff.pair.source_table, max_table_name)} | {r_pad(str(diff.snapshot_rows), column_width)} | "
+              f"{r_pad(str(diff.clone_rows), column_width)} | "
+              f"{r_pad(format_bytes(diff.bytes_processed), column_width)} | {describe_diff(diff)}")
+
+
+def print_diff_details(diff: TableDiff):
+    print()
+    print(f"{diff.pair.source_table}: {diff.pair.snapshot_id} -> {diff.pair.clone_id}")
+    for partition in diff.differing:
+        snapshot_rows = "missing" if partition.snapshot_rows is None else f"{partition.snapshot_rows} rows"
+        clone_rows = "missing" if partition.clone_rows is None else f"{partition.clone_rows} rows"
+        print(f"  partition {partition.partition_id}: {snapshot_rows} -> {clone_rows}")
+    for partition_id, row, snapshot_copies, clone_copies in diff.rows:
+        print(f"  {clone_copies - snapshot_copies:+d} [{partition_id}] {row} ({snapshot_copies} -> {clone_copies} "
+              f"copies)")
+
+
+def main():
+    parser = get_parser()
+    args = ProgramArguments(parser.parse_args(sys.argv[1:]))
+    if not args.project:
+        args.project = default_project()
+        if not args.project:
+            parser.error("Could not infer project from environment. "
+                         "You must supply project_id using the `--project` parameter.")
+            return
+    bigquery_client = create_client(args.project)
+    pairs = find_table_pairs(read_json_as_dict(args.translation_file), bigquery_client)
+    if not pairs:
+        parser.error(f"No clone created by `create-dev-env` was found in {args.translation_file}.")
+        return
+
+    print(f"Comparing {len(pairs)} clone(s) with their snapshot, {args.max_concurrent_queries} at a time")
+    diffs = {}  # type: dict[str, TableDiff]
+    with ThreadPoolExecutor(max_workers=args.max_concurrent_queries) as executor:
+        futures = [executor.submit(diff_tables, bigquery_client, pair, args.max_rows) for pair in pairs]
+        for done, future in enumerate(as_completed(futures), start=1):
+            diff = future.result()
+            diffs[diff.pair.clone_id] = diff
+            print(f"[{done}/{len(pairs)}] {diff.pair.source_table}: {describe_diff(diff)}")
+    diffs = [diffs[pair.clone_id] for pair in pairs]
+    print_diff_summary(diffs)
+    for diff in diffs:
+        if diff.differing:
+            print_diff_details(diff)
+    print()
+    print(f"Total: {format_bytes(sum(diff.bytes_processed for diff in diffs))} processed")
+    if any(diff.error is not None for diff in diffs):
+        sys.exit(2)
+    if not all(diff.identical for diff in diffs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
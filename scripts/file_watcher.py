@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from typing import Callable, Iterable
+
+# How often the files are checked for changes, in seconds.
+DEFAULT_POLL_INTERVAL = 1.0
+
+
+class FileWatcher:
+    """
+    Finds the files that were added, modified or removed since the previous poll, by comparing their modification time
+    and size. Files are polled rather than watched through OS notifications, which works the same on every platform
+    (network and container file systems included) without any extra dependency.
+    """
+
+    def __init__(self, list_files: Callable[[], Iterable[str]]):
+        """
+        Args:
+            list_files: Returns the paths of the files to watch. It is called on every poll, so new files are found.
+        """
+        self._list_files = list_files
+        self._stats = self._scan()
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        stats = {}
+        for path in self._list_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stats[path] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def poll(self) -> tuple[list[str], list[str]]:
+        """Returns the files that were added or modified, and the files that were removed, since the previous poll."""
+        stats = self._scan()
+        changed = [path for path, stat in stats.items() if self._stats.get(path) != stat]
+        removed = [path for path in self._stats if path not in stats]
+        self._stats = stats
+        return changed, removed
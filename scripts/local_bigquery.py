@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A local stand-in for `bigquery.Client`, backed by SQLite, to exercise and benchmark the CLIs without a GCP project.
+# Tables are SQLite tables named after their fully qualified BigQuery name, e.g. `"my-project.dataset1.foo"`, or
+# `"dataset1.foo"` for tables of the default project. Only the subset of the client used by this repo is implemented,
+# and queries are run by SQLite, so only the SQL that both dialects understand works.
+
+import contextlib
+import hashlib
+import io
+import itertools
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional, Union
+
+from google.api_core.exceptions import BadRequest, Conflict, Forbidden, NotFound
+from google.cloud import bigquery
+
+from scripts.sql_splitter import iter_sql_statements
+
+DEFAULT_PROJECT = "local-project"
+DEFAULT_LOCATION = "US"
+DEFAULT_PAGE_SIZE = 50
+
+# The settings of `LocalClient.from_environment`.
+DATABASE_ENV_VAR = "LOCAL_BIGQUERY_DATABASE"
+PROJECT_ENV_VAR = "LOCAL_BIGQUERY_PROJECT"
+LATENCY_ENV_VAR = "LOCAL_BIGQUERY_LATENCY"
+JOB_DURATION_ENV_VAR = "LOCAL_BIGQUERY_JOB_DURATION"
+FAILURE_RATE_ENV_VAR = "LOCAL_BIGQUERY_FAILURE_RATE"
+QUOTA_ERROR_RATE_ENV_VAR = "LOCAL_BIGQUERY_QUOTA_ERROR_RATE"
+SEED_ENV_VAR = "LOCAL_BIGQUERY_SEED"
+
+# A rough number of bytes per value, to report the bytes processed by a query.
+BYTES_PER_VALUE = 8
+
+_BACKTICKED_NAME = re.compile(r"`([^`]+)`")
+_UNQUOTED_TABLE_NAME = re.compile(r"\b(FROM|JOIN)(\s+)([A-Za-z_][\w-]*(?:\.[A-Za-z_][\w-]*){1,2})\b", re.IGNORECASE)
+_TABLESAMPLE = re.compile(r"\bTABLESAMPLE\s+SYSTEM\s*\([^)]*\)", re.IGNORECASE)
+_ASSERT = re.compile(r"^\s*ASSERT\b(?P<expression>.*?)(?:\bAS\s*(?P<message>'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"))?"
+                     r"\s*;?\s*$", re.IGNORECASE | re.DOTALL)
+# SQLite has `IIF`, which like BigQuery's `IF` only evaluates the branch it returns, e.g. an `ERROR(...)` call.
+_IF_FUNCTION = re.compile(r"\bIF(\s*\()", re.IGNORECASE)
+# The JSON of a struct, as used to fingerprint rows. SQLite has no structs, so a row is written as an array of values.
+_TO_JSON_STRING_STRUCT = re.compile(r"\bTO_JSON_STRING\s*\(\s*STRUCT\s*\(", re.IGNORECASE)
+# The sum of cast values, e.g. `SUM(CAST(x AS BIGNUMERIC))`. SQLite sums integers on 64 bits, and fails on overflow.
+_SUM_CAST = re.compile(r"\bSUM(\s*\(\s*CAST\s*\()", re.IGNORECASE)
+_LEADING_COMMENTS = re.compile(r"^(?:\s*(?:--[^\n]*(?:\n|$)|#[^\n]*(?:\n|$)|/\*.*?\*/))*\s*", re.DOTALL)
+_READ_ONLY_STATEMENT = re.compile(r"^\s*(SELECT|WITH|ASSERT)\b", re.IGNORECASE)
+_TABLE_TYPES = {"TABLE", "SNAPSHOT", "VIEW"}
+_COLUMN_TYPES = {"INTEGER": "INTEGER", "INT": "INTEGER", "REAL": "FLOAT", "FLOAT": "FLOAT", "TEXT": "STRING",
+                 "BLOB": "BYTES", "NUMERIC": "NUMERIC", "BOOLEAN": "BOOLEAN", "TIMESTAMP": "TIMESTAMP"}
+
+
+def _concat(*values):
+    # Like in BigQuery, NULL if any of the values is NULL.
+    if any(value is None for value in values):
+        return None
+    return "".join(str(value) for value in values)
+
+
+def _farm_fingerprint(value) -> Optional[int]:
+    # Not the FarmHash of BigQuery, but also a signed 64-bit hash, which is all that comparing fingerprints needs.
+    if value is None:
+        return None
+    data = value if isinstance(value, bytes) else str(value).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big", signed=True)
+
+
+class _BitXor:
+    """The `BIT_XOR` aggregate function. NULL values are ignored, and the result is NULL if all of them are."""
+
+    def __init__(self):
+        self.value = None
+
+    def step(self, value):
+        if value is not None:
+            self.value = value if self.value is None else self.value ^ value
+
+    def finalize(self):
+        return self.value
+
+
+class _BigSum:
+    """The `SUM` of cast values, e.g. of 64-bit fingerprints cast to BIGNUMERIC, without overflow. NULL values are
+    ignored, and the result is NULL if all of them are. SQLite integers are 64-bit, so a sum that does not fit is
+    returned as text.
+    """
+
+    def __init__(self):
+        self.value = None
+
+    def step(self, value):
+        if value is not None:
+            self.value = value if self.value is None else self.value + value
+
+    def finalize(self):
+        if isinstance(self.value, int) and not -2 ** 63 <= self.value < 2 ** 63:
+            return str(self.value)
+        return self.value
+
+
+class LocalJob:
+    """A query or copy job of the local backend. The work is done on submission, but the job only reports as done
+    once its duration has elapsed, so that polling behaves like with BigQuery.
+    """
+
+    def __init__(self, job_type: str, duration: float, exception: Optional[Exception] = None,
+                 rows: Optional[list[tuple]] = None, referenced_tables: Optional[list[bigquery.TableReference]] = None,
+                 bytes_processed: Optional[int] = None):
+        self.job_id = f"local_{job_type}_{uuid.uuid4().hex}"
+        self.job_type = job_type
+        self.created = datetime.now(timezone.utc)
+        self.started = self.created
+        self._ends_at = self.created + timedelta(seconds=duration)
+        self._exception = exception
+        self._rows = rows or []
+        self.referenced_tables = referenced_tables or []
+        self.total_bytes_processed = bytes_processed
+        self.total_bytes_billed = bytes_processed
+        self.slot_millis = int(duration * 1000) if exception is None else None
+        self.cache_hit = False if job_type == "query" else None
+        self.timeline = []
+        self.script_statistics = None
+
+    @property
+    def ended(self) -> Optional[datetime]:
+        return self._ends_at if self.done() else None
+
+    @property
+    def state(self) -> str:
+        return "DONE" if self.done() else "RUNNING"
+
+    def done(self, *args, **kwargs) -> bool:
+        return datetime.now(timezone.utc) >= self._ends_at
+
+    @property
+    def error_result(self) -> Optional[dict]:
+        if not self.done() or self._exception is None:
+            return None
+        errors = getattr(self._exception, "errors", None)
+        return errors[0] if errors else {"reason": "invalidQuery", "message": str(self._exception)}
+
+    @property
+    def errors(self) -> Optional[list[dict]]:
+        return [self.error_result] if self.error_result else None
+
+    def cancel(self, *args, **kwargs) -> bool:
+        if not self.done():
+            self._ends_at = datetime.now(timezone.utc)
+            self._exception = BadRequest("Job execution was cancelled: User requested cancellation",
+                                         errors=[{"reason": "stopped", "message": "Job execution was cancelled: User "
+                                                                                  "requested cancellation"}])
+        return True
+
+    def result(self, *args, **kwargs) -> list[tuple]:
+        remaining = (self._ends_at - datetime.now(timezone.utc)).total_seconds()
+        if remaining > 0:
+            time.sleep(remaining)
+        if self._exception is not None:
+            raise self._exception
+        return self._rows
+
+
+class LocalPageIterator:
+    """Mimics the paged iterators of the client: iterating yields the items, and `pages` yields them page by page."""
+
+    def __init__(self, items: list, page_size: Optional[int], latency: float):
+        self._items = items
+        self._page_size = page_size or DEFAULT_PAGE_SIZE
+        self._latency = latency
+
+    @property
+    def pages(self) -> Iterator[list]:
+        for start in range(0, max(len(self._items), 1), self._page_size):
+            time.sleep(self._latency)
+            yield self._items[start:start + self._page_size]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.pages)
+
+
+class LocalClient:
+    """A stand-in for `bigquery.Client`, backed by a SQLite database.
+
+    Args:
+        database: The path of the SQLite database, or `:memory:`
+        project: The default project, used for the table names without one
+        latency: The number of seconds every request (job submission, metadata request, page of a listing) takes
+        job_duration: The number of seconds a job takes to complete, after it has been submitted
+        failure_rate: The probability of a job failing with a `backendError`, between 0 and 1
+        quota_error_rate: The probability of a job submission being rejected with `rateLimitExceeded`, between 0 and 1
+        seed: The seed of the random failures, for reproducible runs
+    """
+
+    def __init__(self, database: str = ":memory:", project: str = DEFAULT_PROJECT, latency: float = 0.0,
+                 job_duration: float = 0.0, failure_rate: float = 0.0, quota_error_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.project = project
+        self.latency = latency
+        self.job_duration = job_duration
+        self.failure_rate = failure_rate
+        self.quota_error_rate = quota_error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._raised_error = None  # type: Optional[str]
+        self._tables_cache = None  # type: Optional[tuple[int, dict[str, str]]]
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        self._connection.create_function("ERROR", 1, self._error)
+        self._connection.create_function("CONCAT", -1, _concat, deterministic=True)
+        self._connection.create_function("FARM_FINGERPRINT", 1, _farm_fingerprint, deterministic=True)
+        self._connection.create_aggregate("BIT_XOR", 1, _BitXor)
+        self._connection.create_aggregate("BIG_SUM", 1, _BigSum)
+        self._create_metadata_tables()
+
+    def _create_metadata_tables(self):
+        self._connection.execute("CREATE TABLE IF NOT EXISTS __local_datasets__ ("
+                                 "  dataset_id TEXT PRIMARY KEY,"
+                                 "  location TEXT NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS __local_tables__ ("
+                                 "  table_id TEXT PRIMARY KEY,"
+                                 "  table_type TEXT NOT NULL,"
+                                 "  created REAL NOT NULL,"
+                                 "  modified REAL NOT NULL)")
+        self._connection.commit()
+
+    @classmethod
+    def from_environment(cls, project: Optional[str] = None) -> "LocalClient":
+        """Creates a client configured by the `LOCAL_BIGQUERY_*` environment variables."""
+        seed = os.environ.get(SEED_ENV_VAR)
+        return cls(database=os.environ.get(DATABASE_ENV_VAR, ":memory:"),
+                   project=project or os.environ.get(PROJECT_ENV_VAR, DEFAULT_PROJECT),
+                   latency=float(os.environ.get(LATENCY_ENV_VAR, 0)),
+                   job_duration=float(os.environ.get(JOB_DURATION_ENV_VAR, 0)),
+                   failure_rate=float(os.environ.get(FAILURE_RATE_ENV_VAR, 0)),
+                   quota_error_rate=float(os.environ.get(QUOTA_ERROR_RATE_ENV_VAR, 0)),
+                   seed=int(seed) if seed is not None else None)
+
+    @classmethod
+    def in_memory_copy(cls, database: str, **kwargs) -> "LocalClient":
+        """Creates a client working on an in-memory copy of `database`, which is left untouched. Useful to start every
+        run from the same tables, e.g. in CI or in benchmarks.
+        """
+        client = cls(**kwargs)
+        with client._lock, contextlib.closing(sqlite3.connect(database)) as source:
+            source.backup(client._connection)
+            client._create_metadata_tables()
+        return client
+
+    # Names
+
+    def _error(self, message):
+        self._raised_error = str(message)
+        raise ValueError(message)
+
+    def _table_ref(self, table: Union[str, bigquery.TableReference, bigquery.Table]) -> bigquery.TableReference:
+        if isinstance(table, str):
+            # Point-in-time decorators are accepted, but the current version of the table is always used.
+            return bigquery.TableReference.from_string(table.split("@")[0], default_project=self.project)
+        if isinstance(table, bigquery.TableReference):
+            return table
+        return table.reference
+
+    def _dataset_ref(self, dataset) -> bigquery.DatasetReference:
+        if isinstance(dataset, str):
+            return bigquery.DatasetReference.from_string(dataset, default_project=self.project)
+        if isinstance(dataset, bigquery.DatasetReference):
+            return dataset
+        return dataset.reference
+
+    def _physical_tables(self) -> dict[str, str]:
+        """Returns the SQLite table of every BigQuery table, keyed by the fully qualified BigQuery name. The mapping is
+        only built again when the schema of the database has changed, even if changed by another connection.
+        """
+        schema_version = self._connection.execute("PRAGMA schema_version").fetchone()[0]
+        if self._tables_cache is not None and self._tables_cache[0] == schema_version:
+            return self._tables_cache[1]
+        names = [row[0] for row in self._connection.execute("SELECT name FROM sqlite_master "
+                                                            "WHERE type IN ('table', 'view')")]
+        tables = {}
+        for name in names:
+            parts = name.split(".")
+            if len(parts) == 2:
+                tables[f"{self.project}.{name}"] = name
+            elif len(parts) == 3:
+                tables[name] = name
+        self._tables_cache = (schema_version, tables)
+        return tables
+
+    def _physical_table(self, ref: bigquery.TableReference) -> Optional[str]:
+        return self._physical_tables().get(f"{ref.project}.{ref.dataset_id}.{ref.table_id}")
+
+    def _table_metadata(self, table_id: str) -> tuple[str, float, float]:
+        row = self._connection.execute("SELECT table_type, created, modified FROM __local_tables__ WHERE table_id = ?",
+                                       (table_id,)).fetchone()
+        if row is None:
+            # A table created directly in the database: its first sighting counts as its creation.
+            now = time.time()
+            physical_type = self._connection.execute("SELECT type FROM sqlite_master WHERE name = ?",
+                                                     (self._physical_tables().get(table_id),)).fetchone()
+            row = ("VIEW" if physical_type and physical_type[0] == "view" else "TABLE", now, now)
+            self._connection.execute("INSERT INTO __local_tables__ VALUES (?, ?, ?, ?)", (table_id, *row))
+            self._connection.commit()
+        return row
+
+    def _touch(self, table_id: str, table_type: Optional[str] = None):
+        now = time.time()
+        table_type = table_type or self._table_metadata(table_id)[0]
+        self._connection.execute("INSERT INTO __local_tables__ VALUES (?, ?, ?, ?) ON CONFLICT(table_id) DO UPDATE "
+                                 "SET table_type = excluded.table_type, modified = excluded.modified",
+                                 (table_id, table_type, now, now))
+        self._connection.commit()
+
+    def _translate(self, query: str) -> tuple[str, list[bigquery.TableReference]]:
+        """Rewrites the table names of a query into SQLite quoted names, and drops the clauses SQLite does not have.
+
+        Returns:
+            The rewritten query, and the tables it references
+        """
+        tables = self._physical_tables()
+        referenced = {}
+
+        def table_name(name: str) -> str:
+            ref = self._table_ref(name)
+            full_name = f"{ref.project}.{ref.dataset_id}.{ref.table_id}"
+            if full_name not in tables:
+                raise BadRequest(f"Not found: Table {ref.project}:{ref.dataset_id}.{ref.table_id} was not found",
+                                 errors=[{"reason": "notFound", "message": f"Not found: Table {ref.project}:"
+                                                                           f"{ref.dataset_id}.{ref.table_id} was not "
+                                                                           f"found in location {DEFAULT_LOCATION}"}])
+            referenced[full_name] = ref
+            return '"' + tables[full_name].replace('"', '""') + '"'
+
+        def backticked(match: re.Match) -> str:
+            name = match.group(1)
+            return table_name(name) if "." in name else f'"{name}"'
+
+        query = _TABLESAMPLE.sub("", query)
+        query = _IF_FUNCTION.sub(r"IIF\1", query)
+        query = _TO_JSON_STRING_STRUCT.sub("(json_array(", query)
+        query = _SUM_CAST.sub(r"BIG_SUM\1", query)
+        query = _BACKTICKED_NAME.sub(backticked, query)
+        query = _UNQUOTED_TABLE_NAME.sub(lambda m: m.group(1) + m.group(2) + table_name(m.group(3)), query)
+        return query, list(referenced.values())
+
+    # Requests
+
+    def _request(self, job_submission: bool = False):
+        """Simulates the round trip of a request, and the rate limits on job submissions."""
+        time.sleep(self.latency)
+        if not job_submission:
+            return
+        with self._lock:
+            throttled = self._random.random() < self.quota_error_rate
+        if throttled:
+            message = "Exceeded rate limits: too many api requests per user per method for this user_method"
+            raise Forbidden(message, errors=[{"reason": "rateLimitExceeded", "message": message}])
+
+    def _injected_failure(self) -> Optional[Exception]:
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+        if not failed:
+            return None
+        message = "The local backend failed this job on purpose, see LOCAL_BIGQUERY_FAILURE_RATE"
+        return BadRequest(message, errors=[{"reason": "backendError", "message": message}])
+
+    def _bytes_processed(self, refs: list[bigquery.TableReference]) -> int:
+        total = 0
+        for ref in refs:
+            name = '"' + self._physical_table(ref).replace('"', '""') + '"'
+            rows = self._connection.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+            columns = len(self._connection.execute(f"PRAGMA table_info({name})").fetchall())
+            total += rows * columns * BYTES_PER_VALUE
+        return total
+
+    def _execute(self, statement: str, refs: list[bigquery.TableReference]) -> list[tuple]:
+        assertion = _ASSERT.match(statement)
+        if assertion:
+            rows = self._connection.execute(f"SELECT CASE WHEN {assertion.group('expression')} THEN 1 ELSE 0 END"
+                                            ).fetchall()
+            if not rows or rows[0][0] != 1:
+                message = assertion.group("message")
+                message = message[1:-1] if message else assertion.group("expression").strip()
+                raise BadRequest(f"Assertion failed: {message}",
+                                 errors=[{"reason": "invalidQuery", "message": f"Assertion failed: {message}"}])
+            return []
+        rows = self._connection.execute(statement).fetchall()
+        if not _READ_ONLY_STATEMENT.match(statement):
+            self._connection.commit()
+            for ref in refs:
+                self._touch(f"{ref.project}.{ref.dataset_id}.{ref.table_id}")
+        return rows
+
+    def query(self, query: str, job_config: Optional[bigquery.QueryJobConfig] = None, **kwargs) -> LocalJob:
+        self._request(job_submission=True)
+        statements = list(iter_sql_statements(io.StringIO(query)))
+        if len(statements) > 1:
+            message = "Scripts are not supported by the local backend, run one statement per query"
+            raise BadRequest(message, errors=[{"reason": "invalidQuery", "message": message}])
+        statement = _LEADING_COMMENTS.sub("", statements[0], count=1) if statements else ";"
+        with self._lock:
+            try:
+                statement, refs = self._translate(statement)
+                if job_config is not None and job_config.dry_run:
+                    expression = _ASSERT.match(statement)
+                    explained = f"SELECT {expression.group('expression')}" if expression else statement
+                    self._connection.execute(f"EXPLAIN {explained}")
+                    return LocalJob("query", 0.0, referenced_tables=refs, bytes_processed=self._bytes_processed(refs))
+                exception = self._injected_failure()
+                rows = []
+                if exception is None:
+                    self._raised_error = None
+                    try:
+                        rows = self._execute(statement, refs)
+                    except sqlite3.Error as e:
+                        message = self._raised_error or str(e)
+                        exception = BadRequest(message, errors=[{"reason": "invalidQuery", "message": message}])
+                    except BadRequest as e:
+                        exception = e
+            except sqlite3.Error as e:
+                raise BadRequest(str(e), errors=[{"reason": "invalidQuery", "message": str(e)}])
+            return LocalJob("query", self.job_duration, exception=exception, rows=rows, referenced_tables=refs,
+                            bytes_processed=self._bytes_processed(refs))
+
+    def copy_table(self, sources, destination, job_id: Optional[str] = None, project: Optional[str] = None,
+                   job_config: Optional[bigquery.CopyJobConfig] = None, **kwargs) -> LocalJob:
+        self._request(job_submission=True)
+        source_ref = self._table_ref(sources)
+        destination_ref = self._table_ref(destination)
+        destination_id = f"{destination_ref.project}.{destination_ref.dataset_id}.{destination_ref.table_id}"
+        operation_type = (job_config.operation_type if job_config is not None else None) or "COPY"
+        with self._lock:
+            exception = self._injected_failure()
+            source_table = self._physical_table(source_ref)
+            if exception is None and source_table is None:
+                exception = NotFound(f"Not found: Table {source_ref.project}:{source_ref.dataset_id}."
+                                     f"{source_ref.table_id}")
+            elif exception is None and self._physical_table(destination_ref) is not None:
+                exception = Conflict(f"Already Exists: Table {destination_ref.project}:{destination_ref.dataset_id}."
+                                     f"{destination_ref.table_id}")
+            elif exception is None:
+                source = '"' + source_table.replace('"', '""') + '"'
+                destination = '"' + destination_id.replace('"', '""') + '"'
+                self._connection.execute(f"CREATE TABLE {destination} AS SELECT * FROM {source}")
+                self._touch(destination_id, "SNAPSHOT" if operation_type == "SNAPSHOT" else "TABLE")
+            return LocalJob("copy", self.job_duration, exception=exception, referenced_tables=[source_ref])
+
+    def list_jobs(self, parent_job=None, **kwargs) -> LocalPageIterator:
+        # Scripts are rejected on submission, so no job has child jobs.
+        return LocalPageIterator([], None, self.latency)
+
+    def get_table(self, table, **kwargs) -> bigquery.Table:
+        self._request()
+        ref = self._table_ref(table)
+        with self._lock:
+            physical_table = self._physical_table(ref)
+            if physical_table is None:
+                raise NotFound(f"Not found: Table {ref.project}:{ref.dataset_id}.{ref.table_id}")
+            full_name = f"{ref.project}.{ref.dataset_id}.{ref.table_id}"
+            table_type, created, modified = self._table_metadata(full_name)
+            quoted = '"' + physical_table.replace('"', '""') + '"'
+            num_rows = self._connection.execute(f"SELECT COUNT(*) FROM {quoted}").fetchone()[0]
+            columns = self._connection.execute(f"PRAGMA table_info({quoted})").fetchall()
+        return bigquery.Table.from_api_repr({
+            "tableReference": {"projectId": ref.project, "datasetId": ref.dataset_id, "tableId": ref.table_id},
+            "type": table_type if table_type in _TABLE_TYPES else "TABLE",
+            "numRows": str(num_rows),
+            "creationTime": str(int(created * 1000)),
+            "lastModifiedTime": str(int(modified * 1000)),
+            "location": DEFAULT_LOCATION,
+            "schema": {"fields": [{"name": column[1], "type": _COLUMN_TYPES.get(column[2].upper(), "STRING")}
+                                  for column in columns]},
+        })
+
+    def list_tables(self, dataset, max_results: Optional[int] = None, page_size: Optional[int] = None,
+                    **kwargs) -> LocalPageIterator:
+        self._request()
+        ref = self._dataset_ref(dataset)
+        with self._lock:
+            prefix = f"{ref.project}.{ref.dataset_id}."
+            items = []
+            for table_id in sorted(table_id for table_id in self._physical_tables() if table_id.startswith(prefix)):
+                table_type = self._table_metadata(table_id)[0]
+                items.append(bigquery.table.TableListItem({
+                    "tableReference": {"projectId": ref.project, "datasetId": ref.dataset_id,
+                                       "tableId": table_id[len(prefix):]},
+                    "type": table_type,
+                }))
+        return LocalPageIterator(items[:max_results], page_size, self.latency)
+
+    def _datasets(self) -> dict[str, str]:
+        """Returns the location of every dataset, keyed by `project.dataset`. A dataset exists if it was created, or if
+        it has tables.
+        """
+        datasets = {table_id.rsplit(".", 1)[0]: DEFAULT_LOCATION for table_id in self._physical_tables()}
+        datasets.update(self._connection.execute("SELECT dataset_id, location FROM __local_datasets__").fetchall())
+        return datasets
+
+    def list_datasets(self, project: Optional[str] = None, max_results: Optional[int] = None,
+                      page_size: Optional[int] = None, **kwargs) -> LocalPageIterator:
+        self._request()
+        project = project or self.project
+        with self._lock:
+            items = [bigquery.dataset.DatasetListItem({
+                "datasetReference": {"projectId": project, "datasetId": dataset_id.split(".", 1)[1]},
+                "location": location,
+            }) for dataset_id, location in sorted(self._datasets().items()) if dataset_id.startswith(f"{project}.")]
+        return LocalPageIterator(items[:max_results], page_size, self.latency)
+
+    def list_projects(self, max_results: Optional[int] = None, page_size: Optional[int] = None,
+                      **kwargs) -> LocalPageIterator:
+        self._request()
+        with self._lock:
+            projects = sorted({dataset_id.split(".", 1)[0] for dataset_id in self._datasets()} | {self.project})
+        items = [bigquery.client.Project(project, i, project) for i, project in enumerate(projects)]
+        return LocalPageIterator(items[:max_results], page_size, self.latency)
+
+    def get_dataset(self, dataset_ref, **kwargs) -> bigquery.Dataset:
+        self._request()
+        ref = self._dataset_ref(dataset_ref)
+        with self._lock:
+            location = self._datasets().get(f"{ref.project}.{ref.dataset_id}")
+        if location is None:
+            raise NotFound(f"Not found: Dataset {ref.project}:{ref.dataset_id}")
+        dataset = bigquery.Dataset(ref)
+        dataset.location = location
+        return dataset
+
+    def create_dataset(self, dataset, exists_ok: bool = False, **kwargs) -> bigquery.Dataset:
+        self._request()
+        ref = self._dataset_ref(dataset)
+        location = getattr(dataset, "location", None) or DEFAULT_LOCATION
+        with self._lock:
+            if f"{ref.project}.{ref.dataset_id}" in self._datasets():
+                if exists_ok:
+                    return self.get_dataset(ref)
+                raise Conflict(f"Already Exists: Dataset {ref.project}:{ref.dataset_id}")
+            self._connection.execute("INSERT INTO __local_datasets__ VALUES (?, ?)",
+                                     (f"{ref.project}.{ref.dataset_id}", location))
+            self._connection.commit()
+        created = bigquery.Dataset(ref)
+        created.location = location
+        return created
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+# The default location of the metadata cache, next to the result cache.
+DEFAULT_METADATA_CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "ci-for-data-in-bigquery", "metadata.sqlite")
+
+# The default number of seconds after which a cached listing is refreshed in the background.
+DEFAULT_TTL = 3600
+
+
+def projects_key() -> str:
+    return "projects"
+
+
+def datasets_key(project_id: str) -> str:
+    return f"datasets/{project_id}"
+
+
+def tables_key(project_id: str, dataset_id: str) -> str:
+    return f"tables/{project_id}/{dataset_id}"
+
+
+class MetadataCache:
+    """
+    An on-disk store of metadata listings (the projects, the datasets of a project, the tables of a dataset), keyed by
+    `projects_key`, `datasets_key` and `tables_key`. Each listing is stored as a list of API resources, with the time it
+    was fetched at. It can be written from background threads.
+    """
+
+    def __init__(self, path: str = DEFAULT_METADATA_CACHE_FILE):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS listings ("
+                                 "  key TEXT PRIMARY KEY,"
+                                 "  items TEXT NOT NULL,"
+                                 "  fetched_at REAL NOT NULL)")
+        self._connection.commit()
+
+    def get(self, key: str) -> Optional[tuple[list[dict], float]]:
+        """Returns the cached listing and the time it was fetched at, or None if it is not cached."""
+        with self._lock:
+            row = self._connection.execute("SELECT items, fetched_at FROM listings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key: str, items: list[dict]):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO listings (key, items, fetched_at) VALUES (?, ?, ?)",
+                                     (key, json.dumps(items), time.time()))
+            self._connection.commit()
+
+    def invalidate(self, key_prefix: str = ""):
+        """Removes the listings whose key starts with `key_prefix`, all of them by default."""
+        with self._lock:
+            self._connection.execute("DELETE FROM listings WHERE substr(key, 1, ?) = ?",
+                                     (len(key_prefix), key_prefix))
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class Listing:
+    """The items of a listing, which may still be being fetched page by page in a background thread.
+
+    Args:
+        fetch_pages: Returns an iterable over the pages of the listing, each page being a list of API resources. It is
+            called from a background thread. When None, the listing is complete with `items`.
+        items: The items already known
+        on_complete: Called with all the items, from the background thread, once the last page has been fetched
+    """
+
+    def __init__(self, fetch_pages: Optional[Callable[[], Iterable[list[dict]]]] = None,
+                 items: Optional[list[dict]] = None, on_complete: Optional[Callable[[list[dict]], None]] = None):
+        self._items = list(items or [])
+        self._condition = threading.Condition()
+        self.done = fetch_pages is None
+        self.error = None  # type: Optional[Exception]
+        if fetch_pages is not None:
+            threading.Thread(target=self._fetch, args=(fetch_pages, on_complete), daemon=True).start()
+
+    def _fetch(self, fetch_pages: Callable[[], Iterable[list[dict]]], on_complete):
+        try:
+            for page in fetch_pages():
+                with self._condition:
+                    self._items.extend(page)
+                    self._condition.notify_all()
+        except Exception as e:
+            self.error = e
+        with self._condition:
+            self.done = True
+            self._condition.notify_all()
+        if self.error is None and on_complete is not None:
+            on_complete(list(self._items))
+
+    def wait_for(self, count: int) -> list[dict]:
+        """Waits until at least `count` items have been fetched, or the listing is complete, and returns the items
+        fetched so far.
+
+        Raises:
+            Exception: the error that stopped the listing, if it stopped before `count` items were fetched
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.done or len(self._items) >= count)
+            if len(self._items) < count and self.error is not None:
+                raise self.error
+            return list(self._items)
+
+
+def open_listing(cache: MetadataCache, key: str, fetch_pages: Callable[[], Iterable[list[dict]]],
+                 ttl: float = DEFAULT_TTL) -> Listing:
+    """Opens a listing from the cache when possible, so that it can be shown right away.
+
+    A cached listing older than `ttl` seconds is still returned, and refreshed in the background for the next time.
+    When the listing is not cached, it is fetched in the background, and the first pages can be shown while the rest
+    are being fetched. Either way, the cache is updated once the listing has been fetched completely.
+    """
+    on_complete = functools.partial(cache.put, key)
+    cached = cache.get(key)
+    if cached is None:
+        return Listing(fetch_pages, on_complete=on_complete)
+    items, fetched_at = cached
+    if time.time() - fetched_at > ttl:
+        Listing(fetch_pages, on_complete=on_complete)
+    return Listing(items=items)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dataclasses
+import json
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from scripts.run_tests import TestResult
+
+
+def source_file_name(key_name: str) -> str:
+    """Returns the name of the file a test comes from, e.g: `orders/status_is_valid` for `orders/status_is_valid_0`."""
+    return key_name.rsplit("_", 1)[0]
+
+
+def result_as_dict(key_name: str, res: "TestResult") -> dict:
+    return {
+        "name": key_name,
+        "file": source_file_name(key_name),
+        "status": "passed" if res.passed else ("failed" if res.failed else res.message.lower()),
+        "message": res.message,
+        "cached": res.cached,
+        "sample_percent": res.sample_percent,
+        "timings": dataclasses.asdict(res.timings) if res.timings else None,
+        "statistics": dataclasses.asdict(res.statistics) if res.statistics else None,
+    }
+
+
+def write_json_report(results: dict[str, "TestResult"], path: str):
+    """Writes the results of a run, with the timings and job statistics of every test, as a JSON file."""
+    tests = [result_as_dict(key_name, res) for key_name, res in results.items()]
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "summary": {
+            "tests": len(tests),
+            "passed": sum(res.passed for res in results.values()),
+            "failed": sum(res.failed for res in results.values()),
+            "not_run": sum(not res.passed and not res.failed for res in results.values()),
+            "cached": sum(res.cached for res in results.values()),
+            "bytes_processed": sum(res.statistics.bytes_processed or 0 for res in results.values() if res.statistics),
+            "bytes_billed": sum(res.statistics.bytes_billed or 0 for res in results.values() if res.statistics),
+            "slot_millis": sum(res.statistics.slot_millis or 0 for res in results.values() if res.statistics),
+        },
+        "tests": tests,
+    }
+    with open(path, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+
+def write_junit_xml(results: dict[str, "TestResult"], path: str, suite_name: str = "run-tests"):
+    """Writes the results of a run as a JUnit XML file, which most CI systems can display. Each test is a test case,
+    grouped by the file it comes from, and its job statistics are attached as properties.
+    """
+    total_time = sum(res.timings.total for res in results.values() if res.timings)
+    suite = ElementTree.Element("testsuite", {
+        "name": suite_name,
+        "tests": str(len(results)),
+        "failures": str(sum(res.failed for res in results.values())),
+        "skipped": str(sum(not res.passed and not res.failed for res in results.values())),
+        "errors": "0",
+        "time": f"{total_time:.3f}",
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    for key_name, res in results.items():
+        case = ElementTree.SubElement(suite, "testcase", {
+            "name": key_name,
+            "classname": source_file_name(key_name).replace("/", "."),
+            "time": f"{res.timings.total:.3f}" if res.timings else "0.000",
+        })
+        if res.statistics or res.cached:
+            properties = ElementTree.SubElement(case, "properties")
+            values = {"cached": res.cached}
+            if res.sample_percent is not None:
+                values["sample_percent"] = res.sample_percent
+            if res.statistics:
+                values.update({field: value for field, value in dataclasses.asdict(res.statistics).items()
+                               if field != "timeline" and value is not None})
+            for name, value in values.items():
+                ElementTree.SubElement(properties, "property", {"name": name, "value": str(value)})
+        if res.failed:
+            ElementTree.SubElement(case, "failure", {"message": res.message}).text = res.message
+        elif not res.passed:
+            ElementTree.SubElement(case, "skipped", {"message": res.message})
+    ElementTree.indent(suite)
+    ElementTree.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from typing import Iterable
+
+# The default location of the cache file, following the XDG base directory convention.
+DEFAULT_CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+                                  "ci-for-data-in-bigquery", "results.sqlite")
+
+# The default maximum number of results to keep in the cache. Every entry is a couple of hundred bytes.
+DEFAULT_MAX_ENTRIES = 100_000
+
+# Functions whose result changes from one run to the next, with the same tables. The `CURRENT_*` functions can be
+# called without parentheses.
+NON_DETERMINISTIC_FUNCTIONS = re.compile(r"\bCURRENT_(?:DATE|DATETIME|TIME|TIMESTAMP)\b|"
+                                         r"\b(?:RAND|GENERATE_UUID|SESSION_USER)\s*\(", re.IGNORECASE)
+
+
+def is_cacheable(query: str) -> bool:
+    """Returns False if the result of the query may change without any of its tables changing, i.e. it calls a
+    function such as `CURRENT_DATE()` or `RAND()`. A function name found in a string literal or a comment also counts,
+    which at worst runs a test that could have been cached.
+    """
+    return NON_DETERMINISTIC_FUNCTIONS.search(query) is None
+
+
+def cache_key(query: str, table_versions: Iterable[str]) -> str:
+    """Computes the cache key of a test.
+
+    Args:
+        query: The rendered SQL of the test
+        table_versions: One string per table referenced by the query, identifying the table and its last modification
+            time. e.g: `project.dataset.table@2022-03-17T15:19:41+00:00`
+
+    Returns:
+        A hex digest, which changes whenever the query or any of the referenced tables change.
+    """
+    digest = hashlib.sha256(query.encode("utf-8"))
+    for table_version in sorted(table_versions):
+        digest.update(b"\0")
+        digest.update(table_version.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    An on-disk store of the tests that have passed, keyed by `cache_key`.
+    Only passing results are stored, so a hit always means "OK". When the number of entries grows over `max_entries`,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_FILE, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                 "  key TEXT PRIMARY KEY,"
+                                 "  test_name TEXT NOT NULL,"
+                                 "  created_at REAL NOT NULL,"
+                                 "  last_used_at REAL NOT NULL)")
+        self._connection.commit()
+
+    def get(self, key: str) -> bool:
+        """Returns True if a passing result is cached for the given key."""
+        cursor = self._connection.execute("UPDATE results SET last_used_at = ? WHERE key = ?", (time.time(), key))
+        self._connection.commit()
+        return cursor.rowcount > 0
+
+    def put(self, key: str, test_name: str):
+        """Records a passing result for the given key, evicting old entries if the cache is full."""
+        now = time.time()
+        self._connection.execute("INSERT OR REPLACE INTO results (key, test_name, created_at, last_used_at) "
+                                 "VALUES (?, ?, ?, ?)", (key, test_name, now, now))
+        self._evict()
+        self._connection.commit()
+
+    def _evict(self):
+        self._connection.execute("DELETE FROM results WHERE key IN ("
+                                 "  SELECT key FROM results ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                                 (self.max_entries,))
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import time
+from typing import Iterable, Optional
+
+# The default location of the history file, next to the result cache.
+DEFAULT_HISTORY_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+                                    "ci-for-data-in-bigquery", "history.json")
+
+# The weight of the latest run in the expected duration of a test. The rest comes from the previous runs, so a single
+# slow run (e.g. a busy reservation) does not reorder the whole suite.
+SMOOTHING_FACTOR = 0.5
+
+
+class RunHistory:
+    """
+    The duration and bytes processed of past test runs, keyed by test name, stored as a JSON file.
+    The file looks like this:
+    {
+      "no_missing_joins_0": {"duration": 12.3, "bytes_processed": 1073741824, "runs": 4, "updated_at": 1647530381.0}
+    }
+    """
+
+    def __init__(self, path: str = DEFAULT_HISTORY_FILE):
+        self.path = path
+        self.entries = {}  # type: dict[str, dict]
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                self.entries = json.load(fp)
+
+    def expected_duration(self, key_name: str) -> Optional[float]:
+        entry = self.entries.get(key_name)
+        return entry["duration"] if entry else None
+
+    def expected_durations(self, key_names: Iterable[str]) -> dict[str, float]:
+        """Returns the expected duration of each test. Tests without history are expected to take as long as the
+        average known test, or 0 when there is no history at all.
+        """
+        key_names = list(key_names)
+        known = [self.entries[key_name]["duration"] for key_name in key_names if key_name in self.entries]
+        default = sum(known) / len(known) if known else 0.0
+        return {key_name: self.entries[key_name]["duration"] if key_name in self.entries else default
+                for key_name in key_names}
+
+    def record(self, key_name: str, duration: float, bytes_processed: Optional[int]):
+        entry = self.entries.get(key_name)
+        if entry is None:
+            entry = {"duration": duration, "runs": 0}
+        else:
+            entry["duration"] = SMOOTHING_FACTOR * duration + (1 - SMOOTHING_FACTOR) * entry["duration"]
+        entry["bytes_processed"] = bytes_processed
+        entry["runs"] += 1
+        entry["updated_at"] = time.time()
+        self.entries[key_name] = entry
+
+    def save(self):
+        """Writes the history to disk. The file is replaced atomically, so concurrent runs never see it half-written."""
+        directory = os.path.dirname(self.path) or os.curdir
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as fp:
+            json.dump(self.entries, fp, indent=2, sort_keys=True)
+        os.replace(fp.name, self.path)
@@ -17,18 +17,31 @@
 
 # remember to set your environment variable GOOGLE_APPLICATION_CREDENTIALS to point to a service-account key file. e.g:
 # `export GOOGLE_APPLICATION_CREDENTIALS="/path/to/keyfile.json"`
+import dataclasses
+import fnmatch
+import functools
 import json
 import os
 import sys
-from argparse import ArgumentParser
+import time
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 import asyncio
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
-from typing import Optional
+from typing import Iterator, Optional
 
-import google.auth
 from google.api_core.exceptions import BadRequest
 from google.cloud import bigquery
 
+from scripts.backends import create_client, default_project
+from scripts.file_watcher import DEFAULT_POLL_INTERVAL, FileWatcher
+from scripts.run_history import DEFAULT_HISTORY_FILE, RunHistory
+from scripts.result_cache import DEFAULT_CACHE_FILE, DEFAULT_MAX_ENTRIES, ResultCache, cache_key, is_cacheable
+from scripts.sql_splitter import iter_sql_statements
+from scripts.reports import write_json_report, write_junit_xml
+from scripts.translations import TranslationMap
+
 
 class TemplateWithDefaultKey(Template):
     """
@@ -44,121 +57,1311 @@ class TemplateWithDefaultKey(Template):
 
     def __init__(self, template):
         super().__init__(template)
+        self._compiled = compile_template(template)
 
-    def substitute(self, *args, **kwds):
-        try:
-            return super().substitute(*args, **kwds)
-        except KeyError as err:
-            key = str(err.args[0])
-            kwds[key] = key
-            return self.substitute(*args, **kwds)
+    def substitute(self, mapping=None, /, **kwds):
+        """Substitutes every placeholder in a single pass. Keys missing from the mapping are substituted with the key
+        itself. The mapping is never modified.
+        """
+        if mapping is None:
+            mapping = kwds
+        elif kwds:
+            mapping = ChainMap(kwds, mapping)
+        literals, keys = self._compiled
+        parts = [literals[0]]
+        for key, literal in zip(keys, literals[1:]):
+            parts.append(str(mapping.get(key, key)))
+            parts.append(literal)
+        return "".join(parts)
+
+    def substitute_sampled(self, mapping, sample_percent: float) -> str:
+        """Like `substitute`, but every key found in the mapping is replaced with a subquery that reads about
+        `sample_percent` percent of the translated table, using TABLESAMPLE. A subquery can replace a table anywhere in
+        a FROM clause, aliases included. Backticks around the placeholder (e.g. `${dataset.table}`) are removed, as
+        they can not quote a subquery.
+        """
+        literals, keys = self._compiled
+        parts = [literals[0]]
+        for key, literal in zip(keys, literals[1:]):
+            if key in mapping:
+                if parts[-1].endswith("`") and literal.startswith("`"):
+                    parts[-1] = parts[-1][:-1]
+                    literal = literal[1:]
+                parts.append(f"(SELECT * FROM `{mapping[key]}` TABLESAMPLE SYSTEM ({sample_percent:g} PERCENT))")
+            else:
+                parts.append(key)
+            parts.append(literal)
+        return "".join(parts)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(template: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """Parses a template into its literal text and placeholders. Parsing is cached, so a statement that appears in
+    several files (or is rendered with several translation maps) is only parsed once.
+
+    Returns:
+        A tuple of the literal parts of the template and the placeholder keys between them. There is always exactly one
+        more literal part than there are keys.
+    """
+    literals = []
+    keys = []
+    literal = []
+    position = 0
+    for mo in TemplateWithDefaultKey.pattern.finditer(template):
+        literal.append(template[position:mo.start()])
+        position = mo.end()
+        if mo.group('invalid') is not None:
+            # Same error as string.Template
+            lines = template[:mo.start('invalid')].splitlines(keepends=True)
+            colno = mo.start('invalid') - len(''.join(lines[:-1])) if lines else 1
+            raise ValueError(f'Invalid placeholder in string: line {len(lines) or 1}, col {colno}')
+        if mo.group('escaped') is not None:
+            # `$$` is an escaped dollar sign, which is part of the literal text
+            literal.append(TemplateWithDefaultKey.delimiter)
+            continue
+        literals.append(''.join(literal))
+        literal = []
+        keys.append(mo.group('named') or mo.group('braced'))
+    literal.append(template[position:])
+    literals.append(''.join(literal))
+    return tuple(literals), tuple(keys)
+
+
+def positive_int(astring: str) -> int:
+    value = int(astring)
+    if value < 1:
+        raise ArgumentTypeError(f"{astring} is not a positive number")
+    return value
+
+
+def positive_float(astring: str) -> float:
+    value = float(astring)
+    if value <= 0:
+        raise ArgumentTypeError(f"{astring} is not a positive number")
+    return value
+
+
+# The test files to load from a directory, when no `--include` pattern is given.
+DEFAULT_INCLUDE = ["*.sql"]
+
+
+def shard(astring: str) -> tuple[int, int]:
+    """Parses a shard in the form of INDEX/TOTAL, where INDEX is between 1 and TOTAL."""
+    try:
+        index, total = (int(part) for part in astring.split("/"))
+    except ValueError:
+        raise ArgumentTypeError(f"{astring} is not a valid shard. Use the form INDEX/TOTAL, e.g: 1/8")
+    if not 1 <= index <= total:
+        raise ArgumentTypeError(f"Shard index must be between 1 and {total}, got {index}")
+    return index, total
+
+
+BYTE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4, "PB": 1024 ** 5}
+
+
+def byte_size(astring: str) -> int:
+    """Parses a number of bytes, with an optional unit suffix, e.g: `1000000`, `500MB` or `2TB`."""
+    value = astring.strip().upper()
+    for unit in sorted(BYTE_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            value = value[:-len(unit)].strip()
+            multiplier = BYTE_UNITS[unit]
+            break
+    else:
+        multiplier = 1
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        raise ArgumentTypeError(f"{astring} is not a valid size in bytes")
+
+
+def format_bytes(num_bytes: Optional[int]) -> str:
+    if num_bytes is None:
+        return "n/a"
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.2f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.2f} PB"
+
+
+def percent(astring: str) -> float:
+    value = float(astring)
+    if not 0 < value <= 100:
+        raise ArgumentTypeError(f"{astring} is not a percentage between 0 (excluded) and 100")
+    return value
 
 
 def get_parser() -> ArgumentParser:
     arg_parser = ArgumentParser()
-    arg_parser.add_argument('--translation-file', required=False, help='The JSON translation file of tables',
-                            dest='translation_file')
+    arg_parser.add_argument('--translation-file', action='append', default=[], dest='translation_files',
+                            help="The JSON translation file of tables. Can be repeated to run the tests against "
+                                 "several environments at the same time, and compare their results side by side.")
     arg_parser.add_argument("TEST_FILE_OR_DIR_PATH", help="The test path. Can be directory of SQL files or a specific "
                                                           "file")
+    arg_parser.add_argument("--include", action='append', dest='include',
+                            help="Glob pattern of test files to load when TEST_FILE_OR_DIR_PATH is a directory, "
+                                 "matched against the path relative to the directory. Can be repeated. "
+                                 f"Defaults to {' '.join(DEFAULT_INCLUDE)}")
+    arg_parser.add_argument("--exclude", action='append', dest='exclude',
+                            help="Glob pattern of test files to leave out, even if they match `--include`. "
+                                 "Can be repeated. e.g: --exclude 'legacy/*'")
+    arg_parser.add_argument("--shard", type=shard, required=False, dest='shard',
+                            help="Only run a subset of the tests, in the form of INDEX/TOTAL (e.g: 1/8). "
+                                 "Running all shards from 1 to TOTAL runs every test exactly once. When "
+                                 "`--history-file` is given, tests are balanced between the shards by their expected "
+                                 "duration, in which case all shards must use the same history file.")
+    arg_parser.add_argument("--history-file", required=False, dest='history_file',
+                            help="The JSON file in which the duration and bytes processed of each test are recorded. "
+                                 "Tests expected to take the longest are started first. "
+                                 f"Defaults to {DEFAULT_HISTORY_FILE}")
+    arg_parser.add_argument("--affected-only", action='store_true', dest='affected_only',
+                            help="Only run the tests that reference at least one of the tables in the "
+                                 "`--translation-file`, i.e. the tables under change.")
+    arg_parser.add_argument("--list-affected", action='store_true', dest='list_affected',
+                            help="Print the tests that `--affected-only` would run, and the tables under change each "
+                                 "of them references, without running them.")
     arg_parser.add_argument("--project", help="The default project to use. "
                                               "Value must be set if not using a service account.",
                             required=False)
+    arg_parser.add_argument("--max-concurrency", type=positive_int, default=10, dest='max_concurrency',
+                            help="The maximum number of test queries to have in flight at the same time.")
+    arg_parser.add_argument("--poll-initial-interval", type=positive_float, default=0.1,
+                            dest='poll_initial_interval',
+                            help="Seconds to wait between the first check for query completion, made right after "
+                                 "the query is submitted, and the second one. The wait doubles after every check, up "
+                                 "to `--poll-max-interval`.")
+    arg_parser.add_argument("--poll-max-interval", type=positive_float, default=5.0, dest='poll_max_interval',
+                            help="The maximum number of seconds to wait between two checks for query completion.")
+    arg_parser.add_argument("--show-timings", action='store_true', dest='show_timings',
+                            help="Add a column to the results table with the submit, queue, execution and total "
+                                 "time of each test.")
+    arg_parser.add_argument("--preflight", action='store_true', dest='preflight',
+                            help="Dry-run all the tests before running them. If any test fails to validate, "
+                                 "(e.g. a syntax error or a table that does not exist), no test is run.")
+    arg_parser.add_argument("--preflight-only", action='store_true', dest='preflight_only',
+                            help="Only dry-run the tests, and report the bytes each test would process.")
+    arg_parser.add_argument("--max-bytes", type=byte_size, required=False, dest='max_bytes',
+                            help="Refuse to run the tests if all of them together would process more than this "
+                                 "number of bytes. Accepts unit suffixes, e.g: 500GB or 2TB. Implies `--preflight`.")
+    arg_parser.add_argument("--batch-size", type=positive_int, default=1, dest='batch_size',
+                            help="The number of tests to run together in a single script job. Batching saves the "
+                                 "per-job overhead of small tests, and uses fewer concurrent jobs of the quota.")
+    arg_parser.add_argument("--fail-fast", action='store_const', const=1, dest='max_failures',
+                            help="Stop on the first failed test. Same as `--max-failures 1`.")
+    arg_parser.add_argument("--max-failures", type=positive_int, required=False, dest='max_failures',
+                            help="Stop after this number of failed tests: jobs still running are cancelled (and "
+                                 "reported as CANCELLED), and tests not yet submitted are reported as SKIPPED.")
+    arg_parser.add_argument("--json-report", required=False, dest='json_report',
+                            help="Write the results, with the timings and job statistics (bytes processed and billed, "
+                                 "slot time, cache hit and timeline) of every test, to this JSON file.")
+    arg_parser.add_argument("--junit-xml", required=False, dest='junit_xml',
+                            help="Write the results as a JUnit XML file, for CI systems to display.")
+    arg_parser.add_argument("--top-expensive", type=int, default=5, dest='top_expensive',
+                            help="Print the given number of tests that billed the most bytes. 0 to disable.")
+    arg_parser.add_argument("--sample-percent", type=percent, required=False, dest='sample_percent',
+                            help="Run a quick, probabilistic, version of the tests, that only reads about this "
+                                 "percent of each table in the translation file (using TABLESAMPLE). Results are "
+                                 "flagged as sampled, and are not cached.")
+    arg_parser.add_argument("--full-run-on-pass", action='store_true', dest='full_run_on_pass',
+                            help="With `--sample-percent`, run the tests again on the full tables once all the "
+                                 "sampled tests have passed.")
+    arg_parser.add_argument("--no-cache", action='store_false', dest='use_cache',
+                            help="Run all the tests, even the ones that have passed before with the same SQL and the "
+                                 "same version of every table they read. Without it, finding the tables each test "
+                                 "reads costs a dry-run per test and a metadata request per table, on every run. "
+                                 "Tests that call a non-deterministic function (e.g. CURRENT_DATE() or RAND()) are "
+                                 "never cached.")
+    arg_parser.add_argument("--cache-file", default=DEFAULT_CACHE_FILE, dest='cache_file',
+                            help="The SQLite file in which passing results are cached.")
+    arg_parser.add_argument("--watch", action='store_true', dest='watch',
+                            help="Keep running: run the tests, then watch the test files and the translation file, "
+                                 "and run the tests of a file again as soon as it is saved. A change to the "
+                                 "translation file runs again the tests of the tables whose translation changed. "
+                                 "Every run of a file goes through the result cache, `--preflight`, `--max-bytes` "
+                                 "and `--affected-only` like a normal run. Stop with Ctrl+C.")
+    arg_parser.add_argument("--watch-interval", type=positive_float, default=DEFAULT_POLL_INTERVAL,
+                            dest='watch_interval',
+                            help="How often, in seconds, to check the watched files for changes.")
+    arg_parser.add_argument("--cache-max-entries", type=positive_int, default=DEFAULT_MAX_ENTRIES,
+                            dest='cache_max_entries',
+                            help="The maximum number of results to keep in the cache. The least recently used "
+                                 "results are evicted first.")
     return arg_parser
 
 
+@dataclasses.dataclass()
+class ProgramArguments:
+    translation_files: list[str]
+    test_file_path: str
+    include: Optional[list[str]]
+    exclude: Optional[list[str]]
+    shard: Optional[tuple[int, int]]
+    affected_only: bool
+    list_affected: bool
+    history_file: Optional[str]
+    project: Optional[str]
+    max_concurrency: int
+    poll_initial_interval: float
+    poll_max_interval: float
+    show_timings: bool
+    preflight: bool
+    preflight_only: bool
+    max_bytes: Optional[int]
+    batch_size: int
+    max_failures: Optional[int]
+    sample_percent: Optional[float]
+    full_run_on_pass: bool
+    json_report: Optional[str]
+    junit_xml: Optional[str]
+    top_expensive: int
+    use_cache: bool
+    cache_file: str
+    cache_max_entries: int
+    watch: bool
+    watch_interval: float
+
+    def __init__(self, ns: Namespace):
+        self.translation_files = ns.translation_files
+        self.test_file_path = ns.TEST_FILE_OR_DIR_PATH
+        self.include = ns.include
+        self.exclude = ns.exclude
+        self.shard = ns.shard
+        self.affected_only = ns.affected_only
+        self.list_affected = ns.list_affected
+        self.history_file = ns.history_file
+        self.project = ns.project
+        self.max_concurrency = ns.max_concurrency
+        self.poll_initial_interval = ns.poll_initial_interval
+        self.poll_max_interval = ns.poll_max_interval
+        self.show_timings = ns.show_timings
+        self.preflight = ns.preflight or ns.preflight_only or ns.max_bytes is not None
+        self.preflight_only = ns.preflight_only
+        self.max_bytes = ns.max_bytes
+        self.batch_size = ns.batch_size
+        self.max_failures = ns.max_failures
+        self.sample_percent = ns.sample_percent
+        self.full_run_on_pass = ns.full_run_on_pass
+        self.json_report = ns.json_report
+        self.junit_xml = ns.junit_xml
+        self.top_expensive = ns.top_expensive
+        self.use_cache = ns.use_cache
+        self.cache_file = ns.cache_file
+        self.cache_max_entries = ns.cache_max_entries
+        self.watch = ns.watch
+        self.watch_interval = ns.watch_interval
+
+
 def read_json_as_dict(translation_file: str) -> dict[str:str]:
     with open(translation_file, 'r') as fp:
         translations = json.load(fp)
     return translations
 
 
+def environment_names(translation_files: list[str]) -> list[str]:
+    """Names each environment after its translation file, without the directory and the extension (e.g. `prod` for
+    `translations/prod.json`). The paths are used as is when that would give two environments the same name.
+    """
+    names = [os.path.splitext(os.path.basename(translation_file))[0] for translation_file in translation_files]
+    return names if len(set(names)) == len(names) else list(translation_files)
+
+
 def create_bigquery_client(project: str) -> bigquery.Client:
-    client = bigquery.Client(project=project)
+    # The backend is the real BigQuery, unless another one is selected with the `CI_FOR_DATA_BACKEND` variable.
+    client = create_client(project)
     return client
 
 
-def get_tests_to_run_from_file(test_file_path: str, translations: dict[str:str]) -> dict[str:str]:
-    basename = os.path.splitext(os.path.basename(test_file_path))[0]
-    with open(test_file_path) as fp:
-        sql_content = " ".join(fp.readlines())
-    sql_queries = list(
-        map(lambda x: f"{x};",
-            filter(lambda x: len(x) > 0,
-                   sql_content.strip().split(";"))))
+def get_tests_to_run_from_file(test_file_path: str, translations: dict[str:str],
+                               test_name: Optional[str] = None) -> dict[str:str]:
+    """Loads the tests of a single SQL file. Each statement in the file is a test, named `<test_name>_<i>`.
+
+    Args:
+        test_file_path: The path of the SQL file
+        translations: The translation map of tables
+        test_name: The prefix of the test names. Defaults to the name of the file, without the extension.
+    """
+    return render_tests(load_test_templates_from_file(test_file_path, test_name), translations)
+
+
+def load_test_templates_from_file(test_file_path: str, test_name: Optional[str] = None) -> dict[str, str]:
+    """Loads the statements of a single SQL file, before translation. See `get_tests_to_run_from_file`."""
+    basename = test_name or os.path.splitext(os.path.basename(test_file_path))[0]
     results = {}
-    for i, sql_query_raw in enumerate(sql_queries):
-        key_name = f"{basename}_{i}"
-        query_template = TemplateWithDefaultKey(sql_query_raw)
-        query = query_template.substitute(translations)
-        results[key_name] = query
+    with open(test_file_path) as fp:
+        for i, sql_query_raw in enumerate(iter_sql_statements(fp)):
+            results[f"{basename}_{i}"] = sql_query_raw
     return results
 
 
-def get_tests_to_run(test_file_path: str, translations: dict[str:str]) -> dict[str:str]:
+def render_tests(test_templates: dict[str, str], translations: dict[str, str],
+                 sample_percent: Optional[float] = None) -> dict[str, str]:
+    """Translates the tables in the statements of the tests. If `sample_percent` is given, translated tables are only
+    sampled, see `TemplateWithDefaultKey.substitute_sampled`.
+    """
+    if sample_percent is not None:
+        return {key_name: TemplateWithDefaultKey(sql_query_raw).substitute_sampled(translations, sample_percent)
+                for key_name, sql_query_raw in test_templates.items()}
+    return {key_name: TemplateWithDefaultKey(sql_query_raw).substitute(translations)
+            for key_name, sql_query_raw in test_templates.items()}
+
+
+def matches_any(path: str, patterns: list[str]) -> bool:
+    return any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def discover_test_files(test_dir_path: str, include: Optional[list[str]] = None,
+                        exclude: Optional[list[str]] = None) -> list[str]:
+    """Finds the test files under a directory, recursively. Hidden files and directories are ignored.
+
+    Args:
+        test_dir_path: The directory to search in
+        include: Glob patterns of the files to include, matched against the path relative to `test_dir_path` (a `*`
+            also matches `/`, so `*.sql` matches SQL files at any depth). Defaults to `DEFAULT_INCLUDE`.
+        exclude: Glob patterns of files to leave out, even if they match `include`
+
+    Returns:
+        The paths of the test files, relative to `test_dir_path` and using `/` as a separator, in sorted order.
+    """
+    include = include or DEFAULT_INCLUDE
+    exclude = exclude or []
+    test_files = []
+    for dir_path, dir_names, file_names in os.walk(test_dir_path):
+        dir_names[:] = [dir_name for dir_name in dir_names if not dir_name.startswith(".")]
+        relative_dir = os.path.relpath(dir_path, test_dir_path)
+        for file_name in file_names:
+            if file_name.startswith("."):
+                continue
+            relative_path = file_name if relative_dir == os.curdir else f"{relative_dir}/{file_name}"
+            relative_path = relative_path.replace(os.sep, "/")
+            if matches_any(relative_path, include) and not matches_any(relative_path, exclude):
+                test_files.append(relative_path)
+    return sorted(test_files)
+
+
+def get_tests_to_run(test_file_path: str, translations: dict[str:str], include: Optional[list[str]] = None,
+                     exclude: Optional[list[str]] = None) -> dict[str:str]:
+    """Loads the tests from a single SQL file, or from all the SQL files under a directory.
+
+    Tests in a sub-directory are named after their path relative to `test_file_path`, e.g: `orders/status_is_valid_0`.
+    """
+    return render_tests(load_test_templates(test_file_path, include, exclude), translations)
+
+
+def load_test_templates(test_file_path: str, include: Optional[list[str]] = None,
+                        exclude: Optional[list[str]] = None) -> dict[str, str]:
+    """Loads the statements of the tests, before translation. See `get_tests_to_run`."""
     if not os.path.exists(test_file_path):
         raise Exception(f"{test_file_path} does not exists")
-    if os.path.isfile(test_file_path):
-        test_result = get_tests_to_run_from_file(test_file_path, translations)
-        return test_result
-    assert os.path.isdir(test_file_path)
     results = {}
-    for file in os.listdir(test_file_path):
-        results.update(get_tests_to_run_from_file(os.path.join(test_file_path, file), translations))
+    for path, test_name in test_file_names(test_file_path, include, exclude).items():
+        results.update(load_test_templates_from_file(path, test_name=test_name))
     return results
 
 
+def test_file_names(test_file_path: str, include: Optional[list[str]] = None,
+                    exclude: Optional[list[str]] = None) -> dict[str, Optional[str]]:
+    """Finds the test files of a single SQL file, or of a directory.
+
+    Returns:
+        The prefix of the test names of each test file, keyed by path. None to name the tests after the file.
+    """
+    if os.path.isfile(test_file_path):
+        return {test_file_path: None}
+    if not os.path.isdir(test_file_path):
+        return {}
+    return {os.path.join(test_file_path, relative_path): os.path.splitext(relative_path)[0]
+            for relative_path in discover_test_files(test_file_path, include, exclude)}
+
+
+def build_table_index(test_templates: dict[str, str]) -> dict[str, list[str]]:
+    """Builds an index of the tests that reference each table, from the `${...}` placeholders in the statements.
+
+    Returns:
+        A dictionary of placeholder key (e.g: `dataset.table`) to the names of the tests that reference it, in load
+        order.
+    """
+    index = {}
+    for key_name, sql_query_raw in test_templates.items():
+        _, keys = compile_template(sql_query_raw)
+        for key in dict.fromkeys(keys):
+            index.setdefault(key, []).append(key_name)
+    return index
+
+
+def select_affected_tests(test_templates: dict[str, str], translations: dict[str, str]) -> dict[str, list[str]]:
+    """Selects the tests that reference at least one table of the translation map, i.e. a table under change.
+
+    Returns:
+        A dictionary of the name of each affected test to the translated tables it references, in load order.
+    """
+    affected = {}
+    for table, key_names in build_table_index(test_templates).items():
+        if table in translations:
+            for key_name in key_names:
+                affected.setdefault(key_name, []).append(table)
+    return {key_name: affected[key_name] for key_name in test_templates if key_name in affected}
+
+
+def shard_tests(tests_to_run: dict[str, str], shard_index: int, shard_total: int,
+                expected_durations: Optional[dict[str, float]] = None) -> dict[str, str]:
+    """Selects the tests of one shard (1-based).
+
+    Without `expected_durations`, tests are dealt round-robin in their load order. With them, each test, from the
+    longest to the shortest, goes to the shard with the least expected time so far, so all shards finish at about the
+    same time. Between shards with the same expected time (e.g. when the history is still empty, and every test is
+    expected to take 0 seconds), the one with the fewest tests wins. Either way the selection only depends on its
+    inputs, so every CI node that loads the same tests (and the same history) gets the same, disjoint, subset of them.
+    """
+    if expected_durations is None:
+        return {key_name: query for i, (key_name, query) in enumerate(tests_to_run.items())
+                if i % shard_total == shard_index - 1}
+    shard_durations = [0.0] * shard_total
+    shard_counts = [0] * shard_total
+    selected = set()
+    for key_name in longest_first(tests_to_run, expected_durations):
+        shard_i = min(range(shard_total), key=lambda i: (shard_durations[i], shard_counts[i]))
+        shard_durations[shard_i] += expected_durations[key_name]
+        shard_counts[shard_i] += 1
+        if shard_i == shard_index - 1:
+            selected.add(key_name)
+    return {key_name: query for key_name, query in tests_to_run.items() if key_name in selected}
+
+
+def longest_first(tests_to_run: dict[str, str], expected_durations: dict[str, float]) -> dict[str, str]:
+    """Orders the tests from the longest expected to the shortest. Tests that are expected to take the same time keep
+    their load order.
+    """
+    order = sorted(enumerate(tests_to_run), key=lambda item: (-expected_durations[item[1]], item[0]))
+    return {key_name: tests_to_run[key_name] for _, key_name in order}
+
+
 def r_pad(s: str, str_len: int, char: str = " ") -> str:
     base_len = len(s)
     spaces = char * max(str_len - base_len, 0)
     return s + spaces
 
 
-async def result_with_key(query: str, bigquery_client: bigquery.Client):
+# The result of a test whose job was cancelled while running, and of a test that was never submitted, after the maximum
+# number of failures was reached.
+CANCELLED = "CANCELLED"
+SKIPPED = "SKIPPED"
+
+
+@dataclasses.dataclass()
+class TestTimings:
+    """Wall-clock breakdown of a single test, in seconds.
+
+    `queue` and `execution` are taken from the job statistics reported by BigQuery, and are None when the job did not
+    report them (e.g. the query failed before it started). For a test run in a batch, they are those of its own child
+    jobs, see `child_jobs_timings`.
+    """
+    submit: float
+    queue: Optional[float]
+    execution: Optional[float]
+    total: float
+
+    def __str__(self):
+        def fmt(value: Optional[float]) -> str:
+            return f"{value:7.2f}" if value is not None else "    n/a"
+
+        return f"submit {fmt(self.submit)}  queue {fmt(self.queue)}  exec {fmt(self.execution)}  " \
+               f"total {fmt(self.total)}"
+
+
+@dataclasses.dataclass()
+class JobStatistics:
+    """The statistics BigQuery reports for the job(s) of a single test."""
+    job_id: Optional[str]
+    bytes_processed: Optional[int]
+    bytes_billed: Optional[int]
+    slot_millis: Optional[int]
+    cache_hit: Optional[bool]
+    # Each entry is a sample of the progress of the query, see `google.cloud.bigquery.job.TimelineEntry`
+    timeline: list[dict] = dataclasses.field(default_factory=list)
+
+
+def job_statistics(jobs: list[bigquery.QueryJob]) -> JobStatistics:
+    """Collects the statistics of the job(s) of a test. A test run as part of a batch can have several child jobs, in
+    which case their statistics are summed up.
+    """
+
+    def total(values: list[Optional[int]]) -> Optional[int]:
+        values = [value for value in values if value is not None]
+        return sum(values) if values else None
+
+    cache_hits = [job.cache_hit for job in jobs if job.cache_hit is not None]
+    return JobStatistics(
+        job_id=",".join(job.job_id for job in jobs if job.job_id) or None,
+        bytes_processed=total([job.total_bytes_processed for job in jobs]),
+        bytes_billed=total([job.total_bytes_billed for job in jobs]),
+        slot_millis=total([job.slot_millis for job in jobs]),
+        cache_hit=all(cache_hits) if cache_hits else None,
+        timeline=[{"elapsed_ms": entry.elapsed_ms, "active_units": entry.active_units,
+                   "pending_units": entry.pending_units, "completed_units": entry.completed_units,
+                   "slot_millis": entry.slot_millis}
+                  for job in jobs for entry in (job.timeline or [])])
+
+
+@dataclasses.dataclass()
+class TestResult:
+    """The outcome of a single test. `message` is "OK" if the test passed, CANCELLED or SKIPPED if it was stopped by
+    `--fail-fast` or `--max-failures`, or the error message otherwise.
+    """
+    message: str
+    timings: Optional[TestTimings] = None
+    cached: bool = False
+    statistics: Optional[JobStatistics] = None
+    # Set when the test ran on a sample of the translated tables, see `--sample-percent`
+    sample_percent: Optional[float] = None
+
+    def __str__(self):
+        if self.cached:
+            return f"{self.message} (cached)"
+        if self.sample_percent is not None:
+            return f"{self.message} (sampled {self.sample_percent:g}%)"
+        return self.message
+
+    @property
+    def passed(self) -> bool:
+        return self.message == "OK"
+
+    @property
+    def failed(self) -> bool:
+        return self.message not in ("OK", CANCELLED, SKIPPED)
+
+    @property
+    def bytes_processed(self) -> Optional[int]:
+        return self.statistics.bytes_processed if self.statistics else None
+
+
+def poll_intervals(initial_interval: float, max_interval: float) -> Iterator[float]:
+    """Generates the waiting times between two completion checks of a job. Starts at `initial_interval` and doubles
+    on every check, up to `max_interval`.
+    """
+    interval = initial_interval
+    while True:
+        yield min(interval, max_interval)
+        interval *= 2
+
+
+async def wait_for_job(job: bigquery.QueryJob, poll_initial_interval: float, poll_max_interval: float,
+                       stop_event: Optional[asyncio.Event] = None) -> bool:
+    """Waits for a job to complete. The job is checked right away, as a query answered from the BigQuery cache is
+    already done, then after each interval of `poll_intervals`. If `stop_event` is set before the job completes, the
+    job is cancelled.
+
+    Returns:
+        True if the job completed, False if it was cancelled.
+    """
+    intervals = poll_intervals(poll_initial_interval, poll_max_interval)
+    while not await asyncio.to_thread(job.done):
+        if stop_event is None:
+            await asyncio.sleep(next(intervals))
+            continue
+        if not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=next(intervals))
+            except asyncio.TimeoutError:
+                continue
+        await asyncio.to_thread(job.cancel)
+        return False
+    return True
+
+
+def job_timings(job: bigquery.QueryJob, started_at: float, submitted_at: float, ended_at: float) -> TestTimings:
+    queue = None
+    execution = None
+    if job is not None and job.created and job.started:
+        queue = (job.started - job.created).total_seconds()
+    if job is not None and job.started and job.ended:
+        execution = (job.ended - job.started).total_seconds()
+    return TestTimings(submit=submitted_at - started_at, queue=queue, execution=execution,
+                       total=ended_at - started_at)
+
+
+def child_jobs_timings(child_jobs: list[bigquery.QueryJob], submit: float, script_total: float) -> TestTimings:
+    """Timings of a test run in a batch, from its own child jobs rather than from the whole script job: from the
+    creation of its first child job to the end of its last one. `submit` is the time it took to submit the script. The
+    total falls back to `script_total` if the child jobs did not report their times.
+    """
+    created = min((job.created for job in child_jobs if job.created), default=None)
+    started = min((job.started for job in child_jobs if job.started), default=None)
+    ended = max((job.ended for job in child_jobs if job.ended), default=None)
+    return TestTimings(submit=submit,
+                       queue=(started - created).total_seconds() if created and started else None,
+                       execution=(ended - started).total_seconds() if started and ended else None,
+                       total=(ended - created).total_seconds() if created and ended else script_total)
+
+
+async def result_with_key(query: str, bigquery_client: bigquery.Client, poll_initial_interval: float = 0.1,
+                          poll_max_interval: float = 5.0, stop_event: Optional[asyncio.Event] = None) -> TestResult:
+    # The client calls are blocking HTTP requests, so they are pushed to the executor to keep the event loop free for
+    # the other tests in flight.
+    started_at = time.monotonic()
+    submitted_at = started_at
+    job = None
     try:
-        job = bigquery_client.query(query)
-        while not job.done():
-            await asyncio.sleep(1)
+        job = await asyncio.to_thread(bigquery_client.query, query)
+        submitted_at = time.monotonic()
+        if not await wait_for_job(job, poll_initial_interval, poll_max_interval, stop_event):
+            return TestResult(message=CANCELLED)
         if job.error_result:
-            return job.error_result['message']
+            message = job.error_result['message']
         else:
-            return "OK"
+            message = "OK"
     except BadRequest as br:
-        return br.errors[0]['message']
+        message = br.errors[0]['message']
     except Exception as e:
-        return str(e)
+        message = str(e)
+    return TestResult(message=message, timings=job_timings(job, started_at, submitted_at, time.monotonic()),
+                      statistics=job_statistics([job]) if job is not None else None)
+
 
+@dataclasses.dataclass()
+class DryRunResult:
+    message: str
+    bytes_processed: Optional[int] = None
+    referenced_tables: list[str] = dataclasses.field(default_factory=list)
 
-async def run(translation_file: str, test_file_path: Optional[str], project: str) -> int:
+    @property
+    def passed(self) -> bool:
+        return self.message == "OK"
+
+
+async def dry_run_with_key(query: str, bigquery_client: bigquery.Client) -> DryRunResult:
+    # A dry-run job is validated and planned synchronously by BigQuery, so there is nothing to poll.
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    try:
+        job = await asyncio.to_thread(bigquery_client.query, query, job_config=job_config)
+        return DryRunResult(message="OK", bytes_processed=job.total_bytes_processed,
+                            referenced_tables=[f"{t.project}.{t.dataset_id}.{t.table_id}"
+                                               for t in job.referenced_tables])
+    except BadRequest as br:
+        return DryRunResult(message=br.errors[0]['message'])
+    except Exception as e:
+        return DryRunResult(message=str(e))
+
+
+async def dry_run_tests(tests_to_run: dict[str, str], bigquery_client: bigquery.Client,
+                        max_concurrency: int) -> dict[str, DryRunResult]:
+    """Dry-runs all the tests, with at most `max_concurrency` requests in flight at any time.
+
+    Args:
+        tests_to_run: A dictionary of test name to the SQL query to validate
+        bigquery_client: The client used to submit the dry-run queries
+        max_concurrency: The maximum number of dry-run requests to send at the same time
+
+    Returns:
+        A dictionary of test name to dry-run result, in the same order as `tests_to_run`
     """
-    Main entry point
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def bounded_dry_run_with_key(query: str):
+        async with semaphore:
+            return await dry_run_with_key(query=query, bigquery_client=bigquery_client)
+
+    results = await asyncio.gather(*[bounded_dry_run_with_key(query) for query in tests_to_run.values()])
+    return dict(zip(tests_to_run.keys(), results))
+
+
+def print_dry_run_table(results: dict[str, DryRunResult]):
+    max_test_name = max([len('Test Name')] + [len(key_name) for key_name in results])
+    bytes_width = 12
+    print(f"{r_pad('Test Name', max_test_name)} | {r_pad('Bytes', bytes_width)} | Preflight")
+    print(f"{r_pad('', max_test_name, '-')}-+-{r_pad('', bytes_width, '-')}-+-------------------------")
+    for key_name, res in results.items():
+        print(f"{r_pad(key_name, max_test_name)} | {r_pad(format_bytes(res.bytes_processed), bytes_width)} | "
+              f"{res.message}")
+    total_bytes = sum(res.bytes_processed or 0 for res in results.values())
+    print(f"{r_pad('Total', max_test_name)} | {format_bytes(total_bytes)}")
+
+
+async def get_tables_modified(table_ids: set[str], bigquery_client: bigquery.Client,
+                              max_concurrency: int) -> dict[str, Optional[str]]:
+    """Fetches the last modification time of each table, as an ISO formatted string. Tables that could not be fetched
+    map to None.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def bounded_get_modified(table_id: str) -> Optional[str]:
+        async with semaphore:
+            try:
+                table = await asyncio.to_thread(bigquery_client.get_table, table_id)
+            except Exception:
+                return None
+            return table.modified.isoformat() if table.modified else None
+
+    table_ids = sorted(table_ids)
+    modified = await asyncio.gather(*[bounded_get_modified(table_id) for table_id in table_ids])
+    return dict(zip(table_ids, modified))
+
+
+async def get_cache_keys(tests_to_run: dict[str, str], dry_run_results: dict[str, DryRunResult],
+                         bigquery_client: bigquery.Client, max_concurrency: int) -> dict[str, str]:
+    """Computes the result cache key of every test that passed the dry-run. The key is made of the rendered query and
+    the last modification time of every table the query reads, so it changes whenever the test or its data changes.
+    Tests that call a non-deterministic function (e.g. `CURRENT_DATE()`), see `is_cacheable`, are never cached.
+
+    Returns:
+        A dictionary of test name to cache key. Tests that can not be cached are left out.
     """
-    translations = read_json_as_dict(translation_file) if translation_file else {}
-    bigquery_client = create_bigquery_client(project)
-    tests_to_run = get_tests_to_run(test_file_path, translations)
-    max_test_name = max(map(lambda x: len(x), tests_to_run.keys()))
-    print(f"{r_pad('Test Name', max_test_name)} | Result")
-    print(f"{r_pad('', max_test_name, '-')}-+-------------------------")
-    exit_code = 0
+    cacheable = {key_name for key_name, query in tests_to_run.items()
+                 if dry_run_results[key_name].passed and is_cacheable(query)}
+    table_ids = {table_id for key_name in cacheable for table_id in dry_run_results[key_name].referenced_tables}
+    tables_modified = await get_tables_modified(table_ids, bigquery_client, max_concurrency)
+    keys = {}
     for key_name, query in tests_to_run.items():
-        res = await result_with_key(query=query, bigquery_client=bigquery_client)
-        if res != "OK":
-            exit_code = 2
-        print(f"{r_pad(key_name, max_test_name)} | {res}")
-    return exit_code
+        res = dry_run_results[key_name]
+        if key_name not in cacheable:
+            continue
+        table_versions = [f"{table_id}@{tables_modified[table_id]}" for table_id in res.referenced_tables]
+        if any(tables_modified[table_id] is None for table_id in res.referenced_tables):
+            continue
+        keys[key_name] = cache_key(query, table_versions)
+    return keys
+
+
+def batch_script(batch: dict[str, str]) -> tuple[str, dict[str, tuple[int, int]]]:
+    """Wraps several tests into a single BigQuery script. Each test is placed in its own BEGIN...EXCEPTION block, so a
+    failing test does not stop the tests that come after it.
+
+    Args:
+        batch: A dictionary of test name to the SQL query of the test
+
+    Returns:
+        A tuple of the script, and a dictionary of test name to the first and last line (1-based) of the test in the
+        script.
+    """
+    lines = []
+    line_ranges = {}
+    for key_name, query in batch.items():
+        lines.append("BEGIN")
+        first_line = len(lines) + 1
+        lines.extend(query.strip().split("\n"))
+        line_ranges[key_name] = (first_line, len(lines))
+        lines.append("EXCEPTION WHEN ERROR THEN")
+        lines.append("  SELECT @@error.message;")
+        lines.append("END;")
+    return "\n".join(lines), line_ranges
+
+
+def child_job_line(child_job: bigquery.QueryJob) -> Optional[int]:
+    # The last stack frame is the one of the script itself, even when the statement was run inside a procedure.
+    script_statistics = child_job.script_statistics
+    if script_statistics is None or not script_statistics.stack_frames:
+        return None
+    return script_statistics.stack_frames[-1].start_line
+
+
+async def batch_results_with_keys(batch: dict[str, str], bigquery_client: bigquery.Client,
+                                  poll_initial_interval: float = 0.1, poll_max_interval: float = 5.0,
+                                  stop_event: Optional[asyncio.Event] = None) -> dict[str, TestResult]:
+    """Runs several tests as a single script job, and attributes the child jobs of the script back to the tests.
+
+    Tests that could not be attributed to a child job (e.g. when the whole script failed to compile) are run again one
+    by one, so that each of them gets its own result.
+    """
+    started_at = time.monotonic()
+    script, line_ranges = batch_script(batch)
+    results = {}
+    try:
+        job = await asyncio.to_thread(bigquery_client.query, script)
+        submitted_at = time.monotonic()
+        if not await wait_for_job(job, poll_initial_interval, poll_max_interval, stop_event):
+            return {key_name: TestResult(message=CANCELLED) for key_name in batch}
+        child_jobs = await asyncio.to_thread(lambda: list(bigquery_client.list_jobs(parent_job=job)))
+        for key_name, (first_line, last_line) in line_ranges.items():
+            test_jobs = [child_job for child_job in child_jobs
+                         if first_line <= (child_job_line(child_job) or 0) <= last_line]
+            if not test_jobs:
+                continue
+            failed_jobs = [child_job for child_job in test_jobs if child_job.error_result]
+            message = failed_jobs[0].error_result['message'] if failed_jobs else "OK"
+            timings = child_jobs_timings(test_jobs, submitted_at - started_at, time.monotonic() - started_at)
+            results[key_name] = TestResult(message=message, timings=timings, statistics=job_statistics(test_jobs))
+    except Exception:
+        # Any problem with the script job itself is handled by the fallback below.
+        pass
+    for key_name in batch:
+        if key_name in results:
+            continue
+        if stop_event is not None and stop_event.is_set():
+            results[key_name] = TestResult(message=SKIPPED)
+        else:
+            results[key_name] = await result_with_key(batch[key_name], bigquery_client, poll_initial_interval,
+                                                      poll_max_interval, stop_event)
+    return {key_name: results[key_name] for key_name in batch}
+
+
+async def run_tests_concurrently(tests_to_run: dict[str, str], bigquery_client: bigquery.Client,
+                                 max_concurrency: int, poll_initial_interval: float = 0.1,
+                                 poll_max_interval: float = 5.0, batch_size: int = 1,
+                                 max_failures: Optional[int] = None, stop_event: Optional[asyncio.Event] = None,
+                                 semaphore: Optional[asyncio.Semaphore] = None) -> dict[str, TestResult]:
+    """Runs all the tests, with at most `max_concurrency` queries in flight at any time.
+
+    Results are printed as soon as each test completes. When `batch_size` is more than 1, tests are grouped into script
+    jobs of up to `batch_size` tests each, and each script job counts as a single query in flight.
+    Once `max_failures` tests have failed, the jobs still running are cancelled and the tests not yet submitted are
+    skipped.
+
+    Args:
+        tests_to_run: A dictionary of test name to the SQL query to run
+        bigquery_client: The client used to submit the queries
+        max_concurrency: The maximum number of queries to run at the same time
+        poll_initial_interval: Seconds to wait between the first completion check of each query, made right after it
+            is submitted, and the second one
+        poll_max_interval: Maximum seconds to wait between two completion checks of each query
+        batch_size: The number of tests to run in each query job
+        max_failures: The number of failed tests after which to stop. None to run all the tests.
+        stop_event: Stops the tests when set, as when `max_failures` is reached. A new event is used if not given.
+        semaphore: Limits the number of queries in flight, shared with other runs. A new one, allowing
+            `max_concurrency` queries, is used if not given.
+
+    Returns:
+        A dictionary of test name to result, in the same order as `tests_to_run`
+    """
+    semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+    stop_event = stop_event or asyncio.Event()
+
+    async def bounded_results_with_keys(batch: dict[str, str]) -> dict[str, TestResult]:
+        async with semaphore:
+            if stop_event.is_set():
+                return {key_name: TestResult(message=SKIPPED) for key_name in batch}
+            if len(batch) > 1:
+                return await batch_results_with_keys(batch, bigquery_client,
+                                                     poll_initial_interval=poll_initial_interval,
+                                                     poll_max_interval=poll_max_interval, stop_event=stop_event)
+            (key_name, query), = batch.items()
+            return {key_name: await result_with_key(query=query, bigquery_client=bigquery_client,
+                                                    poll_initial_interval=poll_initial_interval,
+                                                    poll_max_interval=poll_max_interval, stop_event=stop_event)}
+
+    tests = list(tests_to_run.items())
+    batches = [dict(tests[i:i + batch_size]) for i in range(0, len(tests), batch_size)]
+    results = {}
+    failures = 0
+    # Tasks are created in order, so that they acquire the semaphore in the order of `tests_to_run` (e.g. longest
+    # first). `as_completed` would otherwise wrap bare coroutines into tasks in an arbitrary order.
+    pending = [asyncio.create_task(bounded_results_with_keys(batch)) for batch in batches]
+    for completed in asyncio.as_completed(pending):
+        for key_name, res in (await completed).items():
+            results[key_name] = res
+            print(f"[{len(results)}/{len(tests_to_run)}] {key_name}: {res}")
+            failures += res.failed
+            if max_failures is not None and failures >= max_failures and not stop_event.is_set():
+                print(f"Reached the maximum number of failed tests ({max_failures}), cancelling the remaining tests")
+                stop_event.set()
+    return {key_name: results[key_name] for key_name in tests_to_run}
+
+
+async def run(args: ProgramArguments) -> int:
+    """
+    Main entry point
+    """
+    # The default executor is sized by CPU count, which would cap the number of queries in flight.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.max_concurrency))
+    translation_files = ", ".join(args.translation_files)
+    # The suite is loaded (and each statement parsed) once, and rendered for each environment.
+    environments = {name: TranslationMap(read_json_as_dict(translation_file))
+                    for name, translation_file in zip(environment_names(args.translation_files),
+                                                      args.translation_files)}
+    translations = next(iter(environments.values())) if len(environments) == 1 else TranslationMap({})
+    test_templates = load_test_templates(args.test_file_path, include=args.include, exclude=args.exclude)
+    if args.affected_only or args.list_affected:
+        # With several environments, a test is affected if it references a table under change in any of them.
+        affected = {}  # type: dict[str, list[str]]
+        for environment in environments.values():
+            for key_name, tables in select_affected_tests(test_templates, environment).items():
+                affected[key_name] = list(dict.fromkeys(affected.get(key_name, []) + tables))
+        affected = {key_name: affected[key_name] for key_name in test_templates if key_name in affected}
+        if args.list_affected:
+            print(f"{len(affected)} of {len(test_templates)} tests reference a table in {translation_files}:")
+            for key_name, tables in affected.items():
+                print(f"{key_name}: {', '.join(tables)}")
+            return 0
+        print(f"Running the {len(affected)} of {len(test_templates)} tests that reference a table in "
+              f"{translation_files}")
+        test_templates = {key_name: test_templates[key_name] for key_name in affected}
+    bigquery_client = create_bigquery_client(args.project)
+    history = RunHistory(args.history_file or DEFAULT_HISTORY_FILE)
+    expected_durations = history.expected_durations(test_templates)
+    if args.shard:
+        # A local default history differs between machines, so it can only be used to balance shards when all the
+        # shards were explicitly given the same file.
+        test_templates = shard_tests(test_templates, *args.shard,
+                                     expected_durations=expected_durations if args.history_file else None)
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: running {len(test_templates)} tests")
+    if args.sample_percent is not None:
+        print(f"Sampled run, reading about {args.sample_percent:g}% of each table in the translation file")
+        tests_to_run = render_tests(test_templates, translations, sample_percent=args.sample_percent)
+        exit_code = await run_rendered_tests(args, tests_to_run, bigquery_client, history, expected_durations,
+                                             sample_percent=args.sample_percent)
+        if exit_code != 0 or not args.full_run_on_pass:
+            return exit_code
+        print()
+        print("Sampled run passed, running the tests on the full tables")
+    if len(environments) > 1:
+        return await run_matrix(args, test_templates, environments, bigquery_client, history, expected_durations)
+    tests_to_run = render_tests(test_templates, translations)
+    return await run_rendered_tests(args, tests_to_run, bigquery_client, history, expected_durations)
+
+
+async def run_matrix(args: ProgramArguments, test_templates: dict[str, str], environments: dict[str, TranslationMap],
+                     bigquery_client: bigquery.Client, history: RunHistory,
+                     expected_durations: dict[str, float]) -> int:
+    """Runs the tests against several environments at the same time, and prints their results side by side.
+
+    The tests of all the environments are run together, named `ENVIRONMENT/TEST`, so they share the client and the
+    `--max-concurrency` limit, and a slow environment does not hold back the others.
+    """
+    tests_to_run = {}
+    matrix_names = {}  # type: dict[str, tuple[str, str]]
+    for environment, translations in environments.items():
+        for key_name, query in render_tests(test_templates, translations).items():
+            tests_to_run[f"{environment}/{key_name}"] = query
+            matrix_names[f"{environment}/{key_name}"] = (environment, key_name)
+    print(f"Running {len(test_templates)} tests against {len(environments)} environments: {', '.join(environments)}")
+    expected_durations = {name: expected_durations[key_name] for name, (_, key_name) in matrix_names.items()}
+    return await run_rendered_tests(args, tests_to_run, bigquery_client, history, expected_durations,
+                                    matrix_names=matrix_names)
+
+
+def read_translations(translation_files: list[str]) -> TranslationMap:
+    return TranslationMap(read_json_as_dict(translation_files[0]) if translation_files else {})
+
+
+def changed_translations(test_templates: dict[str, str], previous: TranslationMap,
+                         translations: TranslationMap) -> set[str]:
+    """Returns the tests that reference a table whose translation is not the same in `previous` and `translations`."""
+    return {key_name for table, key_names in build_table_index(test_templates).items()
+            if previous.get(table) != translations.get(table) for key_name in key_names}
+
+
+async def watch_tests(args: ProgramArguments) -> int:
+    """Runs the tests, then runs again the tests of every test file that changes, until interrupted.
+
+    A single client is used for the whole session. Each file runs on its own, so that a change to a file only cancels
+    the jobs of the previous version of that file, but all of them share the `--max-concurrency` limit.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.max_concurrency))
+    bigquery_client = create_bigquery_client(args.project)
+    semaphore = asyncio.Semaphore(args.max_concurrency)
+    history = RunHistory(args.history_file or DEFAULT_HISTORY_FILE)
+    translations = read_translations(args.translation_files)
+    test_templates = {}  # type: dict[str, dict[str, str]]
+    # The task, the cancel event and the tests of the run of each file
+    runs = {}  # type: dict[str, tuple[asyncio.Task, asyncio.Event, set[str]]]
+
+    async def run_file(path: str, tests_to_run: dict[str, str], cancel_event: asyncio.Event):
+        await run_rendered_tests(args, tests_to_run, bigquery_client, history,
+                                 history.expected_durations(tests_to_run), cancel_event=cancel_event,
+                                 semaphore=semaphore)
+        if not cancel_event.is_set():
+            print(f"Ran the tests of {path}. Watching for changes, press Ctrl+C to stop.")
+
+    def start(path: str, key_names: Optional[set[str]] = None):
+        """Runs the tests of a file, or only `key_names` if given, after cancelling its previous run. Nothing is done
+        (and the previous run goes on) when none of the tests of the file is to be run.
+        """
+        templates = test_templates[path]
+        if args.affected_only:
+            templates = {key_name: templates[key_name] for key_name in select_affected_tests(templates, translations)}
+        if key_names is not None:
+            if not key_names & set(templates):
+                return
+            if path in runs and not runs[path][0].done():
+                # The tests of the previous run can not be told apart from those that are done, they all run again.
+                key_names = key_names | runs[path][2]
+            templates = {key_name: template for key_name, template in templates.items() if key_name in key_names}
+        if not templates:
+            return
+        stop(path)
+        cancel_event = asyncio.Event()
+        runs[path] = (asyncio.create_task(run_file(path, render_tests(templates, translations), cancel_event)),
+                      cancel_event, set(templates))
+
+    def stop(path: str):
+        if path in runs:
+            task, cancel_event, _ = runs.pop(path)
+            if not task.done():
+                print(f"Cancelling the tests still running from the previous run of {path}")
+                cancel_event.set()
+
+    def load(path: str, test_name: Optional[str]) -> bool:
+        try:
+            test_templates[path] = load_test_templates_from_file(path, test_name=test_name)
+            return True
+        except Exception as e:
+            print(f"Could not load {path}: {e}")
+            return False
+
+    def watched_files() -> list[str]:
+        return list(test_file_names(args.test_file_path, args.include, args.exclude)) + args.translation_files
+
+    watcher = FileWatcher(watched_files)
+    for path, test_name in test_file_names(args.test_file_path, args.include, args.exclude).items():
+        if load(path, test_name):
+            start(path)
+    try:
+        while True:
+            await asyncio.sleep(args.watch_interval)
+            changed, removed = watcher.poll()
+            for path in removed:
+                if path in test_templates:
+                    stop(path)
+                    del test_templates[path]
+                    print(f"{path} was removed")
+            if args.translation_files and args.translation_files[0] in changed:
+                try:
+                    previous, translations = translations, read_translations(args.translation_files)
+                except Exception as e:
+                    print(f"Could not load {args.translation_files[0]}, keeping the previous translations: {e}")
+                else:
+                    for path, templates in test_templates.items():
+                        if path not in changed:
+                            start(path, changed_translations(templates, previous, translations))
+            test_names = test_file_names(args.test_file_path, args.include, args.exclude)
+            for path in changed:
+                if path in test_names and load(path, test_names[path]):
+                    print(f"{path} changed, running its tests")
+                    start(path)
+    finally:
+        # Interrupted: cancel the jobs still running, rather than leaving them to run in BigQuery.
+        for _, cancel_event, _ in runs.values():
+            cancel_event.set()
+        await asyncio.gather(*(task for task, _, _ in runs.values()), return_exceptions=True)
+
+
+async def run_rendered_tests(args: ProgramArguments, tests_to_run: dict[str, str], bigquery_client: bigquery.Client,
+                             history: RunHistory, expected_durations: dict[str, float],
+                             sample_percent: Optional[float] = None,
+                             matrix_names: Optional[dict[str, tuple[str, str]]] = None,
+                             cancel_event: Optional[asyncio.Event] = None,
+                             semaphore: Optional[asyncio.Semaphore] = None) -> int:
+    """Runs the tests, from the preflight to the reports, and returns the exit code.
+
+    Results of a sampled run (`sample_percent` is set) are flagged as such, and are neither cached nor recorded in the
+    history, as they do not reflect the full tables.
+    In a matrix run, `matrix_names` gives the environment and the test name of each test in `tests_to_run`: durations
+    are recorded in the history under the test name, and the results are printed as a matrix.
+    When `cancel_event` is set (e.g. watch mode runs a newer version of the tests), the jobs still running are
+    cancelled, and the run stops without caching, recording or reporting anything. `semaphore` limits the queries in
+    flight together with other runs, see `run_tests_concurrently`.
+    """
+    use_cache = args.use_cache and sample_percent is None
+    # The dry-run is also needed by the result cache, to find out which tables each test reads.
+    if args.preflight or use_cache:
+        dry_run_results = await dry_run_tests(tests_to_run, bigquery_client, args.max_concurrency)
+    if args.preflight:
+        print_dry_run_table(dry_run_results)
+        if not all(res.passed for res in dry_run_results.values()):
+            print("Preflight failed, no tests were run.")
+            return 2
+        total_bytes = sum(res.bytes_processed or 0 for res in dry_run_results.values())
+        if args.max_bytes is not None and total_bytes > args.max_bytes:
+            print(f"Tests would process {format_bytes(total_bytes)}, which is over the budget of "
+                  f"{format_bytes(args.max_bytes)}. No tests were run.")
+            return 2
+        if args.preflight_only:
+            return 0
+        print()
+    if cancel_event is not None and cancel_event.is_set():
+        return 2
+    cached_results = {}
+    cache_keys = {}
+    result_cache = None
+    if use_cache:
+        result_cache = ResultCache(args.cache_file, args.cache_max_entries)
+        cache_keys = await get_cache_keys(tests_to_run, dry_run_results, bigquery_client, args.max_concurrency)
+        cached_results = {key_name: TestResult(message="OK", cached=True)
+                          for key_name, key in cache_keys.items() if result_cache.get(key)}
+    # A stop event of its own, as it is also set when `--max-failures` is reached, which is not a cancellation.
+    stop_event = asyncio.Event()
+    cancelled = asyncio.create_task(cancel_event.wait()) if cancel_event is not None else None
+    if cancelled is not None:
+        cancelled.add_done_callback(lambda _: stop_event.set())
+    try:
+        results = await run_tests_concurrently(longest_first({key_name: query
+                                                              for key_name, query in tests_to_run.items()
+                                                              if key_name not in cached_results}, expected_durations),
+                                               bigquery_client, args.max_concurrency,
+                                               poll_initial_interval=args.poll_initial_interval,
+                                               poll_max_interval=args.poll_max_interval, batch_size=args.batch_size,
+                                               max_failures=args.max_failures, stop_event=stop_event,
+                                               semaphore=semaphore)
+    finally:
+        if cancelled is not None:
+            cancelled.cancel()
+    if cancel_event is not None and cancel_event.is_set():
+        if result_cache is not None:
+            result_cache.close()
+        return 2
+    if result_cache is not None:
+        for key_name, res in results.items():
+            if res.passed and key_name in cache_keys:
+                result_cache.put(cache_keys[key_name], key_name)
+        result_cache.close()
+    if sample_percent is None:
+        for key_name, res in results.items():
+            if res.timings is not None and res.timings.execution is not None:
+                history.record(matrix_names[key_name][1] if matrix_names else key_name, res.timings.total,
+                               res.bytes_processed)
+        history.save()
+    else:
+        for res in results.values():
+            res.sample_percent = sample_percent
+    results = {key_name: cached_results.get(key_name) or results[key_name] for key_name in tests_to_run}
+    if matrix_names:
+        print_results_matrix(results, matrix_names)
+    else:
+        print_results_table(results, args.show_timings)
+    if args.top_expensive:
+        print_most_expensive_tests(results, args.top_expensive)
+    if args.json_report:
+        write_json_report(results, args.json_report)
+    if args.junit_xml:
+        write_junit_xml(results, args.junit_xml)
+    return 0 if all(res.passed for res in results.values()) else 2
+
+
+def print_results_table(results: dict[str, TestResult], show_timings: bool = False):
+    max_test_name = max([len('Test Name')] + [len(key_name) for key_name in results])
+    timings_header = ""
+    timings_separator = ""
+    timings_width = 0
+    if show_timings:
+        timings_width = len(str(TestTimings(0, 0, 0, 0)))
+        timings_header = f" | {r_pad('Timings (seconds)', timings_width)}"
+        timings_separator = f"-+-{r_pad('', timings_width, '-')}"
+    print()
+    print(f"{r_pad('Test Name', max_test_name)}{timings_header} | Result")
+    print(f"{r_pad('', max_test_name, '-')}{timings_separator}-+-------------------------")
+    for key_name, res in results.items():
+        timings_column = f" | {r_pad(str(res.timings or ''), timings_width)}" if show_timings else ""
+        print(f"{r_pad(key_name, max_test_name)}{timings_column} | {res}")
+
+
+def result_status(res: TestResult) -> str:
+    if res.passed:
+        return "PASSED"
+    return res.message if res.message in (CANCELLED, SKIPPED) else "FAILED"
+
+
+def describe_differences(statuses: dict[str, str]) -> str:
+    """Describes how the status of a test differs between environments, e.g: `passes on prod, fails on clone`."""
+    verbs = {"PASSED": "passes", "FAILED": "fails", CANCELLED: "cancelled", SKIPPED: "skipped"}
+    by_status = {}  # type: dict[str, list[str]]
+    for environment, status in statuses.items():
+        by_status.setdefault(status, []).append(environment)
+    return ", ".join(f"{verbs[status]} on {' and '.join(environments)}" for status, environments in by_status.items())
+
+
+def print_results_matrix(results: dict[str, TestResult], matrix_names: dict[str, tuple[str, str]]):
+    """Prints the status of every test in every environment, one column per environment. The tests whose status
+    differs between environments are flagged, and their failure messages are printed below the matrix.
+    """
+    matrix = {}  # type: dict[str, dict[str, TestResult]]
+    for name, res in results.items():
+        environment, key_name = matrix_names[name]
+        matrix.setdefault(key_name, {})[environment] = res
+    environments = list(dict.fromkeys(environment for environment, _ in matrix_names.values()))
+    max_test_name = max([len('Test Name')] + [len(key_name) for key_name in matrix])
+    column_widths = [max(len(environment), len(CANCELLED)) for environment in environments]
+    print()
+    print(f"{r_pad('Test Name', max_test_name)} | "
+          + " | ".join(r_pad(environment, width) for environment, width in zip(environments, column_widths))
+          + " | Differences")
+    print(f"{r_pad('', max_test_name, '-')}-+-" + "-+-".join('-' * width for width in column_widths)
+          + "-+-------------------------")
+    differing = []
+    for key_name, environment_results in matrix.items():
+        statuses = {environment: result_status(environment_results[environment]) for environment in environments}
+        differences = ""
+        if len(set(statuses.values())) > 1:
+            differences = f"<< {describe_differences(statuses)}"
+            differing.append(key_name)
+        print(f"{r_pad(key_name, max_test_name)} | "
+              + " | ".join(r_pad(statuses[environment], width)
+                           for environment, width in zip(environments, column_widths))
+              + f" | {differences}")
+    print()
+    if not differing:
+        print(f"All {len(matrix)} tests have the same result in every environment")
+        return
+    print(f"{len(differing)} of {len(matrix)} tests have a different result between environments:")
+    for key_name in differing:
+        for environment in environments:
+            res = matrix[key_name][environment]
+            if res.failed:
+                print(f"{key_name} on {environment}: {res}")
+
+
+def print_most_expensive_tests(results: dict[str, TestResult], top_n: int):
+    """Prints the `top_n` tests that billed the most bytes (and then used the most slot time)."""
+    with_statistics = [(key_name, res.statistics) for key_name, res in results.items() if res.statistics]
+    if not with_statistics:
+        return
+    most_expensive = sorted(with_statistics, key=lambda item: (-(item[1].bytes_billed or 0),
+                                                               -(item[1].slot_millis or 0)))[:top_n]
+    max_test_name = max([len('Test Name')] + [len(key_name) for key_name, _ in most_expensive])
+    column_width = 15
+    print()
+    print(f"Top {len(most_expensive)} most expensive tests:")
+    print(f"{r_pad('Test Name', max_test_name)} | {r_pad('Bytes billed', column_width)} | "
+          f"{r_pad('Bytes processed', column_width)} | {r_pad('Slot seconds', column_width)} | Cache hit")
+    print(f"{r_pad('', max_test_name, '-')}-+-{r_pad('', column_width, '-')}-+-{r_pad('', column_width, '-')}-+-"
+          f"{r_pad('', column_width, '-')}-+----------")
+    for key_name, statistics in most_expensive:
+        slot_seconds = f"{statistics.slot_millis / 1000:.1f}" if statistics.slot_millis is not None else "n/a"
+        print(f"{r_pad(key_name, max_test_name)} | {r_pad(format_bytes(statistics.bytes_billed), column_width)} | "
+              f"{r_pad(format_bytes(statistics.bytes_processed), column_width)} | "
+              f"{r_pad(slot_seconds, column_width)} | {statistics.cache_hit}")
+    total_billed = sum(res.statistics.bytes_billed or 0 for res in results.values() if res.statistics)
+    total_slot_millis = sum(res.statistics.slot_millis or 0 for res in results.values() if res.statistics)
+    print(f"Total: {format_bytes(total_billed)} billed, {total_slot_millis / 1000:.1f} slot seconds")
 
 
 def main():
     parser = get_parser()
-    args = parser.parse_args(sys.argv[1:])
-    project = args.project
-    if not project:
-        _, project = google.auth.default()
-        if not project:
+    args = ProgramArguments(parser.parse_args(sys.argv[1:]))
+    if (args.affected_only or args.list_affected) and not args.translation_files:
+        parser.error("`--affected-only` and `--list-affected` select tests by the tables in the translation file. "
+                     "You must supply one using the `--translation-file` parameter.")
+    if args.sample_percent is not None and not args.translation_files:
+        parser.error("`--sample-percent` samples the tables in the translation file. "
+                     "You must supply one using the `--translation-file` parameter.")
+    if len(set(args.translation_files)) < len(args.translation_files):
+        parser.error("The same `--translation-file` was given more than once.")
+    if args.sample_percent is not None and len(args.translation_files) > 1:
+        parser.error("`--sample-percent` can only be used with a single `--translation-file`.")
+    if args.watch:
+        if len(args.translation_files) > 1:
+            parser.error("`--watch` can only be used with a single `--translation-file`.")
+        conflicts = [option for option, value in [("--list-affected", args.list_affected),
+                                                   ("--preflight-only", args.preflight_only),
+                                                   ("--sample-percent", args.sample_percent is not None),
+                                                   ("--shard", args.shard), ("--json-report", args.json_report),
+                                                   ("--junit-xml", args.junit_xml)] if value]
+        if conflicts:
+            parser.error(f"`--watch` can not be used together with {', '.join(conflicts)}.")
+    if args.full_run_on_pass and args.sample_percent is None:
+        parser.error("`--full-run-on-pass` can only be used together with `--sample-percent`.")
+    # Listing the affected tests does not query BigQuery, so it does not need a project (nor credentials).
+    if not args.project and not args.list_affected:
+        args.project = default_project()
+        if not args.project:
             parser.error("Could not infer project from environment. "
                          "You must supply project_id using the `--project` parameter.")
             sys.exit(1)
-    exit_code = asyncio.run(run(translation_file=args.translation_file, test_file_path=args.TEST_FILE_OR_DIR_PATH,
-                                project=project))
+    if args.watch:
+        try:
+            asyncio.run(watch_tests(args))
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        sys.exit(0)
+    exit_code = asyncio.run(run(args))
     sys.exit(exit_code)
 
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from typing import Iterator, TextIO
+
+# The default number of characters to read from a file at a time.
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+# Tokens that change the state of the splitter when found outside of strings and comments. Triple quotes must come
+# before single quotes, as the first alternative that matches wins.
+_CODE_TOKENS = re.compile(r";|'''|\"\"\"|'|\"|`|#|--|/\*")
+
+# For each token that opens a string, quoted identifier or comment, the pattern that finds where it ends. Backslash
+# escapes are matched as a whole, so an escaped quote never ends a string.
+_CLOSING_TOKENS = {
+    "'": re.compile(r"\\.|'", re.DOTALL),
+    '"': re.compile(r'\\.|"', re.DOTALL),
+    "'''": re.compile(r"\\.|'''", re.DOTALL),
+    '"""': re.compile(r'\\.|"""', re.DOTALL),
+    "`": re.compile(r"\\.|`", re.DOTALL),
+    "#": re.compile(r"\n"),
+    "--": re.compile(r"\n"),
+    "/*": re.compile(r"\*/"),
+}
+
+_COMMENT_TOKENS = {"#", "--", "/*"}
+
+# The longest token is 3 characters long (a triple quote), so a match that starts closer than this to the end of the
+# buffer might be the prefix of a longer token, split between two chunks.
+_LOOKAHEAD = 3
+
+
+def iter_sql_statements(fp: TextIO, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    """Splits SQL text into statements, reading it incrementally.
+
+    Semicolons inside string literals, quoted identifiers and comments do not end a statement. Statements that only
+    contain whitespace and comments are skipped. Only the current statement and one chunk are held in memory.
+
+    Args:
+        fp: A text file (or any object with a `read(size)` method) with the SQL content
+        chunk_size: The number of characters to read at a time
+
+    Returns:
+        An iterator over the statements, each stripped of surrounding whitespace and terminated with a semicolon (one is
+        added to the last statement if the file does not end with one).
+    """
+    buffer = ""
+    start = 0  # Where the current statement starts in the buffer
+    pos = 0  # Where to continue scanning in the buffer
+    closing = None  # The pattern that ends the current string or comment, or None when in code
+    has_content = False  # Whether the current statement has anything else than whitespace and comments
+    after_line_comment = False  # Whether the last thing seen in the current statement is a line comment
+    eof = False
+    while True:
+        pattern = closing or _CODE_TOKENS
+        match = pattern.search(buffer, pos)
+        if not eof and (match is None or match.start() + _LOOKAHEAD > len(buffer)):
+            # Not enough text to decide, read the next chunk. Everything before `start` has already been yielded.
+            scanned_to = match.start() if match is not None else max(pos, len(buffer) - _LOOKAHEAD + 1)
+            if closing is None and buffer[pos:scanned_to].strip():
+                has_content = True
+                after_line_comment = False
+            pos = scanned_to
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[start:] + chunk
+            pos -= start
+            start = 0
+            continue
+        if match is None:
+            break
+        token = match.group()
+        if closing is not None:
+            if not token.startswith("\\"):
+                after_line_comment = token == "\n"
+                closing = None
+        else:
+            if buffer[pos:match.start()].strip():
+                has_content = True
+                after_line_comment = False
+            if token == ";":
+                if has_content:
+                    yield buffer[start:match.end()].strip()
+                start = match.end()
+                has_content = False
+                after_line_comment = False
+            else:
+                after_line_comment = False
+                closing = _CLOSING_TOKENS[token]
+                if token not in _COMMENT_TOKENS:
+                    has_content = True
+        pos = match.end()
+    if closing is None and buffer[pos:].strip():
+        has_content = True
+        after_line_comment = False
+    if has_content:
+        # A semicolon right after a line comment would be part of the comment.
+        in_line_comment = closing is _CLOSING_TOKENS["--"] or closing is _CLOSING_TOKENS["#"]
+        terminator = "\n;" if in_line_comment or after_line_comment else ";"
+        yield buffer[start:].strip() + terminator
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections.abc import Mapping
+from typing import Iterable, Iterator, Optional
+
+WILDCARD = "*"
+
+# Marks a key that has been resolved to nothing, in the cache of resolved keys.
+_NOT_FOUND = object()
+
+
+def without_project(table_name: str) -> Optional[str]:
+    """Returns `dataset.table` for `project.dataset.table`, or None if the name has no project."""
+    parts = table_name.split(".", 2)
+    return f"{parts[1]}.{parts[2]}" if len(parts) == 3 else None
+
+
+class RuleIndex:
+    """The exact rules and the prefix rules of a translation map, indexed for lookups."""
+
+    def __init__(self, rules: Iterable[tuple[str, str]]):
+        self.exact = {}  # type: dict[str, str]
+        self.prefixes = {}  # type: dict[str, str]
+        for key, value in rules:
+            if key.endswith(WILDCARD):
+                self.prefixes.setdefault(key[:-1], value)
+            else:
+                self.exact.setdefault(key, value)
+        # Only the lengths of the prefixes are tried, longest first, rather than every prefix of the name.
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.prefixes}, reverse=True)
+
+    def match_prefix(self, name: str) -> Optional[str]:
+        for length in self.prefix_lengths:
+            if length <= len(name) and name[:length] in self.prefixes:
+                return self.prefixes[name[:length]].replace(WILDCARD, name[length:], 1)
+        return None
+
+
+class TranslationMap(Mapping):
+    """
+    A translation map of tables, with rules of two kinds:
+    - Exact rules, mapping a table to another one. e.g: `"dataset1.foo": "project.dev.clone_20220317151941_foo"`
+    - Prefix rules, ending with a `*`, mapping all the tables whose name starts with the prefix. The `*` of the target,
+      if any, is replaced with the rest of the table name. e.g: `"dataset1.*": "project.dev.clone_20220317151941_*"`
+      maps `dataset1.foo` to `project.dev.clone_20220317151941_foo`.
+
+    The project is optional one way only: a rule with a project also matches the table written without it, but a rule
+    without a project only matches the table written without one. `dataset1.foo` must not turn
+    `bigquery-public-data.dataset1.foo` into the clone, as a test comparing that table with the clone would then compare
+    the clone with itself. Exact rules come first, then the rule with the longest prefix. Between two rules of the same
+    kind, the one written like the table (without its project) wins.
+
+    Rules are indexed once: resolving a table costs a few dictionary lookups, whatever the number of rules.
+    """
+
+    def __init__(self, rules: dict[str, str]):
+        self._rules = dict(rules)
+        for key in self._rules:
+            if WILDCARD in key[:-1]:
+                raise ValueError(f"Invalid translation rule {key!r}: a `{WILDCARD}` can only end the table name")
+        self._index = RuleIndex(self._rules.items())
+        # The rules with a project, without it, which only a table name without a project is matched against.
+        self._aliases = RuleIndex((without_project(key), value) for key, value in self._rules.items()
+                                  if without_project(key) is not None)
+        self._resolved = {}  # type: dict[str, object]
+
+    def resolve(self, table_name: str) -> Optional[str]:
+        """Returns the translation of a table, or None if no rule matches it."""
+        resolved = self._resolved.get(table_name)
+        if resolved is None:
+            resolved = self._resolve(table_name)
+            self._resolved[table_name] = _NOT_FOUND if resolved is None else resolved
+        return None if resolved is _NOT_FOUND else resolved
+
+    def _resolve(self, table_name: str) -> Optional[str]:
+        if without_project(table_name) is not None:
+            candidates = [(self._index, table_name)]
+        else:
+            candidates = [(self._index, table_name), (self._aliases, table_name)]
+        for index, name in candidates:
+            if name in index.exact:
+                return index.exact[name]
+        for index, name in candidates:
+            resolved = index.match_prefix(name)
+            if resolved is not None:
+                return resolved
+        return None
+
+    def __getitem__(self, table_name: str) -> str:
+        resolved = self.resolve(table_name)
+        if resolved is None:
+            raise KeyError(table_name)
+        return resolved
+
+    def get(self, table_name: str, default=None):
+        resolved = self.resolve(table_name)
+        return default if resolved is None else resolved
+
+    def __contains__(self, table_name) -> bool:
+        return isinstance(table_name, str) and self.resolve(table_name) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterates over the rules as they were written, not over all the tables they match."""
+        return iter(self._rules)
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+
+def compact_translations(translations: dict[str, str], complete_datasets: set[str]) -> dict[str, str]:
+    """Writes a translation map of tables in its compact form, which a `TranslationMap` resolves the same way.
+
+    Only the names with a project are kept, as they also match the names without one. The tables of a dataset in
+    `complete_datasets` (i.e. all the tables of the dataset are in `translations`) whose targets only differ by the
+    table name are replaced with a single prefix rule, e.g: `"project.dataset1.*": "project.dev.clone_1_*"`.
+
+    Args:
+        translations: The translation of every table, keyed by the name of the table with its project
+        complete_datasets: The datasets, as `project.dataset`, that were translated entirely
+
+    Returns:
+        The compact translation map, ordered like `translations`
+    """
+    by_dataset = {}  # type: dict[str, dict[str, str]]
+    for table_name, target in translations.items():
+        by_dataset.setdefault(table_name.rsplit(".", 1)[0], {})[table_name] = target
+
+    compact = {}
+    for dataset, tables in by_dataset.items():
+        target_prefixes = set()
+        for table_name, target in tables.items():
+            table_id = table_name.rsplit(".", 1)[1]
+            target_prefixes.add(target[:-len(table_id)] if target.endswith(table_id) else None)
+        if dataset in complete_datasets and len(target_prefixes) == 1 and None not in target_prefixes:
+            compact[f"{dataset}.{WILDCARD}"] = f"{target_prefixes.pop()}{WILDCARD}"
+        else:
+            compact.update(tables)
+    return compact
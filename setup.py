@@ -31,6 +31,7 @@ setup(
             'create-dev-env-interactive = scripts.create_dev_env_interactive:main',
             'create-dev-env = scripts.create_dev_env:main',
             'run-tests = scripts.run_tests:main',
+            'diff-dev-env = scripts.diff_dev_env:main',
         ],
     },
 )
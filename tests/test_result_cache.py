@@ -0,0 +1,47 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from scripts.result_cache import cache_key, is_cacheable
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM t WHERE d = CURRENT_DATE()",
+    "SELECT * FROM t WHERE d = current_date",
+    "SELECT * FROM t WHERE ts < CURRENT_TIMESTAMP ()",
+    "SELECT * FROM t WHERE RAND() < 0.1",
+    "SELECT GENERATE_UUID()",
+    "SELECT SESSION_USER()",
+])
+def test_queries_with_non_deterministic_functions_are_not_cacheable(query):
+    assert not is_cacheable(query)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM t",
+    "SELECT current_date_column, operand() FROM t",
+])
+def test_other_queries_are_cacheable(query):
+    assert is_cacheable(query)
+
+
+def test_key_changes_with_the_query_and_the_table_versions():
+    key = cache_key("SELECT 1", ["p.d.a@1", "p.d.b@1"])
+
+    assert cache_key("SELECT 1", ["p.d.b@1", "p.d.a@1"]) == key
+    assert cache_key("SELECT 2", ["p.d.a@1", "p.d.b@1"]) != key
+    assert cache_key("SELECT 1", ["p.d.a@1", "p.d.b@2"]) != key
+
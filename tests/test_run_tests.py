@@ -0,0 +1,303 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import datetime
+import re
+import string
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from scripts import run_tests
+from scripts.run_history import RunHistory
+
+
+class FakeJob:
+    """A query job that completes `duration` seconds after it was submitted, and fails if `error` is given."""
+
+    def __init__(self, client: "FakeClient", duration: float, error: str = None):
+        self._client = client
+        self._finished = False
+        self.job_id = f"job_{id(self)}"
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+        self.started = self.created
+        self.ended = None
+        self._deadline = time.monotonic() + duration
+        self.error_result = {"message": error} if error else None
+        self.total_bytes_processed = 1
+        self.total_bytes_billed = 1
+        self.slot_millis = 1
+        self.cache_hit = False
+        self.timeline = []
+
+    def done(self) -> bool:
+        # Sleeps like the HTTP request of a real client would.
+        time.sleep(0.001)
+        if not self._finished and time.monotonic() >= self._deadline:
+            self._finished = True
+            self.ended = datetime.datetime.now(datetime.timezone.utc)
+            self._client.job_finished(self)
+        return self._finished
+
+    def cancel(self):
+        if not self._finished:
+            self._finished = True
+            self._client.job_finished(self)
+
+
+class FakeClient:
+    """Runs queries of the form `SELECT <duration>, '<name>'`, and a query fails if its name starts with `fail`.
+
+    Keeps track of the number of jobs in flight, and of the order in which the jobs are submitted and complete.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.submitted = []
+        self.completed = []
+
+    def query(self, query: str) -> FakeJob:
+        duration, name = re.match(r"SELECT ([0-9.]+), '(\w+)'", query).groups()
+        time.sleep(0.001)
+        job = FakeJob(self, float(duration), error=f"{name} failed" if name.startswith("fail") else None)
+        job.name = name
+        with self._lock:
+            self.in_flight += 1
+            self.submitted.append(name)
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return job
+
+    def job_finished(self, job: FakeJob):
+        with self._lock:
+            self.in_flight -= 1
+            self.completed.append(job.name)
+
+
+def fake_tests(durations: dict[str, float]) -> dict[str, str]:
+    return {name: f"SELECT {duration}, '{name}'" for name, duration in durations.items()}
+
+
+def printed_results(output: str) -> list[str]:
+    """The names of the tests, in the order their results were printed while running."""
+    return re.findall(r"^\[\d+/\d+\] (\w+): ", output, re.MULTILINE)
+
+
+def test_never_exceeds_max_concurrency():
+    client = FakeClient()
+    tests = fake_tests({f"test_{i}": 0.05 for i in range(12)})
+
+    results = asyncio.run(run_tests.run_tests_concurrently(tests, client, max_concurrency=3,
+                                                           poll_initial_interval=0.01, poll_max_interval=0.01))
+
+    assert client.max_in_flight == 3
+    assert client.in_flight == 0
+    assert all(res.passed for res in results.values())
+
+
+def test_prints_results_in_completion_order(capsys):
+    client = FakeClient()
+    tests = fake_tests({"slow": 0.3, "medium": 0.15, "fast": 0.01})
+
+    asyncio.run(run_tests.run_tests_concurrently(tests, client, max_concurrency=3, poll_initial_interval=0.01,
+                                                 poll_max_interval=0.01))
+
+    assert client.completed == ["fast", "medium", "slow"]
+    assert printed_results(capsys.readouterr().out) == ["fast", "medium", "slow"]
+
+
+def test_returns_results_in_load_order():
+    client = FakeClient()
+    tests = fake_tests({"slow": 0.2, "fast": 0.01})
+
+    results = asyncio.run(run_tests.run_tests_concurrently(tests, client, max_concurrency=2,
+                                                           poll_initial_interval=0.01, poll_max_interval=0.01))
+
+    assert list(results) == ["slow", "fast"]
+
+
+def test_starts_tests_in_the_given_order():
+    client = FakeClient()
+    durations = {f"test_{i}": 0.01 for i in range(12)}
+    expected_durations = {name: float(i) for i, name in enumerate(durations)}
+    tests = run_tests.longest_first(fake_tests(durations), expected_durations)
+
+    asyncio.run(run_tests.run_tests_concurrently(tests, client, max_concurrency=1, poll_initial_interval=0.01,
+                                                 poll_max_interval=0.01))
+
+    assert client.submitted == [f"test_{i}" for i in reversed(range(12))]
+
+
+def test_summary_table_and_exit_code_keep_load_order(tmp_path, capsys):
+    client = FakeClient()
+    tests = fake_tests({"slow": 0.2, "fail_fast": 0.01, "fast": 0.05})
+    args = run_tests.ProgramArguments(run_tests.get_parser().parse_args([
+        "tests", "--no-cache", "--top-expensive", "0", "--poll-initial-interval", "0.01",
+        "--poll-max-interval", "0.01"]))
+    history = RunHistory(str(tmp_path / "history.json"))
+
+    exit_code = asyncio.run(run_tests.run_rendered_tests(args, tests, client, history,
+                                                         history.expected_durations(tests)))
+
+    assert exit_code == 2
+    output = capsys.readouterr().out
+    assert printed_results(output) == ["fail_fast", "fast", "slow"]
+    table = output[output.index("Test Name"):].splitlines()[2:]
+    assert [line.split(" | ")[0].strip() for line in table] == ["slow", "fail_fast", "fast"]
+    assert table[1].endswith("fail_fast failed")
+
+
+def test_exit_code_is_zero_when_all_tests_pass(tmp_path):
+    client = FakeClient()
+    tests = fake_tests({"first": 0.02, "second": 0.01})
+    args = run_tests.ProgramArguments(run_tests.get_parser().parse_args([
+        "tests", "--no-cache", "--top-expensive", "0", "--poll-initial-interval", "0.01"]))
+    history = RunHistory(str(tmp_path / "history.json"))
+
+    exit_code = asyncio.run(run_tests.run_rendered_tests(args, tests, client, history,
+                                                         history.expected_durations(tests)))
+
+    assert exit_code == 0
+
+
+def test_compile_template_splits_literals_and_placeholders():
+    assert run_tests.compile_template("SELECT * FROM ${dataset1.foo} JOIN $dataset2.bar USING (id)") == (
+        ("SELECT * FROM ", " JOIN ", " USING (id)"), ("dataset1.foo", "dataset2.bar"))
+    assert run_tests.compile_template("SELECT 1") == (("SELECT 1",), ())
+
+
+def test_compile_template_keeps_escaped_dollars_in_literals():
+    assert run_tests.compile_template("SELECT '$$5' FROM $ds.foo") == (("SELECT '$5' FROM ", ""), ("ds.foo",))
+
+
+@pytest.mark.parametrize("sql", ["SELECT 1\nFROM ${", "$", "SELECT\n\n1 $ 2"])
+def test_compile_template_rejects_invalid_placeholders_like_string_template(sql):
+    with pytest.raises(ValueError) as expected:
+        string.Template(sql).substitute({})
+    with pytest.raises(ValueError, match=re.escape(str(expected.value))):
+        run_tests.compile_template(sql)
+
+
+def test_substitute_falls_back_to_the_key():
+    template = run_tests.TemplateWithDefaultKey("SELECT * FROM `${dataset1.foo}` JOIN $dataset2.bar USING (id)")
+    translations = {"dataset1.foo": "project.dev.clone_foo"}
+
+    assert template.substitute(translations) == \
+        "SELECT * FROM `project.dev.clone_foo` JOIN dataset2.bar USING (id)"
+    assert translations == {"dataset1.foo": "project.dev.clone_foo"}
+
+
+def test_substitute_matches_string_template_for_translated_keys():
+    sql = "SELECT '$$1' FROM ${a.b}, $c.d WHERE x = '$${not_a_key}'"
+    translations = {"a.b": "p.x.b", "c.d": "p.x.d"}
+
+    assert run_tests.TemplateWithDefaultKey(sql).substitute(translations) == \
+        string.Template.substitute(run_tests.TemplateWithDefaultKey(sql), translations)
+
+
+def test_substitute_keyword_arguments_take_precedence():
+    template = run_tests.TemplateWithDefaultKey("SELECT * FROM $a.b, $c.d")
+
+    assert template.substitute({"a.b": "x.b", "c.d": "x.d"}, **{"c.d": "y.d"}) == "SELECT * FROM x.b, y.d"
+    assert template.substitute(**{"a.b": "x.b"}) == "SELECT * FROM x.b, c.d"
+
+
+def test_substitute_sampled_only_samples_translated_tables():
+    template = run_tests.TemplateWithDefaultKey("SELECT * FROM `${a.b}` AS t JOIN $c.d USING (id)")
+
+    assert template.substitute_sampled({"a.b": "p.x.b"}, 10.0) == \
+        "SELECT * FROM (SELECT * FROM `p.x.b` TABLESAMPLE SYSTEM (10 PERCENT)) AS t JOIN c.d USING (id)"
+
+
+@pytest.mark.parametrize("expected_durations", [
+    None,
+    {f"test_{i}": float(i % 7) for i in range(20)},
+    # An empty history expects every test to take 0 seconds.
+    {f"test_{i}": 0.0 for i in range(20)},
+])
+def test_shards_are_disjoint_and_cover_every_test(expected_durations):
+    tests = {f"test_{i}": f"SELECT {i}" for i in range(20)}
+
+    shards = [run_tests.shard_tests(tests, shard_index, 3, expected_durations) for shard_index in (1, 2, 3)]
+
+    assert sorted(key_name for shard in shards for key_name in shard) == sorted(tests)
+    assert all(list(shard) == [key_name for key_name in tests if key_name in shard] for shard in shards)
+    assert sorted(len(shard) for shard in shards) == [6, 7, 7]
+
+
+def test_shards_without_history_are_dealt_round_robin():
+    tests = {f"test_{i}": f"SELECT {i}" for i in range(7)}
+
+    assert list(run_tests.shard_tests(tests, 1, 3)) == ["test_0", "test_3", "test_6"]
+    assert list(run_tests.shard_tests(tests, 3, 3)) == ["test_2", "test_5"]
+
+
+def test_shards_with_history_are_balanced_by_expected_duration():
+    tests = {key_name: "SELECT 1" for key_name in ("a", "b", "c", "d", "e")}
+    expected_durations = {"a": 10.0, "b": 6.0, "c": 5.0, "d": 3.0, "e": 1.0}
+
+    shards = [run_tests.shard_tests(tests, shard_index, 2, expected_durations) for shard_index in (1, 2)]
+
+    assert [list(shard) for shard in shards] == [["a", "d"], ["b", "c", "e"]]
+    assert [sum(expected_durations[key_name] for key_name in shard) for shard in shards] == [13.0, 12.0]
+
+
+def child_job(line: int, created: datetime.datetime, seconds: float) -> SimpleNamespace:
+    return SimpleNamespace(script_statistics=SimpleNamespace(stack_frames=[SimpleNamespace(start_line=line)]),
+                           created=created, started=created, ended=created + datetime.timedelta(seconds=seconds),
+                           error_result=None, job_id=f"child_{line}", total_bytes_processed=1, total_bytes_billed=1,
+                           slot_millis=1, cache_hit=False, timeline=[])
+
+
+class FakeScriptClient:
+    """Runs a batch script of two tests, whose child jobs took 1 and 10 seconds."""
+
+    def query(self, query: str) -> SimpleNamespace:
+        return SimpleNamespace(done=lambda: True)
+
+    def list_jobs(self, parent_job=None) -> list[SimpleNamespace]:
+        created = datetime.datetime(2022, 3, 17, tzinfo=datetime.timezone.utc)
+        return [child_job(2, created, 1.0), child_job(7, created + datetime.timedelta(seconds=1), 10.0)]
+
+
+def test_batched_tests_are_timed_by_their_own_child_jobs():
+    results = asyncio.run(run_tests.batch_results_with_keys({"short": "SELECT 1", "long": "SELECT 2"},
+                                                            FakeScriptClient(), poll_initial_interval=0.01))
+
+    assert results["short"].timings.total == 1.0
+    assert results["short"].timings.execution == 1.0
+    assert results["long"].timings.total == 10.0
+
+
+def test_list_affected_does_not_need_a_project(tmp_path, monkeypatch, capsys):
+    (tmp_path / "a.sql").write_text("SELECT * FROM ${ds.foo};\nSELECT * FROM ${ds.bar};\n")
+    (tmp_path / "translations.json").write_text('{"ds.foo": "dev.foo"}')
+
+    def default_project():
+        raise AssertionError("The project must not be resolved")
+
+    monkeypatch.setattr(run_tests, "default_project", default_project)
+    monkeypatch.setattr("sys.argv", ["run-tests", str(tmp_path), "--list-affected",
+                                     "--translation-file", str(tmp_path / "translations.json")])
+
+    with pytest.raises(SystemExit) as exit_info:
+        run_tests.main()
+
+    assert exit_info.value.code == 0
+    assert "a_0: ds.foo" in capsys.readouterr().out
@@ -0,0 +1,67 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+
+import pytest
+
+from scripts.sql_splitter import iter_sql_statements
+
+
+def split(sql: str, chunk_size: int = 1 << 16) -> list[str]:
+    return list(iter_sql_statements(io.StringIO(sql), chunk_size=chunk_size))
+
+
+def test_splits_on_semicolons():
+    assert split("SELECT 1;\nSELECT 2;\n") == ["SELECT 1;", "SELECT 2;"]
+
+
+def test_adds_a_semicolon_to_the_last_statement():
+    assert split("SELECT 1;\nSELECT 2") == ["SELECT 1;", "SELECT 2;"]
+
+
+@pytest.mark.parametrize("statement", [
+    "SELECT 'a;b';",
+    'SELECT "a;b";',
+    "SELECT '''a;\nb''';",
+    'SELECT """a;\nb""";',
+    "SELECT * FROM `project.data;set.table`;",
+    "SELECT 'it\\'s;';",
+    "SELECT 1 /* a; comment */;",
+    "SELECT 1 -- a; comment\n;",
+    "SELECT 1 # a; comment\n;",
+])
+def test_semicolons_in_strings_and_comments_do_not_end_a_statement(statement):
+    assert split(statement + "\nSELECT 2;") == [statement, "SELECT 2;"]
+
+
+def test_skips_statements_with_only_whitespace_and_comments():
+    assert split("SELECT 1;\n  -- nothing here;\n/* nor; here */ ;\n;\nSELECT 2;") == ["SELECT 1;", "SELECT 2;"]
+
+
+def test_ends_a_last_statement_that_ends_with_a_line_comment_on_a_new_line():
+    assert split("SELECT 1 -- no semicolon") == ["SELECT 1 -- no semicolon\n;"]
+
+
+def test_an_empty_file_has_no_statements():
+    assert split("") == []
+    assert split("\n  -- only a comment\n") == []
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7])
+def test_tokens_split_between_chunks(chunk_size):
+    sql = "SELECT '''a;b''' -- c;d\n;/* e;f */SELECT `g;h`, \"i\\\";j\";SELECT 3"
+    assert split(sql, chunk_size=chunk_size) == split(sql)
+    assert split(sql) == ["SELECT '''a;b''' -- c;d\n;", "/* e;f */SELECT `g;h`, \"i\\\";j\";", "SELECT 3;"]
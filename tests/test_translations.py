@@ -0,0 +1,114 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from scripts.translations import TranslationMap, compact_translations
+
+
+def test_exact_rules():
+    translations = TranslationMap({"dataset1.foo": "project.dev.clone_foo"})
+
+    assert translations["dataset1.foo"] == "project.dev.clone_foo"
+    assert translations.get("dataset1.bar") is None
+    assert "dataset1.foo" in translations
+    assert "dataset1.bar" not in translations
+    with pytest.raises(KeyError):
+        translations["dataset1.bar"]
+
+
+def test_prefix_rules_replace_the_wildcard_with_the_rest_of_the_name():
+    translations = TranslationMap({"dataset1.*": "project.dev.clone_1_*"})
+
+    assert translations["dataset1.foo"] == "project.dev.clone_1_foo"
+    assert translations.get("dataset2.foo") is None
+
+
+def test_exact_rules_come_before_prefix_rules():
+    translations = TranslationMap({"dataset1.*": "project.dev.clone_1_*", "dataset1.foo": "project.dev.other_foo"})
+
+    assert translations["dataset1.foo"] == "project.dev.other_foo"
+    assert translations["dataset1.bar"] == "project.dev.clone_1_bar"
+
+
+def test_the_longest_prefix_wins():
+    translations = TranslationMap({"dataset1.*": "project.dev.short_*", "dataset1.fo*": "project.dev.long_*"})
+
+    assert translations["dataset1.foo"] == "project.dev.long_o"
+    assert translations["dataset1.bar"] == "project.dev.short_bar"
+
+
+def test_a_rule_with_a_project_also_matches_the_table_without_it():
+    translations = TranslationMap({"project.dataset1.foo": "project.dev.clone_foo",
+                                   "project.dataset2.*": "project.dev.*"})
+
+    assert translations["dataset1.foo"] == "project.dev.clone_foo"
+    assert translations["project.dataset1.foo"] == "project.dev.clone_foo"
+    assert translations["dataset2.bar"] == "project.dev.bar"
+    assert translations.get("other_project.dataset1.foo") is None
+    assert translations.get("other_project.dataset2.bar") is None
+
+
+def test_a_rule_without_a_project_only_matches_the_table_without_one():
+    translations = TranslationMap({"dataset1.foo": "project.dev.clone_foo", "dataset2.*": "project.dev.*"})
+
+    assert translations["dataset1.foo"] == "project.dev.clone_foo"
+    assert translations["dataset2.bar"] == "project.dev.bar"
+    assert translations.get("bigquery-public-data.dataset1.foo") is None
+    assert translations.get("project.dataset2.bar") is None
+
+
+def test_a_rule_written_like_the_table_wins():
+    translations = TranslationMap({"project.dataset1.foo": "project.dev.with_project",
+                                   "dataset1.foo": "project.dev.without_project"})
+
+    assert translations["project.dataset1.foo"] == "project.dev.with_project"
+    assert translations["dataset1.foo"] == "project.dev.without_project"
+
+
+def test_iterates_over_the_rules_as_written():
+    rules = {"dataset1.*": "project.dev.clone_1_*", "dataset2.foo": "project.dev.clone_foo"}
+
+    assert dict(TranslationMap(rules)) == rules
+    assert len(TranslationMap(rules)) == 2
+
+
+def test_a_wildcard_can_only_end_a_rule():
+    with pytest.raises(ValueError, match="can only end the table name"):
+        TranslationMap({"dataset1.*_foo": "project.dev.*"})
+
+
+def test_compact_translations_resolve_like_the_full_ones():
+    translations = {
+        "project.dataset1.foo": "project.dev.clone_1_foo",
+        "project.dataset1.bar": "project.dev.clone_1_bar",
+        "project.dataset2.foo": "project.dev.clone_2_foo",
+        "project.dataset3.foo": "project.dev.clone_3_foo",
+        "project.dataset3.bar": "project.dev.renamed",
+    }
+
+    compact = compact_translations(translations, complete_datasets={"project.dataset1", "project.dataset3"})
+
+    assert compact == {
+        "project.dataset1.*": "project.dev.clone_1_*",
+        "project.dataset2.foo": "project.dev.clone_2_foo",
+        "project.dataset3.foo": "project.dev.clone_3_foo",
+        "project.dataset3.bar": "project.dev.renamed",
+    }
+    full_map, compact_map = TranslationMap(translations), TranslationMap(compact)
+    for table_name in translations:
+        short_name = table_name.split(".", 1)[1]
+        assert compact_map[table_name] == full_map[table_name]
+        assert compact_map[short_name] == full_map[short_name]